@@ -0,0 +1,38 @@
+"""Autocomplete indexes
+
+Revision ID: 1b7e2a3c9f4d
+Revises: 3e15e2b894d5
+Create Date: 2014-03-04 16:20:11.482903
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '1b7e2a3c9f4d'
+down_revision = '3e15e2b894d5'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# User.autocomplete matches lower(column) LIKE 'prefix%' on these columns
+indexes = [
+    ('ix_user_fullname_lower', 'user', 'fullname'),
+    ('ix_user_username_lower', 'user', 'username'),
+    ('ix_useremail_email_lower', 'useremail', 'email'),
+    ('ix_userexternalid_username_lower', 'userexternalid', 'username'),
+    ]
+
+
+def upgrade():
+    # See lastuser_core.models.user._lower_prefix_index for the pattern operator class
+    if op.get_bind().dialect.name == 'postgresql':
+        opclass = ' text_pattern_ops'
+    else:
+        opclass = ''
+    for name, table, column in indexes:
+        op.execute('CREATE INDEX {name} ON "{table}" (lower({column}){opclass})'.format(
+            name=name, table=table, column=column, opclass=opclass))
+
+def downgrade():
+    for name, table, column in reversed(indexes):
+        op.drop_index(name, table)
@@ -0,0 +1,25 @@
+"""Access token expiry
+
+Revision ID: 2d7f4b8e1c6a
+Revises: 5e3b9c7d2f1a
+Create Date: 2014-04-14 16:08:51.302817
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '2d7f4b8e1c6a'
+down_revision = '5e3b9c7d2f1a'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # Existing tokens don't expire, so expires_at stays null for them
+    op.add_column('authtoken', sa.Column('expires_at', sa.DateTime(), nullable=True))
+    op.create_index('ix_authtoken_expires_at', 'authtoken', ['expires_at'])
+
+
+def downgrade():
+    op.drop_index('ix_authtoken_expires_at', 'authtoken')
+    op.drop_column('authtoken', 'expires_at')
@@ -0,0 +1,37 @@
+"""Event outbox
+
+Revision ID: 2d9f4c7a1e3b
+Revises: 5a2c8d1e4b7f
+Create Date: 2014-03-18 12:06:41.530218
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '2d9f4c7a1e3b'
+down_revision = '5a2c8d1e4b7f'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('event',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=False),
+    sa.Column('name', sa.Unicode(length=80), nullable=False),
+    sa.Column('entity_type', sa.Unicode(length=80), nullable=False),
+    sa.Column('entity_id', sa.Integer(), nullable=False),
+    sa.Column('payload', sa.UnicodeText(), nullable=False),
+    sa.Column('attempts', sa.Integer(), nullable=False),
+    sa.Column('error', sa.UnicodeText(), nullable=True),
+    sa.Column('dispatched_at', sa.DateTime(), nullable=True),
+    sa.Column('failed_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_event_dispatched_at', 'event', ['dispatched_at'])
+
+
+def downgrade():
+    op.drop_index('ix_event_dispatched_at', 'event')
+    op.drop_table('event')
@@ -0,0 +1,22 @@
+"""SMS provider
+
+Revision ID: 3f7a9d2c6b1e
+Revises: 6c1e8b3f2a5d
+Create Date: 2014-03-27 11:45:52.604318
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3f7a9d2c6b1e'
+down_revision = '6c1e8b3f2a5d'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('smsmessage', sa.Column('provider', sa.Unicode(length=20), nullable=True))
+
+
+def downgrade():
+    op.drop_column('smsmessage', 'provider')
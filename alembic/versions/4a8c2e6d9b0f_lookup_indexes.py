@@ -0,0 +1,37 @@
+"""Indexes for frequent lookups
+
+Revision ID: 4a8c2e6d9b0f
+Revises: 7b4e1f9a3c2d
+Create Date: 2014-04-07 15:31:09.447102
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4a8c2e6d9b0f'
+down_revision = '7b4e1f9a3c2d'
+
+from alembic import op
+
+indexes = [
+    ('ix_authcode_code', 'authcode', ['code']),
+    ('ix_useremail_user_id_primary', 'useremail', ['user_id', 'primary']),
+    ('ix_useremailclaim_email', 'useremailclaim', ['email']),
+    ('ix_useremailclaim_md5sum', 'useremailclaim', ['md5sum']),
+    ('ix_userphone_user_id_primary', 'userphone', ['user_id', 'primary']),
+    ('ix_userexternalid_service_username', 'userexternalid', ['service', 'username']),
+    ('ix_passwordresetrequest_user_id_reset_code', 'passwordresetrequest', ['user_id', 'reset_code']),
+    ('ix_team_membership_user_id', 'team_membership', ['user_id']),
+    ('ix_team_membership_team_id', 'team_membership', ['team_id']),
+    ('ix_userflashmessage_user_id', 'userflashmessage', ['user_id']),
+    ('ix_clientteamaccess_org_id', 'clientteamaccess', ['org_id']),
+    ]
+
+
+def upgrade():
+    for name, table, columns in indexes:
+        op.create_index(name, table, columns)
+
+
+def downgrade():
+    for name, table, columns in reversed(indexes):
+        op.drop_index(name, table)
@@ -0,0 +1,38 @@
+"""Notice batching and delivery failures
+
+Revision ID: 5a2c8d1e4b7f
+Revises: 1b7e2a3c9f4d
+Create Date: 2014-03-11 18:42:07.215361
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5a2c8d1e4b7f'
+down_revision = '1b7e2a3c9f4d'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('client', sa.Column('notification_batch', sa.Boolean(), nullable=False,
+        server_default=sa.text('false')))
+    op.alter_column('client', 'notification_batch', server_default=None)
+    op.create_table('noticefailure',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=False),
+    sa.Column('client_id', sa.Integer(), nullable=True),
+    sa.Column('url', sa.Unicode(length=250), nullable=False),
+    sa.Column('method', sa.Unicode(length=10), nullable=False),
+    sa.Column('payload', sa.UnicodeText(), nullable=False),
+    sa.Column('attempts', sa.Integer(), nullable=False),
+    sa.Column('error', sa.UnicodeText(), nullable=False),
+    sa.ForeignKeyConstraint(['client_id'], ['client.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    op.drop_table('noticefailure')
+    op.drop_column('client', 'notification_batch')
@@ -0,0 +1,89 @@
+"""Normalized email lookup key
+
+Revision ID: 5e3b9c7d2f1a
+Revises: 4a8c2e6d9b0f
+Create Date: 2014-04-11 11:52:37.210495
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5e3b9c7d2f1a'
+down_revision = '4a8c2e6d9b0f'
+
+from alembic import op
+from alembic.util import CommandError
+import sqlalchemy as sa
+from sqlalchemy.sql import table as sql_table, column
+
+# Rows to backfill per statement
+BATCH_SIZE = 1000
+
+
+def check_duplicates():
+    """
+    Refuse to upgrade if useremail has addresses that differ only in case. They
+    can't share the unique key, and an address left without one can't be found
+    by lookups, so its users must be merged first.
+    """
+    connection = op.get_bind()
+    t = sql_table('useremail', column('id', sa.Integer), column('user_id', sa.Integer),
+        column('email', sa.Unicode))
+    key = sa.func.lower(t.c.email)
+    keys = sa.select([key]).group_by(key).having(sa.func.count() > 1)
+    rows = connection.execute(sa.select([t.c.id, t.c.user_id, t.c.email]).where(key.in_(keys)).order_by(
+        key, t.c.id)).fetchall()
+    if rows:
+        raise CommandError("These addresses in useremail differ only in case. Merge their users, "
+            "or delete the extra addresses, and run the upgrade again:\n" + '\n'.join(
+                "  id %d, user_id %d: %s" % tuple(row) for row in rows))
+
+
+def backfill(table):
+    """
+    Fill in email_normalized in batches of rows, in id order.
+    """
+    connection = op.get_bind()
+    t = sql_table(table, column('id', sa.Integer), column('email', sa.Unicode),
+        column('email_normalized', sa.Unicode))
+    last_id = 0
+    while True:
+        rows = connection.execute(sa.select([t.c.id, t.c.email]).where(t.c.id > last_id).order_by(
+            t.c.id).limit(BATCH_SIZE)).fetchall()
+        if not rows:
+            break
+        connection.execute(t.update().where(t.c.id == sa.bindparam('row_id')).values(
+            email_normalized=sa.bindparam('key')),
+            [{'row_id': row_id, 'key': email.lower() if email is not None else None} for row_id, email in rows])
+        last_id = rows[-1][0]
+
+
+def upgrade():
+    check_duplicates()
+    op.add_column('useremail', sa.Column('email_normalized', sa.Unicode(length=254), nullable=True))
+    op.add_column('useremailclaim', sa.Column('email_normalized', sa.Unicode(length=254), nullable=True))
+    backfill('useremail')
+    backfill('useremailclaim')
+    op.alter_column('useremail', 'email_normalized', nullable=False)
+    # Lookups and autocomplete now use email_normalized instead of email and lower(email).
+    # On PostgreSQL the index takes the pattern operator class, as explained in
+    # lastuser_core.models.user._lower_prefix_index
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute('CREATE UNIQUE INDEX ix_useremail_email_normalized ON useremail '
+            '(email_normalized text_pattern_ops)')
+    else:
+        op.create_index('ix_useremail_email_normalized', 'useremail', ['email_normalized'], unique=True)
+    op.create_index('ix_useremailclaim_email_normalized', 'useremailclaim', ['email_normalized'])
+    op.drop_index('ix_useremail_email_lower', 'useremail')
+    op.drop_index('ix_useremailclaim_email', 'useremailclaim')
+
+
+def downgrade():
+    op.create_index('ix_useremailclaim_email', 'useremailclaim', ['email'])
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute('CREATE INDEX ix_useremail_email_lower ON useremail (lower(email) text_pattern_ops)')
+    else:
+        op.execute('CREATE INDEX ix_useremail_email_lower ON useremail (lower(email))')
+    op.drop_index('ix_useremailclaim_email_normalized', 'useremailclaim')
+    op.drop_index('ix_useremail_email_normalized', 'useremail')
+    op.drop_column('useremailclaim', 'email_normalized')
+    op.drop_column('useremail', 'email_normalized')
@@ -0,0 +1,38 @@
+"""Email queue
+
+Revision ID: 6c1e8b3f2a5d
+Revises: 2d9f4c7a1e3b
+Create Date: 2014-03-24 16:20:13.802145
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '6c1e8b3f2a5d'
+down_revision = '2d9f4c7a1e3b'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('emailmessage',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=False),
+    sa.Column('recipient', sa.Unicode(length=254), nullable=False),
+    sa.Column('subject', sa.Unicode(length=250), nullable=False),
+    sa.Column('body', sa.UnicodeText(), nullable=False),
+    sa.Column('html', sa.UnicodeText(), nullable=True),
+    sa.Column('status', sa.Integer(), nullable=False),
+    sa.Column('attempts', sa.Integer(), nullable=False),
+    sa.Column('error', sa.UnicodeText(), nullable=True),
+    sa.Column('retry_at', sa.DateTime(), nullable=True),
+    sa.Column('sent_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_emailmessage_status', 'emailmessage', ['status'])
+
+
+def downgrade():
+    op.drop_index('ix_emailmessage_status', 'emailmessage')
+    op.drop_table('emailmessage')
@@ -0,0 +1,27 @@
+"""Indexes for expiring records
+
+Revision ID: 7b4e1f9a3c2d
+Revises: 3f7a9d2c6b1e
+Create Date: 2014-04-02 10:12:37.118240
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7b4e1f9a3c2d'
+down_revision = '3f7a9d2c6b1e'
+
+from alembic import op
+
+
+def upgrade():
+    op.create_index('ix_authcode_created_at', 'authcode', ['created_at'])
+    op.create_index('ix_passwordresetrequest_created_at', 'passwordresetrequest', ['created_at'])
+    op.create_index('ix_userflashmessage_created_at', 'userflashmessage', ['created_at'])
+    op.create_index('ix_emailmessage_created_at', 'emailmessage', ['created_at'])
+
+
+def downgrade():
+    op.drop_index('ix_emailmessage_created_at', 'emailmessage')
+    op.drop_index('ix_userflashmessage_created_at', 'userflashmessage')
+    op.drop_index('ix_passwordresetrequest_created_at', 'passwordresetrequest')
+    op.drop_index('ix_authcode_created_at', 'authcode')
@@ -18,9 +18,54 @@ SQLALCHEMY_BINDS = {
     'lastuser': 'sqlite:///test.db',
     }
 
-#: Cache type
+#: Cache type: 'redis' (uses REDIS_URL), 'simple' (in-memory, per process) or 'null'
 CACHE_TYPE = 'redis'
 
+#: Redis server, used for caching and the job queue
+REDIS_URL = 'redis://localhost:6379/0'
+
+#: Password hashing: bcrypt work factor for new hashes (older hashes are
+#: upgraded at login), hashes computed at once per process, and seconds to
+#: wait for a free slot before responding with 503 Service Unavailable.
+#: Hashing stats are logged every PASSWORD_HASH_LOG_INTERVAL seconds (0 to not log)
+PASSWORD_HASH_ROUNDS = 12
+PASSWORD_HASH_CONCURRENCY = 4
+PASSWORD_HASH_TIMEOUT = 1.0
+PASSWORD_HASH_LOG_INTERVAL = 300
+
+#: Most token and resource pairs a client app may verify in one request to
+#: /api/1/token/verify_bulk
+VERIFY_BULK_MAX = 100
+
+#: Enqueue a job to dispatch events (signals to notify client apps, etc) after
+#: each commit that records any. Requires an RQ worker for the 'lastuser' queue
+DISPATCH_EVENTS = True
+
+#: Send queued emails from a job on the 'lastuser' RQ queue after commit
+QUEUE_EMAILS = True
+
+#: Lifetimes in seconds of auth codes, password reset links, messages
+#: waiting for trusted clients and emails that were sent or failed. Expired
+#: records are deleted by `python manage.py sweep`, which queues the work on
+#: the RQ worker with -q. Run it hourly from cron, with a crontab entry like:
+#: 0 * * * * cd /path/to/lastuser && python manage.py sweep -e production -q
+AUTH_CODE_EXPIRY = 60
+PASSWORD_RESET_EXPIRY = 86400
+FLASH_MESSAGE_EXPIRY = 604800
+EMAIL_MESSAGE_EXPIRY = 604800
+
+#: Lifetime in seconds of access tokens, or 0 for tokens that don't expire.
+#: Client apps get a new token with the refresh_token grant, for up to
+#: REFRESH_TOKEN_EXPIRY seconds after the token expires. Only set this once
+#: all client apps use refresh tokens
+ACCESS_TOKEN_EXPIRY = 0
+REFRESH_TOKEN_EXPIRY = 2592000
+
+#: Where auth codes are kept until redeemed: 'sql' (the authcode table) or
+#: 'cache' (the shared cache, which must be Redis if there are several app
+#: processes). Codes in the cache expire on their own
+AUTH_CODE_STORE = 'sql'
+
 #: Secret key
 SECRET_KEY = 'make this something random'
 
@@ -103,6 +148,12 @@ SMS_SMSGUPSHUP_PASS = ''
 SMS_EXOTEL_SID = ''
 SMS_EXOTEL_TOKEN = ''
 SMS_FROM = ''
+#: URL Exotel should post delivery reports to (/report/exotel on this site)
+SMS_EXOTEL_CALLBACK = ''
+#: Gateways to try, in order
+SMS_PROVIDERS = ['exotel', 'smsgupshup']
+#: Send queued messages from a job on the 'lastuser' RQ queue after commit
+QUEUE_SMS = True
 
 #: Messages (text or HTML)
 MESSAGE_FOOTER = Markup('Copyright &copy; <a href="http://hasgeek.com/">HasGeek</a>. Powered by <a href="https://github.com/hasgeek/lastuser" title="GitHub project page">Lastuser</a>, open source software from <a href="https://github.com/hasgeek">HasGeek</a>.')
@@ -21,7 +21,23 @@ SQLALCHEMY_BINDS = {
 SQLALCHEMY_ECHO = False
 
 #: Cache type
-CACHE_TYPE = 'redis'
+CACHE_TYPE = 'simple'
+
+#: Password hashing: bcrypt work factor for new hashes (older hashes are
+#: upgraded at login), hashes computed at once per process, and seconds to
+#: wait for a free slot before responding with 503 Service Unavailable.
+#: Hashing stats are logged every PASSWORD_HASH_LOG_INTERVAL seconds (0 to not log)
+PASSWORD_HASH_ROUNDS = 4  # Minimum, to keep tests fast
+PASSWORD_HASH_CONCURRENCY = 4
+PASSWORD_HASH_TIMEOUT = 1.0
+PASSWORD_HASH_LOG_INTERVAL = 0
+
+#: Enqueue a job to dispatch events after commit. Tests call dispatch_events directly
+DISPATCH_EVENTS = False
+
+#: Send queued emails from a background job after commit. Tests call
+#: send_queued_emails directly
+QUEUE_EMAILS = False
 
 #: Secret key
 SECRET_KEY = 'random_string_here'
@@ -89,6 +105,8 @@ RECAPTCHA_OPTIONS = ''
 SMS_SMSGUPSHUP_MASK = ''
 SMS_SMSGUPSHUP_USER = ''
 SMS_SMSGUPSHUP_PASS = ''
+#: Tests call send_queued_sms directly
+QUEUE_SMS = False
 
 #: Messages (text or HTML)
 MESSAGE_FOOTER = Markup('Copyright &copy; <a href="http://hasgeek.com/">HasGeek</a>. Powered by <a href="https://github.com/hasgeek/lastuser" title="GitHub project page">Lastuser</a>, open source software from <a href="https://github.com/hasgeek">HasGeek</a>.')
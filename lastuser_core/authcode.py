@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+"""
+Storage for OAuth authorization codes
+"""
+
+from collections import namedtuple
+from datetime import datetime
+from flask import current_app
+from coaster import newsecret
+from .cache import shared_cache
+from .expiry import expiry_seconds
+from .models import db, User, AuthCode
+
+__all__ = ['AuthCodeGrant', 'AuthCodeStore', 'SQLAuthCodeStore', 'CacheAuthCodeStore',
+    'auth_code_stores', 'auth_code_store']
+
+
+class AuthCodeGrant(namedtuple('AuthCodeGrant', ['code', 'user_id', 'client_id', 'scope', 'redirect_uri',
+        'created_at'])):
+    """
+    What a user granted a client with an auth code, as saved in an :class:`AuthCodeStore`.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def make(cls, user, client, scope, redirect_uri):
+        return cls(code=newsecret(), user_id=user.id, client_id=client.id, scope=scope,
+            redirect_uri=redirect_uri, created_at=datetime.utcnow())
+
+    @property
+    def user(self):
+        return User.query.get(self.user_id)
+
+
+class AuthCodeStore(object):
+    """
+    Base class for auth code stores. Subclasses are registered in
+    :data:`auth_code_stores` and selected with the ``AUTH_CODE_STORE`` setting.
+    """
+    def save(self, grant):
+        """
+        Save a grant until it is redeemed or expires.
+        """
+        raise NotImplementedError
+
+    def redeem(self, code, client_id):
+        """
+        Remove the grant for this code and client and return it, or return None if
+        there isn't one. Of several concurrent calls for the same code, only one
+        gets the grant. Codes are not checked for expiry.
+        """
+        raise NotImplementedError
+
+
+class SQLAuthCodeStore(AuthCodeStore):
+    """
+    Auth codes in the ``authcode`` table. The caller commits.
+    """
+    def save(self, grant):
+        db.session.add(AuthCode(code=grant.code, user_id=grant.user_id, client_id=grant.client_id,
+            scope=grant.scope, redirect_uri=grant.redirect_uri, created_at=grant.created_at))
+
+    def redeem(self, code, client_id):
+        authcode = AuthCode.query.filter_by(code=code, client_id=client_id).first()
+        if authcode is None:
+            return None
+        grant = AuthCodeGrant(code=authcode.code, user_id=authcode.user_id, client_id=authcode.client_id,
+            scope=authcode.scope, redirect_uri=authcode.redirect_uri, created_at=authcode.created_at)
+        # Only one transaction can delete the row. The others delete nothing
+        deleted = AuthCode.query.filter_by(id=authcode.id).delete(synchronize_session=False)
+        db.session.expunge(authcode)
+        return grant if deleted else None
+
+
+class CacheAuthCodeStore(AuthCodeStore):
+    """
+    Auth codes in the :data:`~lastuser_core.cache.shared_cache`, expiring after
+    ``AUTH_CODE_EXPIRY`` seconds. This needs a cache shared by all app processes,
+    such as Redis.
+    """
+    def _key(self, code):
+        return u'authcode/{code}'.format(code=code)
+
+    def save(self, grant):
+        shared_cache.set(self._key(grant.code), grant, timeout=expiry_seconds('AUTH_CODE_EXPIRY'))
+
+    def redeem(self, code, client_id):
+        grant = shared_cache.pop(self._key(code))
+        if grant is None or grant.client_id != client_id:
+            # A code presented by another client is used up all the same
+            return None
+        return grant
+
+
+#: Auth code stores by name
+auth_code_stores = {
+    'sql': SQLAuthCodeStore(),
+    'cache': CacheAuthCodeStore(),
+    }
+
+
+def auth_code_store():
+    """
+    Return the auth code store selected with the ``AUTH_CODE_STORE`` setting.
+    """
+    return auth_code_stores[current_app.config.get('AUTH_CODE_STORE', 'sql')]
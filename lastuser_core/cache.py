@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+
+"""
+Two-tier caching: a small in-process LRU in front of a shared store
+"""
+
+from threading import RLock
+from time import time
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
+from werkzeug.contrib.cache import SimpleCache, NullCache, RedisCache
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+__all__ = ['LRUCache', 'TwoTierCache', 'shared_cache', 'register_local_cache', 'delete_on_commit', 'init_cache']
+
+
+class LRUCache(object):
+    """
+    Thread-safe in-process LRU cache where every entry expires after a time-to-live.
+
+    :param int maxsize: Maximum number of entries to hold
+    :param int ttl: Seconds after which an entry expires
+    """
+    def __init__(self, maxsize=1024, ttl=10):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = RLock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires < time():
+                return None
+            self._data[key] = entry  # Re-insert to mark as most recently used
+            return value
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, time() + (self.ttl if ttl is None else ttl))
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SharedCache(object):
+    """
+    Proxy to the cross-process cache backend selected by :func:`init_cache`.
+    Until configured, this is an in-memory cache local to the process.
+    """
+    def __init__(self):
+        self.backend = SimpleCache()
+        self._lock = RLock()
+
+    def pop(self, key):
+        """
+        Get a value and delete it in one step, so that only one of several
+        concurrent callers gets it. Returns None if there is no value.
+        """
+        backend = self.backend
+        if isinstance(backend, RedisCache):
+            # MULTI/EXEC runs both commands with nothing in between
+            pipe = backend._client.pipeline(transaction=True)
+            pipe.get(backend.key_prefix + key)
+            pipe.delete(backend.key_prefix + key)
+            value, deleted = pipe.execute()
+            return backend.load_object(value) if deleted else None
+        # Other backends are local to the process
+        with self._lock:
+            value = backend.get(key)
+            backend.delete(key)
+            return value
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+
+#: Cache shared across processes (Redis in production)
+shared_cache = SharedCache()
+
+#: Caches with process-local state, to be reset when the backend changes
+_caches = []
+
+
+def register_local_cache(cache):
+    """
+    Register an object holding process-local cached data. Its ``clear()`` method
+    is called when :func:`init_cache` selects a shared backend.
+    """
+    _caches.append(cache)
+
+
+class TwoTierCache(object):
+    """
+    A namespaced cache that is looked up in a process-local :class:`LRUCache`
+    first and in the :data:`shared_cache` next. Values must be picklable and
+    should be immutable, since the local tier hands out the same instance to
+    every caller.
+
+    The local tier is not notified when another process deletes a key, so its
+    ``ttl`` should be kept short.
+
+    :param str namespace: Prefix for keys in the shared cache
+    :param int maxsize: Maximum number of entries in the local tier
+    :param int ttl: Seconds an entry may live in the local tier
+    :param int shared_ttl: Seconds an entry may live in the shared cache
+    """
+    def __init__(self, namespace, maxsize=1024, ttl=10, shared_ttl=300):
+        self.namespace = namespace
+        self.local = LRUCache(maxsize=maxsize, ttl=ttl)
+        self.shared_ttl = shared_ttl
+        register_local_cache(self)
+
+    def _key(self, key):
+        return u'{namespace}/{key}'.format(namespace=self.namespace, key=key)
+
+    def get(self, key):
+        value = self.local.get(key)
+        if value is None:
+            value = shared_cache.get(self._key(key))
+            if value is not None:
+                self.local.set(key, value)
+        return value
+
+    def set(self, key, value):
+        self.local.set(key, value)
+        shared_cache.set(self._key(key), value, timeout=self.shared_ttl)
+
+    def delete(self, key):
+        self.local.delete(key)
+        shared_cache.delete(self._key(key))
+
+    def clear(self):
+        """
+        Clear the local tier. Shared entries expire on their own.
+        """
+        self.local.clear()
+
+
+def delete_on_commit(session, cache, *keys):
+    """
+    Delete keys from a :class:`TwoTierCache` once the session commits. Use this
+    when rows change: until the commit, lookups in other transactions still see
+    the old row and would put it back in the cache if the key was deleted now.
+
+    :param session: Database session the change was made in
+    :param cache: :class:`TwoTierCache` to delete from
+    :param keys: Keys to delete. Empty keys are skipped
+    """
+    if session is None:
+        return
+    pending = session.info.setdefault('cache_deletes', {})
+    pending.setdefault(cache.namespace, (cache, set()))[1].update(key for key in keys if key)
+
+
+@event.listens_for(Session, 'after_commit')
+def _cache_deletes_committed(session):
+    for cache, keys in session.info.pop('cache_deletes', {}).values():
+        for key in keys:
+            cache.delete(key)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _cache_deletes_discarded(session):
+    session.info.pop('cache_deletes', None)
+
+
+def init_cache(app):
+    """
+    Select the shared cache backend using the app's ``CACHE_TYPE`` setting:
+    ``redis`` (using ``REDIS_URL``), ``null`` to disable sharing, or anything
+    else for an in-memory cache local to the process.
+    """
+    cache_type = app.config.get('CACHE_TYPE')
+    if cache_type == 'redis':
+        from redis import StrictRedis
+        shared_cache.backend = RedisCache(
+            StrictRedis.from_url(app.config.get('REDIS_URL', 'redis://localhost:6379/0')),
+            key_prefix=app.config.get('CACHE_KEY_PREFIX', 'lastuser/'))
+    elif cache_type == 'null':
+        shared_cache.backend = NullCache()
+    else:
+        shared_cache.backend = SimpleCache()
+    for cache in _caches:
+        cache.clear()
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+"""
+Expiry of short-lived records
+"""
+
+from datetime import datetime, timedelta
+from time import time
+from flask import current_app
+from flask.ext.rq import job
+from .jobs import with_app_context
+from .models import db, AuthCode, AuthToken, PasswordResetRequest, UserFlashMessage, EmailMessage, EMAIL_STATUS
+
+__all__ = ['EXPIRY_DEFAULTS', 'expiry_seconds', 'expiry_cutoff', 'delete_expired', 'sweep_expired']
+
+#: Lifetimes in seconds, unless set in the app's config
+EXPIRY_DEFAULTS = {
+    'AUTH_CODE_EXPIRY': 60,
+    'ACCESS_TOKEN_EXPIRY': 0,  # Access tokens don't expire
+    'REFRESH_TOKEN_EXPIRY': 2592000,  # After the access token expires
+    'PASSWORD_RESET_EXPIRY': 86400,
+    'FLASH_MESSAGE_EXPIRY': 604800,
+    'EMAIL_MESSAGE_EXPIRY': 604800,
+    }
+
+#: Models removed by :func:`sweep_expired`, with the column their lifetime counts
+#: from, the setting for their lifetime, and criteria for the records that expire
+expiring_models = [
+    (AuthCode, 'created_at', 'AUTH_CODE_EXPIRY', ()),
+    (AuthToken, 'expires_at', 'REFRESH_TOKEN_EXPIRY', ()),
+    (PasswordResetRequest, 'created_at', 'PASSWORD_RESET_EXPIRY', ()),
+    (UserFlashMessage, 'created_at', 'FLASH_MESSAGE_EXPIRY', ()),
+    # Emails that are done with. Their bodies may have reset links and verification codes
+    (EmailMessage, 'created_at', 'EMAIL_MESSAGE_EXPIRY',
+        (EmailMessage.status.in_([EMAIL_STATUS.SENT, EMAIL_STATUS.FAILED]),)),
+    ]
+
+
+def expiry_seconds(setting):
+    """
+    Return the lifetime in seconds for a setting in :data:`EXPIRY_DEFAULTS`.
+    """
+    return current_app.config.get(setting, EXPIRY_DEFAULTS[setting])
+
+
+def expiry_cutoff(setting):
+    """
+    Return the creation time before which records with this lifetime have expired.
+
+    :param str setting: Name of the lifetime setting, from :data:`EXPIRY_DEFAULTS`
+    """
+    return datetime.utcnow() - timedelta(seconds=expiry_seconds(setting))
+
+
+def delete_expired(model, cutoff, batch_size=1000, column='created_at', criteria=()):
+    """
+    Delete records created before the cutoff, committing after each batch so that
+    locks are held briefly. Returns the number of records deleted.
+
+    :param model: Model with a ``created_at`` column
+    :param datetime cutoff: Creation time before which records are deleted
+    :param int batch_size: Records to delete per transaction
+    :param str column: Column to compare with the cutoff instead of ``created_at``
+    :param criteria: Further conditions that the records must meet
+    """
+    column = getattr(model, column)
+    count = 0
+    while True:
+        ids = [rowid for (rowid,) in db.session.query(model.id).filter(
+            column < cutoff, *criteria).order_by(column).limit(batch_size)]
+        if not ids:
+            break
+        count += model.query.filter(model.id.in_(ids)).delete(synchronize_session=False)
+        db.session.commit()
+    return count
+
+
+@job('lastuser')
+@with_app_context
+def sweep_expired(batch_size=1000):
+    """
+    Delete expired auth codes, password reset requests and flash messages, access
+    tokens that can no longer be refreshed, and old emails that were sent or failed.
+    Returns a list of (table name, rows deleted, seconds taken). Queue this from
+    cron with ``python manage.py sweep -q``.
+
+    :param int batch_size: Records to delete per transaction
+    """
+    report = []
+    for model, column, setting, criteria in expiring_models:
+        started = time()
+        count = delete_expired(model, expiry_cutoff(setting), batch_size, column, criteria)
+        report.append((model.__tablename__, count, time() - started))
+    return report
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+"""
+Query plan checks for queries on the login and token paths
+"""
+
+from collections import namedtuple
+from sqlalchemy import event
+from .models import (db, getuser, notice_recipients, scope_catalog, Client, AuthCode, AuthToken,
+    UserFlashMessage, UserEmail, UserPhone, UserClientPermissions, TeamClientPermissions, Team,
+    PasswordResetRequest)
+from .models.user import team_membership
+
+__all__ = ['canonical_queries', 'explain_queries']
+
+# Stand-in for a user or organization, for queries that only need ids
+_Ref = namedtuple('_Ref', ['id', 'owners_id'])
+
+
+def canonical_queries():
+    """
+    Return (label, function, scan_expected) for the queries issued by
+    ``getuser``, ``verifyscope``, ``oauth_token`` and ``get_userinfo``. Each
+    function makes the same queries as the code it stands for.
+    """
+    user = _Ref(1, None)
+    org = _Ref(1, 1)
+    return [
+        ('getuser: username', lambda: getuser(u'username'), False),
+        ('getuser: email', lambda: getuser(u'user@example.com'), False),
+        ('getuser: twitter', lambda: getuser(u'@username'), False),
+        # The scope catalog loads every resource by design, once per process
+        ('verifyscope: scope catalog', lambda: scope_catalog._load(), True),
+        ('oauth_token: client', lambda: Client.query.filter_by(key=u'key').first(), False),
+        ('oauth_token: auth code', lambda: AuthCode.query.filter_by(code=u'code', client_id=1).first(), False),
+        ('oauth_token: token', lambda: AuthToken.query.filter_by(user_id=1, client_id=1).first(), False),
+        ('oauth_token: refresh token', lambda: AuthToken.query.filter_by(
+            refresh_token=u'token', client_id=1).first(), False),
+        ('oauth_token: flash messages', lambda: UserFlashMessage.query.filter_by(user_id=1).all(), False),
+        ('reset_email: reset request', lambda: PasswordResetRequest.query.filter_by(
+            user_id=1, reset_code=u'code').first(), False),
+        ('get_userinfo: emails', lambda: UserEmail.query.filter_by(user_id=1).all(), False),
+        ('get_userinfo: phones', lambda: UserPhone.query.filter_by(user_id=1).all(), False),
+        ('get_userinfo: teams', lambda: Team.query.join(team_membership).filter(
+            team_membership.c.user_id == 1).all(), False),
+        ('get_userinfo: user permissions', lambda: UserClientPermissions.query.filter_by(
+            user_id=1, client_id=1).first(), False),
+        ('get_userinfo: team permissions', lambda: TeamClientPermissions.query.filter_by(client_id=1).filter(
+            TeamClientPermissions.team_id.in_([1, 2])).all(), False),
+        ('notify: user tokens', lambda: notice_recipients(user=user), False),
+        ('notify: org owner tokens', lambda: notice_recipients(org=org, team_access=True), False),
+        ]
+
+
+def _plan(cursor, dialect, statement, parameters):
+    """
+    Return the plan for a statement as a list of lines, and whether it scans a table.
+    """
+    if dialect == 'postgresql':
+        cursor.execute('EXPLAIN ' + statement, parameters)
+        lines = [row[0] for row in cursor.fetchall()]
+        return lines, any('Seq Scan' in line for line in lines)
+    elif dialect == 'sqlite':
+        cursor.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+        lines = [row[-1] for row in cursor.fetchall()]
+        return lines, any(line.startswith('SCAN') and 'INDEX' not in line for line in lines)
+    raise ValueError("Query plans are not supported for %s" % dialect)
+
+
+def explain_queries():
+    """
+    Run each canonical query and explain the statements it sends to the database.
+    Returns a list of (label, statement, plan lines, scans a table, scan expected).
+    """
+    engine = db.get_engine(db.get_app(), 'lastuser')
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append((label, statement, parameters, scan_expected))
+
+    event.listen(engine, 'before_cursor_execute', record)
+    try:
+        for label, query, scan_expected in canonical_queries():
+            query()
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
+        db.session.rollback()
+
+    report = []
+    dialect = engine.dialect.name
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        if dialect == 'postgresql':
+            # Small tables are always scanned. Make the planner use an index if there is one.
+            # SET LOCAL lasts until the rollback below, so the pooled connection is left as it was
+            cursor.execute('SET LOCAL enable_seqscan = off')
+        for label, statement, parameters, scan_expected in statements:
+            lines, scans = _plan(cursor, dialect, statement, parameters)
+            report.append((label, statement, lines, scans, scan_expected))
+    finally:
+        connection.rollback()
+        connection.close()
+    return report
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+
+"""
+Running and scheduling jobs on the 'lastuser' RQ queue
+"""
+
+from datetime import timedelta
+from functools import wraps
+from flask import has_app_context
+from flask.ext.rq import get_queue
+from .models import db
+
+__all__ = ['with_app_context', 'enqueue_in']
+
+
+def with_app_context(f):
+    """
+    Decorator for jobs, which workers call without an app context. Pushes one for
+    the job if there isn't one already, so the job can use the app's config.
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if has_app_context():
+            return f(*args, **kwargs)
+        with db.get_app().app_context():
+            return f(*args, **kwargs)
+    return decorated_function
+
+
+@with_app_context
+def enqueue_in(seconds, func, *args, **kwargs):
+    """
+    Run a job on the 'lastuser' queue after a delay. Jobs that need to try again
+    later should use this instead of sleeping, which holds up every job queued
+    behind them. Delayed jobs are run by workers started with ``--with-scheduler``.
+
+    :param int seconds: Delay before the job is queued
+    :param func: Job function, called with the remaining arguments
+    """
+    return get_queue('lastuser').enqueue_in(timedelta(seconds=seconds), func, *args, **kwargs)
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 from inspect import isclass
+from flask import g, has_request_context
 from flask.ext.sqlalchemy import SQLAlchemy
 from coaster.sqlalchemy import TimestampMixin, BaseMixin  # Imported from here by other models
 
@@ -10,6 +11,9 @@ db = SQLAlchemy()
 from .user import *
 from .client import *
 from .notice import *
+from .event import *
+from .merge import *
+from ..passwords import password_hasher
 
 
 def getuser(name):
@@ -34,38 +38,91 @@ def getuser(name):
         return User.get(username=name)
 
 
-def getextid(service, userid):
-    return UserExternalId.get(service=service, userid=userid)
+def resolve_user(name):
+    """
+    Like :func:`getuser`, but remembers the result for the rest of the request, so
+    that forms and views looking up the same name share a single lookup.
+    """
+    if not has_request_context():
+        return getuser(name)
+    if not hasattr(g, 'resolved_users'):
+        g.resolved_users = {}
+    if name not in g.resolved_users:
+        g.resolved_users[name] = getuser(name)
+    return g.resolved_users[name]
 
 
-def merge_users(user1, user2):
+def check_password(user, password):
     """
-    Merge two user accounts and return the new user account.
+    Check a password for a user who may be ``None``. If there is no user or the
+    user has no password, a dummy hash is checked instead, so that the response
+    takes as long as it would for a real user.
     """
-    # Always keep the older account and merge from the newer account
-    if user1.created_at < user2.created_at:
-        keep_user, merge_user = user1, user2
-    else:
-        keep_user, merge_user = user2, user1
-
-    # 1. Inspect all tables for foreign key references to merge_user and switch to keep_user.
-    for model in db.Model.__subclasses__():
-        if model != User:
-            # a. This is a model and it's not the User model. Does it have a migrate_user classmethod?
-            if hasattr(model, 'migrate_user'):
-                model.migrate_user(olduser=merge_user, newuser=keep_user)
-            # b. No migrate_user? Does it have a user_id column?
-            elif hasattr(model, 'user_id') and hasattr(model, 'query'):
-                for row in model.query.filter_by(user_id=merge_user.id).all():
-                    row.user_id = keep_user.id
-    # 2. Add merge_user's userid to olduserids. Commit session.
-    db.session.add(UserOldId(user=keep_user, userid=merge_user.userid))
-    # 3. Mark merge_user as merged. Commit session.
-    merge_user.status = USER_STATUS.MERGED
-    # 4. Release the username
-    merge_user.username = None
-    # 5. Commit all of this
-    db.session.commit()
-
-    # 6. Return keep_user.
-    return keep_user
+    if user is None or user.pw_hash is None:
+        return password_hasher.verify_dummy(password)
+    return user.password_is(password)
+
+
+def getusers(names):
+    """
+    Bulk version of :func:`getuser`. Returns active users matching the given usernames,
+    email addresses or Twitter handles, without duplicates, in the order the names were
+    given. Each kind of name is resolved with one query, and the old userids of all the
+    users found are loaded with one more.
+    """
+    usernames = set()
+    handles = set()
+    emails = set()
+    for name in names:
+        if not name:
+            continue
+        if '@' in name:
+            if name.startswith('@'):
+                handles.add(name[1:])
+            else:
+                emails.add(name)
+        else:
+            usernames.add(name)
+
+    found = {}  # name: user
+    if usernames:
+        for user in User.query.filter(User.username.in_(usernames), User.status == USER_STATUS.ACTIVE).all():
+            found[user.username] = user
+    if handles:
+        for extid in UserExternalId.query.filter(UserExternalId.service == u'twitter',
+                UserExternalId.username.in_(handles)).options(db.joinedload(UserExternalId.user)).all():
+            if extid.user.is_active:
+                found.setdefault(u'@' + extid.username, extid.user)
+    if emails:
+        keys = dict((email, normalize_email(email)) for email in emails)
+        useremails = dict((useremail.email_normalized, useremail) for useremail in UserEmail.query.filter(
+            UserEmail.email_normalized.in_(set(keys.values()))).options(db.joinedload(UserEmail.user)).all())
+        for email in emails:
+            useremail = useremails.get(keys[email])
+            if useremail and useremail.user.is_active:
+                found[email] = useremail.user
+        # No verified email address? Like getuser, return the first user to claim it
+        unverified = set(keys[email] for email in emails if email not in found)
+        if unverified:
+            claims = {}
+            for claim in UserEmailClaim.query.filter(UserEmailClaim.email_normalized.in_(unverified)).options(
+                    db.joinedload(UserEmailClaim.user)).order_by(UserEmailClaim.user_id).all():
+                claims.setdefault(claim.email_normalized, []).append(claim)
+            for email in emails:
+                results = claims.get(keys[email]) if email not in found else None
+                if results and results[0].user.is_active:
+                    found[email] = results[0].user
+
+    users = []
+    user_ids = set()
+    for name in names:
+        user = found.get(name)
+        if user is not None and user.id not in user_ids:
+            users.append(user)
+            user_ids.add(user.id)
+    User.preload_oldids(users)
+    return users
+
+
+def getextid(service, userid):
+    return UserExternalId.get(service=service, userid=userid)
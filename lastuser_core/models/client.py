@@ -1,14 +1,24 @@
 # -*- coding: utf-8 -*-
 
+from collections import namedtuple
+from datetime import datetime, timedelta
+from hashlib import sha256
+from threading import RLock
+from time import time
+from flask import g, has_request_context
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
 from sqlalchemy.ext.declarative import declared_attr
+from werkzeug.security import safe_str_cmp
 from coaster import newid, newsecret
 
 from . import db, BaseMixin
-from .user import User, Organization, Team
+from .user import User, Organization, Team, team_membership
+from ..cache import TwoTierCache, shared_cache, register_local_cache, delete_on_commit
 
-__all__ = ['Client', 'UserFlashMessage', 'Resource', 'ResourceAction', 'AuthCode', 'AuthToken',
-    'Permission', 'UserClientPermissions', 'TeamClientPermissions', 'NoticeType',
-    'CLIENT_TEAM_ACCESS', 'ClientTeamAccess']
+__all__ = ['Client', 'ClientSnapshot', 'UserFlashMessage', 'Resource', 'ResourceAction', 'ResourceSnapshot',
+    'ResourceActionSnapshot', 'scope_catalog', 'Scope', 'AuthCode', 'AuthToken', 'AuthTokenSnapshot', 'Permission', 'UserClientPermissions', 'TeamClientPermissions', 'NoticeType',
+    'CLIENT_TEAM_ACCESS', 'ClientTeamAccess', 'NoticeRecipient', 'notice_recipients']
 
 
 class Client(BaseMixin, db.Model):
@@ -33,6 +43,8 @@ class Client(BaseMixin, db.Model):
     redirect_uri = db.Column(db.Unicode(250), nullable=True, default=u'')
     #: Back-end notification URI
     notification_uri = db.Column(db.Unicode(250), nullable=True, default=u'')
+    #: Accept multiple notices in a single request to the notification URI?
+    notification_batch = db.Column(db.Boolean, nullable=False, default=False)
     #: Front-end notification URI
     iframe_uri = db.Column(db.Unicode(250), nullable=True, default=u'')
     #: Resource discovery URI
@@ -57,7 +69,7 @@ class Client(BaseMixin, db.Model):
         """
         Check if the provided client secret is valid.
         """
-        return self.secret == candidate
+        return safe_str_cmp(self.secret, candidate)
 
     @property
     def owner_title(self):
@@ -74,7 +86,7 @@ class Client(BaseMixin, db.Model):
     def owner_is(self, user):
         if not user:
             return False
-        return self.user == user or (self.org and self.org in user.organizations_owned())
+        return self.user == user or (self.org_id is not None and self.org_id in user.organizations_owned_ids())
 
     def orgs_with_team_access(self):
         """
@@ -101,6 +113,67 @@ class Client(BaseMixin, db.Model):
         """
         return cls.query.filter_by(key=key, active=True).one_or_none()
 
+    def snapshot(self):
+        """
+        Return a :class:`ClientSnapshot` of this client.
+        """
+        return ClientSnapshot(id=self.id, key=self.key, secret_digest=_secret_digest(self.secret),
+            active=self.active, trusted=self.trusted, team_access=self.team_access)
+
+    @classmethod
+    def get_cached(cls, key):
+        """
+        Return a :class:`ClientSnapshot` for the client with the given key, from cache if
+        available. Unlike :meth:`get`, inactive clients are returned too; check ``active``.
+        Use this instead of :meth:`get` where the client is only being authenticated.
+
+        :param str key: Client key to lookup
+        """
+        snapshot = client_cache.get(key)
+        if snapshot is None:
+            client = cls.query.filter_by(key=key).one_or_none()
+            if client is None:
+                return None
+            snapshot = client.snapshot()
+            client_cache.set(key, snapshot)
+        return snapshot
+
+    @classmethod
+    def uncache(cls, *keys):
+        """
+        Remove the given client keys from the cache.
+        """
+        for key in keys:
+            if key:
+                client_cache.delete(key)
+
+
+def _secret_digest(secret):
+    return sha256(secret.encode('utf-8') if isinstance(secret, unicode) else secret).hexdigest()
+
+
+class ClientSnapshot(namedtuple('ClientSnapshot',
+        ['id', 'key', 'secret_digest', 'active', 'trusted', 'team_access'])):
+    """
+    Immutable summary of a :class:`Client` for authentication, suitable for caching.
+    Only a digest of the secret is kept.
+    """
+    __slots__ = ()
+
+    def secret_is(self, candidate):
+        """
+        Check if the provided client secret is valid.
+        """
+        return safe_str_cmp(_secret_digest(candidate), self.secret_digest)
+
+    @property
+    def client(self):
+        return Client.query.get(self.id)
+
+
+#: Cache of :class:`ClientSnapshot` instances, keyed by client key
+client_cache = TwoTierCache('client', maxsize=1000)
+
 
 class UserFlashMessage(BaseMixin, db.Model):
     """
@@ -114,6 +187,9 @@ class UserFlashMessage(BaseMixin, db.Model):
     seq = db.Column(db.Integer, default=0, nullable=False)
     category = db.Column(db.Unicode(20), nullable=False)
     message = db.Column(db.Unicode(250), nullable=False)
+    __table_args__ = (db.Index('ix_userflashmessage_user_id', 'user_id'),
+        # For deleting expired messages
+        db.Index('ix_userflashmessage_created_at', 'created_at'))
 
 
 class Resource(BaseMixin, db.Model):
@@ -195,18 +271,175 @@ class ResourceAction(BaseMixin, db.Model):
         return cls.query.filter_by(name=name, resource=resource).one_or_none()
 
 
+class ResourceSnapshot(namedtuple('ResourceSnapshot', ['id', 'name', 'title', 'trusted', 'client_id', 'actions'])):
+    """
+    Immutable copy of a :class:`Resource` in the :data:`scope_catalog`. ``actions``
+    is a dictionary of action name: :class:`ResourceActionSnapshot`.
+    """
+    __slots__ = ()
+
+    def __hash__(self):
+        # The actions dictionary can't be hashed
+        return hash(self.id)
+
+
+#: Immutable copy of a :class:`ResourceAction` in the :data:`scope_catalog`
+ResourceActionSnapshot = namedtuple('ResourceActionSnapshot', ['id', 'name', 'title'])
+
+
+class ScopeCatalog(object):
+    """
+    Process-wide copy of all resources and their actions, for validating scope
+    without querying the database. A version counter in the shared cache is bumped
+    whenever a commit changes a resource or action, and each process reloads its
+    copy when it sees a new version. The counter is read once per request, however
+    many lookups the request makes. Copies are also reloaded after ``maxage``
+    seconds, in case the counter is evicted from the cache.
+
+    :param int maxage: Seconds after which the catalog is reloaded regardless
+    """
+    version_key = 'scopecatalog/version'
+
+    def __init__(self, maxage=300):
+        self.maxage = maxage
+        self._lock = RLock()
+        self.clear()
+        register_local_cache(self)
+
+    def clear(self):
+        with self._lock:
+            self._resources = None
+            self._version = None
+            self._loaded_at = 0
+
+    def _load(self):
+        resources = {}
+        for resource in Resource.query.options(db.joinedload(Resource.actions)).all():
+            resources[resource.name] = ResourceSnapshot(resource.id, resource.name, resource.title,
+                resource.trusted, resource.client_id,
+                dict((action.name, ResourceActionSnapshot(action.id, action.name, action.title))
+                    for action in resource.actions))
+        return resources
+
+    def _shared_version(self):
+        if not has_request_context():
+            return shared_cache.get(self.version_key)
+        if not hasattr(g, 'scope_catalog_version'):
+            g.scope_catalog_version = shared_cache.get(self.version_key)
+        return g.scope_catalog_version
+
+    def resources(self):
+        """
+        Return a dictionary of resource name: :class:`ResourceSnapshot`.
+        """
+        version = self._shared_version()
+        with self._lock:
+            if self._resources is None or self._version != version or self._loaded_at + self.maxage < time():
+                self._resources = self._load()
+                self._version = version
+                self._loaded_at = time()
+            return self._resources
+
+    def get(self, name):
+        """
+        Return the :class:`ResourceSnapshot` for the named resource, or None.
+        """
+        return self.resources().get(name)
+
+    def invalidate(self):
+        """
+        Make every process reload the catalog on next use.
+        """
+        self.clear()
+        shared_cache.inc(self.version_key)
+        if has_request_context() and hasattr(g, 'scope_catalog_version'):
+            del g.scope_catalog_version
+
+
+#: Catalog of all resources, for validating scope
+scope_catalog = ScopeCatalog()
+
+
+@event.listens_for(Resource, 'after_insert')
+@event.listens_for(Resource, 'after_update')
+@event.listens_for(Resource, 'after_delete')
+@event.listens_for(ResourceAction, 'after_insert')
+@event.listens_for(ResourceAction, 'after_update')
+@event.listens_for(ResourceAction, 'after_delete')
+def _resource_changed(mapper, connection, target):
+    # Invalidate only after commit, so other processes don't reload the old data
+    session = db.object_session(target)
+    if session is not None:
+        session.info['scope_catalog_changed'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def _session_committed(session):
+    if session.info.pop('scope_catalog_changed', False):
+        scope_catalog.invalidate()
+
+
+@event.listens_for(Session, 'after_rollback')
+def _session_rolledback(session):
+    session.info.pop('scope_catalog_changed', None)
+
+
+class Scope(tuple):
+    """
+    Parsed scope: a sorted tuple of tokens, with membership and subset tests
+    backed by a frozenset. Scope is immutable, so it can be cached and shared.
+
+    :param value: Scope as a space-separated string, or an iterable of tokens
+    """
+    def __new__(cls, value=()):
+        if isinstance(value, Scope):
+            return value
+        if isinstance(value, basestring):
+            tokens = frozenset(value.split())
+        else:
+            tokens = frozenset(t.strip() for t in value if t and t.strip())
+        scope = super(Scope, cls).__new__(cls, sorted(tokens))
+        scope._tokens = tokens
+        return scope
+
+    def __reduce__(self):
+        return (Scope, (tuple(self),))
+
+    def __contains__(self, token):
+        return token in self._tokens
+
+    def issubset(self, other):
+        return self._tokens.issubset(other)
+
+    def issuperset(self, other):
+        return self._tokens.issuperset(other)
+
+    def union(self, *others):
+        return Scope(self._tokens.union(*others))
+
+    __or__ = union
+
+    def __unicode__(self):
+        return u' '.join(self)
+
+
 class ScopeMixin(object):
     @declared_attr
     def _scope(self):
         return db.Column('scope', db.UnicodeText, nullable=False)
 
     def _scope_get(self):
-        return sorted([t.strip() for t in self._scope.replace('\r', ' ').replace('\n', ' ').split(u' ') if t])
+        # Parse once per value of the column. Reloading or setting the column replaces the value
+        raw = self._scope
+        cached = self.__dict__.get('_scope_parsed')
+        if cached is None or cached[0] is not raw:
+            cached = self._scope_parsed = (raw, Scope(raw))
+        return cached[1]
 
     def _scope_set(self, value):
-        if isinstance(value, basestring):
-            value = [value]
-        self._scope = u' '.join(sorted([t.strip() for t in value if t]))
+        scope = Scope(value)
+        self._scope = unicode(scope)
+        self._scope_parsed = (self._scope, scope)
 
     @declared_attr
     def scope(self):
@@ -215,7 +448,7 @@ class ScopeMixin(object):
     def add_scope(self, additional):
         if isinstance(additional, basestring):
             additional = [additional]
-        self.scope = list(set(self.scope).union(set(additional)))
+        self.scope = self.scope.union(additional)
 
 
 class AuthCode(ScopeMixin, BaseMixin, db.Model):
@@ -227,9 +460,11 @@ class AuthCode(ScopeMixin, BaseMixin, db.Model):
     client_id = db.Column(db.Integer, db.ForeignKey('client.id'), nullable=False)
     client = db.relationship(Client, primaryjoin=client_id == Client.id,
         backref=db.backref("authcodes", cascade="all, delete-orphan"))
-    code = db.Column(db.String(44), default=newsecret, nullable=False)
+    code = db.Column(db.String(44), default=newsecret, nullable=False, index=True)
     redirect_uri = db.Column(db.Unicode(1024), nullable=False)
     used = db.Column(db.Boolean, default=False, nullable=False)
+    # For deleting expired codes
+    __table_args__ = (db.Index('ix_authcode_created_at', 'created_at'),)
 
 
 class AuthToken(ScopeMixin, BaseMixin, db.Model):
@@ -246,10 +481,14 @@ class AuthToken(ScopeMixin, BaseMixin, db.Model):
     secret = db.Column(db.String(44), nullable=True)
     _algorithm = db.Column('algorithm', db.String(20), nullable=True)
     validity = db.Column(db.Integer, nullable=False, default=0)  # Validity period in seconds
+    #: When this token stops working, or null if it doesn't expire
+    expires_at = db.Column(db.DateTime, nullable=True)
     refresh_token = db.Column(db.String(22), nullable=True, unique=True)
 
-    # Only one authtoken per user and client. Add to scope as needed
-    __table_args__ = (db.UniqueConstraint("user_id", "client_id"), {})
+    # Only one authtoken per user and client. Add to scope as needed.
+    # Tokens are deleted some time after they expire
+    __table_args__ = (db.UniqueConstraint("user_id", "client_id"),
+        db.Index('ix_authtoken_expires_at', 'expires_at'))
 
     def __init__(self, **kwargs):
         super(AuthToken, self).__init__(**kwargs)
@@ -257,14 +496,35 @@ class AuthToken(ScopeMixin, BaseMixin, db.Model):
         if self.user:
             self.refresh_token = newid()
         self.secret = newsecret()
+        self._set_expiry()
+
+    def _set_expiry(self):
+        if self.validity:
+            self.expires_at = datetime.utcnow() + timedelta(seconds=self.validity)
+        else:
+            self.expires_at = None
 
-    def refresh(self):
+    def refresh(self, validity=None):
         """
-        Create a new token while retaining the refresh token.
+        Replace the token, and the refresh token if there is one, and restart the
+        validity period. Client-only tokens are replaced as well, so that one that
+        has expired isn't made valid again.
+
+        :param int validity: New validity period in seconds, if it has changed
         """
+        self.token = newid()
+        self.secret = newsecret()
         if self.refresh_token is not None:
-            self.token = newid()
-            self.secret = newsecret()
+            self.refresh_token = newid()
+        if validity is not None:
+            self.validity = validity
+        self._set_expiry()
+
+    def is_valid(self):
+        """
+        Has this token not expired yet?
+        """
+        return self.expires_at is None or self.expires_at > datetime.utcnow()
 
     @property
     def algorithm(self):
@@ -284,26 +544,18 @@ class AuthToken(ScopeMixin, BaseMixin, db.Model):
 
     @classmethod
     def migrate_user(cls, olduser, newuser):
-        if not olduser or not newuser:
-            return  # Don't mess with client-only tokens
-        oldtokens = cls.query.filter_by(user=olduser).all()
-        newtokens = {}  # Client: token mapping
-        for token in cls.query.filter_by(user=newuser).all():
-            newtokens.setdefault(token.client_id, []).append(token)
-
-        for token in oldtokens:
-            merge_performed = False
-            if token.client_id in newtokens:
-                for newtoken in newtokens[token.client_id]:
-                    if newtoken.user == newuser:
-                        # There's another token for  newuser with the same client.
-                        # Just extend the scope there
-                        newtoken.scope = set(newtoken.scope) | set(token.scope)
-                        db.session.delete(token)
-                        merge_performed = True
-                        break
-            if merge_performed is False:
-                token.user = newuser  # Reassign this token to newuser
+        """
+        Add the scope of olduser's tokens to newuser's tokens for the same clients.
+        :func:`merge_users` then discards olduser's tokens for those clients.
+        """
+        oldtoken = db.aliased(cls)
+        for token, scope in db.session.query(cls, oldtoken._scope).join(oldtoken, db.and_(
+                oldtoken.client_id == cls.client_id, oldtoken.user_id == olduser.id)).filter(
+                cls.user_id == newuser.id):
+            token.add_scope(scope.split())
+        # The bulk statements that move or delete olduser's tokens skip the mapper
+        # events that would drop them from the cache
+        cls.uncache(*[token for (token,) in db.session.query(cls.token).filter_by(user_id=olduser.id)])
 
     @classmethod
     def get(cls, token):
@@ -314,6 +566,122 @@ class AuthToken(ScopeMixin, BaseMixin, db.Model):
         """
         return cls.query.filter_by(token=token).one_or_none()
 
+    def snapshot(self):
+        """
+        Return an :class:`AuthTokenSnapshot` of this token.
+        """
+        return AuthTokenSnapshot(token=self.token, scope=self.scope, user_id=self.user_id,
+            client_id=self.client_id, client_trusted=self.client.trusted, client_active=self.client.active,
+            expires_at=self.expires_at)
+
+    @classmethod
+    def get_cached(cls, token):
+        """
+        Return an :class:`AuthTokenSnapshot` for the matching token, from cache if available.
+        Use this instead of :meth:`get` where the token is only being verified.
+
+        :param str token: Token to lookup
+        """
+        snapshot = authtoken_cache.get(token)
+        if snapshot is None:
+            authtoken = cls.query.filter_by(token=token).options(db.joinedload(cls.client)).one_or_none()
+            if authtoken is None:
+                return None
+            snapshot = authtoken.snapshot()
+            authtoken_cache.set(token, snapshot)
+        return snapshot
+
+    @classmethod
+    def all_cached(cls, tokens):
+        """
+        Return a dictionary of token: :class:`AuthTokenSnapshot` for the given tokens.
+        Tokens not in cache are looked up in a single query. Unknown tokens are skipped.
+
+        :param list tokens: Tokens to lookup
+        """
+        snapshots = {}
+        missing = set()
+        for token in tokens:
+            snapshot = authtoken_cache.get(token)
+            if snapshot is None:
+                missing.add(token)
+            else:
+                snapshots[token] = snapshot
+        if missing:
+            for authtoken in cls.query.filter(cls.token.in_(missing)).options(db.joinedload(cls.client)).all():
+                snapshot = authtoken.snapshot()
+                authtoken_cache.set(authtoken.token, snapshot)
+                snapshots[authtoken.token] = snapshot
+        return snapshots
+
+    @classmethod
+    def uncache(cls, *tokens):
+        """
+        Remove the given tokens from the cache.
+        """
+        for token in tokens:
+            if token:
+                authtoken_cache.delete(token)
+
+
+class AuthTokenSnapshot(namedtuple('AuthTokenSnapshot',
+        ['token', 'scope', 'user_id', 'client_id', 'client_trusted', 'client_active', 'expires_at'])):
+    """
+    Immutable summary of an :class:`AuthToken`, suitable for caching. The user and client
+    are loaded from the database only when accessed.
+    """
+    __slots__ = ()
+
+    def is_valid(self):
+        return self.expires_at is None or self.expires_at > datetime.utcnow()
+
+    def expires_in(self):
+        """
+        Seconds until this token expires, or None if it doesn't.
+        """
+        if self.expires_at is not None:
+            return max(int((self.expires_at - datetime.utcnow()).total_seconds()), 0)
+
+    @property
+    def user(self):
+        if self.user_id is not None:
+            return User.query.get(self.user_id)
+
+    @property
+    def client(self):
+        return Client.query.get(self.client_id)
+
+
+#: Cache of :class:`AuthTokenSnapshot` instances, keyed by token. The namespace
+#: changes with the snapshot's fields, since older entries can't be unpickled
+authtoken_cache = TwoTierCache('authtoken.2', maxsize=10000)
+
+
+@event.listens_for(AuthToken, 'after_update')
+@event.listens_for(AuthToken, 'after_delete')
+def _authtoken_changed(mapper, connection, target):
+    # Scope, user or the token itself have changed (via add_scope, migrate_user or refresh).
+    # Drop both the old and the new token from the cache once the change is committed
+    delete_on_commit(db.object_session(target), authtoken_cache,
+        target.token, *(inspect(target).attrs.token.history.deleted or ()))
+
+
+@event.listens_for(Client, 'after_update')
+@event.listens_for(Client, 'after_delete')
+def _client_cache_changed(mapper, connection, target):
+    # The key, secret or flags have changed. Drop the old and new key once committed
+    delete_on_commit(db.object_session(target), client_cache,
+        target.key, *(inspect(target).attrs.key.history.deleted or ()))
+
+
+@event.listens_for(Client, 'after_update')
+def _client_changed(mapper, connection, target):
+    # Tokens are cascade-deleted with their client, so only flag changes need attention here
+    attrs = inspect(target).attrs
+    if attrs.active.history.has_changes() or attrs.trusted.history.has_changes():
+        delete_on_commit(db.object_session(target), authtoken_cache, *[row.token for row in connection.execute(
+            db.select([AuthToken.token]).where(AuthToken.client_id == target.id))])
+
 
 class Permission(BaseMixin, db.Model):
     __tablename__ = 'permission'
@@ -336,7 +704,8 @@ class Permission(BaseMixin, db.Model):
     allusers = db.Column(db.Boolean, default=False, nullable=False)
 
     def owner_is(self, user):
-        return user is not None and self.user == user or (self.org and self.org in user.organizations_owned())
+        return user is not None and (self.user == user or (self.org_id is not None and
+            self.org_id in user.organizations_owned_ids()))
 
     @property
     def owner_title(self):
@@ -406,20 +775,16 @@ class UserClientPermissions(BaseMixin, db.Model):
 
     @classmethod
     def migrate_user(cls, olduser, newuser):
-        for operm in olduser.client_permissions:
-            merge_performed = False
-            for nperm in newuser.client_permissions:
-                if nperm.client == operm.client:
-                    # Merge permission strings
-                    tokens = set(operm.access_permissions.split(' '))
-                    tokens.update(set(nperm.access_permissions.split(' ')))
-                    if u' ' in tokens:
-                        tokens.remove(u' ')
-                    nperm.access_permissions = u' '.join(sorted(tokens))
-                    db.session.delete(operm)
-                    merge_performed = True
-            if not merge_performed:
-                operm.user = newuser
+        """
+        Add olduser's permissions to newuser's permissions on the same clients.
+        :func:`merge_users` then discards olduser's permissions on those clients.
+        """
+        oldperm = db.aliased(cls)
+        for perm, permissions in db.session.query(cls, oldperm.access_permissions).join(oldperm, db.and_(
+                oldperm.client_id == cls.client_id, oldperm.user_id == olduser.id)).filter(
+                cls.user_id == newuser.id):
+            perm.access_permissions = u' '.join(sorted(set(perm.access_permissions.split()) |
+                set(permissions.split())))
 
 
 # This model's name is in plural because it defines multiple permissions within each instance
@@ -461,7 +826,7 @@ class ClientTeamAccess(BaseMixin, db.Model):
     __tablename__ = 'clientteamaccess'
     __bind_key__ = 'lastuser'
     #: Organization whose teams are exposed to the client app
-    org_id = db.Column(db.Integer, db.ForeignKey('organization.id'), nullable=True)
+    org_id = db.Column(db.Integer, db.ForeignKey('organization.id'), nullable=True, index=True)
     org = db.relationship(Organization, primaryjoin=org_id == Organization.id,
         backref=db.backref('client_team_access', cascade="all, delete-orphan"))
     #: Client app they are exposed to
@@ -486,3 +851,43 @@ class NoticeType(BaseMixin, db.Model):
     description = db.Column(db.UnicodeText, default=u'', nullable=False)
     #: Is this notice type available to all users and client apps?
     allusers = db.Column(db.Boolean, default=False, nullable=False)
+
+
+#: Client app holding a token for a user, as returned by :func:`notice_recipients`
+NoticeRecipient = namedtuple('NoticeRecipient', ['client_id', 'notification_uri', 'notification_batch',
+    'scope', 'userid'])
+
+
+def notice_recipients(user=None, org=None, team_access=False):
+    """
+    Return a :class:`NoticeRecipient` for every token held by a client app with a
+    notification URI, for the given user or for the owners of the given organization,
+    using a single query. Tokens are listed in the order they were created.
+
+    :param User user: User whose tokens to look for
+    :param Organization org: Organization whose owners' tokens to look for, if no user is given.
+        Only tokens with the ``organizations`` scope are included
+    :param bool team_access: Only include client apps with access to the organization's teams
+    """
+    query = db.session.query(AuthToken.client_id, Client.notification_uri, Client.notification_batch,
+        AuthToken._scope, User.userid).join(Client, AuthToken.client_id == Client.id).join(
+        User, AuthToken.user_id == User.id).filter(
+        Client.notification_uri != None, Client.notification_uri != u'')  # NOQA
+    if user is not None:
+        query = query.filter(AuthToken.user_id == user.id)
+    else:
+        query = query.filter(AuthToken.user_id.in_(
+            db.select([team_membership.c.user_id]).where(team_membership.c.team_id == org.owners_id)),
+            AuthToken._scope.like(u'%organizations%'))
+        if team_access:
+            query = query.filter(AuthToken.client_id.in_(
+                db.select([ClientTeamAccess.client_id]).where(db.and_(
+                    ClientTeamAccess.org_id == org.id,
+                    ClientTeamAccess.access_level == CLIENT_TEAM_ACCESS.ALL))))
+    recipients = []
+    for client_id, notification_uri, notification_batch, scope, userid in query.order_by(AuthToken.id).all():
+        scope = Scope(scope)
+        if user is None and u'organizations' not in scope:
+            continue
+        recipients.append(NoticeRecipient(client_id, notification_uri, notification_batch, scope, userid))
+    return recipients
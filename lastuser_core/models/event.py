@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+
+from . import db, BaseMixin
+
+__all__ = ['Event']
+
+
+class Event(BaseMixin, db.Model):
+    """
+    A signal recorded in the transaction that caused it, to be sent to receivers
+    after commit. Events are dispatched in order of id and marked as dispatched
+    once all receivers have run. An event that keeps failing is marked as failed,
+    and holds back later events for the same entity until its ``failed_at`` is
+    cleared to try it again.
+    """
+    __tablename__ = 'event'
+    __bind_key__ = 'lastuser'
+    #: Name of the signal
+    name = db.Column(db.Unicode(80), nullable=False)
+    #: Model and primary key of the signal's sender, to keep events for an entity in order
+    entity_type = db.Column(db.Unicode(80), nullable=False)
+    entity_id = db.Column(db.Integer, nullable=False)
+    #: JSON-encoded sender and keyword arguments
+    payload = db.Column(db.UnicodeText, nullable=False)
+    #: Number of times dispatching was attempted and failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    #: Last error raised by a receiver
+    error = db.Column(db.UnicodeText, nullable=True)
+    #: Time all receivers ran successfully
+    dispatched_at = db.Column(db.DateTime, nullable=True, index=True)
+    #: Time the event was given up on after repeated failures
+    failed_at = db.Column(db.DateTime, nullable=True)
+
+    @classmethod
+    def pending(cls, limit=100):
+        """
+        Return events that are yet to be dispatched and haven't failed, oldest first.
+
+        :param int limit: Maximum number of events to return
+        """
+        return cls.query.filter_by(dispatched_at=None, failed_at=None).order_by(cls.id).limit(limit).all()
+
+    @classmethod
+    def failed(cls, limit=100):
+        """
+        Return events that were given up on, oldest first.
+
+        :param int limit: Maximum number of events to return
+        """
+        return cls.query.filter(cls.failed_at != None).order_by(cls.id).limit(limit).all()
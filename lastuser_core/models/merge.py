@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+from collections import namedtuple
+from . import db
+from .user import User, UserOldId, USER_STATUS, memberships_changed
+
+__all__ = ['merge_users', 'merge_report', 'user_references']
+
+#: A column that refers to a user. ``keys`` lists the sets of other columns that
+#: must be unique per user. ``model`` is the model mapped to the table, if any.
+UserReference = namedtuple('UserReference', ['table', 'column', 'keys', 'model'])
+
+_user_references = None
+
+
+def user_references():
+    """
+    Return a :class:`UserReference` for every column that refers to ``user.id``.
+    This is built from table metadata once, on first use.
+    """
+    global _user_references
+    if _user_references is None:
+        models = dict((model.__table__, model) for model in db.Model._decl_class_registry.values()
+            if hasattr(model, '__table__'))
+        references = []
+        for table in db.Model.metadata.sorted_tables:
+            uniques = [constraint.columns for constraint in table.constraints
+                if isinstance(constraint, (db.UniqueConstraint, db.PrimaryKeyConstraint))]
+            uniques.extend(index.columns for index in table.indexes if index.unique)
+            if not table.primary_key.columns:
+                uniques.append(table.columns)  # Association tables don't repeat rows
+            for fk in table.foreign_keys:
+                if fk.column is not User.__table__.c.id:
+                    continue
+                column = fk.parent
+                keys = {}
+                for columns in uniques:
+                    if columns.contains_column(column):
+                        key = [c for c in columns if c is not column]
+                        keys[tuple(c.name for c in key)] = key
+                references.append(UserReference(table, column, keys.values(), models.get(table)))
+        _user_references = references
+    return _user_references
+
+
+def _merge_order(user1, user2):
+    """
+    Return (keep_user, merge_user). The older account is kept.
+    """
+    if user1.created_at < user2.created_at:
+        return user1, user2
+    else:
+        return user2, user1
+
+
+def _duplicates(ref, key, keep_user, merge_user):
+    """
+    Condition matching merge_user's rows that would collide with keep_user's rows on key.
+    """
+    other = ref.table.alias()
+    return db.and_(ref.column == merge_user.id, db.exists().where(db.and_(
+        other.c[ref.column.name] == keep_user.id, *[other.c[c.name] == c for c in key])))
+
+
+def merge_report(user1, user2):
+    """
+    Dry run of :func:`merge_users`. Returns (table, rows, duplicates) for each table
+    with rows to move from the newer account, where duplicates is the number of those
+    rows that the older account already has and are merged into its own rows.
+    """
+    keep_user, merge_user = _merge_order(user1, user2)
+    report = []
+    for ref in user_references():
+        rows = db.session.execute(db.select([db.func.count()]).select_from(ref.table).where(
+            ref.column == merge_user.id), mapper=User.__mapper__).scalar()
+        if rows:
+            duplicates = 0
+            if ref.keys:
+                duplicates = db.session.execute(db.select([db.func.count()]).select_from(ref.table).where(
+                    db.or_(*[_duplicates(ref, key, keep_user, merge_user) for key in ref.keys])),
+                    mapper=User.__mapper__).scalar()
+            report.append((ref.table.name, rows, duplicates))
+    return report
+
+
+def merge_users(user1, user2):
+    """
+    Merge two user accounts and return the new user account. Rows are moved with one
+    UPDATE per table. The caller commits.
+    """
+    # Always keep the older account and merge from the newer account
+    keep_user, merge_user = _merge_order(user1, user2)
+    references = user_references()
+
+    # 1. Models with a migrate_user classmethod fold merge_user's rows that duplicate
+    # keep_user's rows into keep_user's rows, such as the scope of tokens for the same client
+    for ref in references:
+        if ref.model is not None and hasattr(ref.model, 'migrate_user'):
+            ref.model.migrate_user(olduser=merge_user, newuser=keep_user)
+    db.session.flush()
+    # 2. Drop merge_user's duplicate rows and switch the rest to keep_user. Passing the
+    # User mapper runs these on the same database connection as the session
+    for ref in references:
+        for key in ref.keys:
+            db.session.execute(ref.table.delete().where(_duplicates(ref, key, keep_user, merge_user)),
+                mapper=User.__mapper__)
+        db.session.execute(ref.table.update().where(ref.column == merge_user.id).values(
+            {ref.column.name: keep_user.id}), mapper=User.__mapper__)
+    # These statements bypassed the session. Reload whatever it has loaded
+    db.session.expire_all()
+    memberships_changed(keep_user, merge_user)
+    # 3. Add merge_user's userid to olduserids
+    db.session.add(UserOldId(user=keep_user, userid=merge_user.userid))
+    # 4. Mark merge_user as merged
+    merge_user.status = USER_STATUS.MERGED
+    # 5. Release the username
+    merge_user.username = None
+    db.session.flush()
+
+    # 6. Return keep_user.
+    return keep_user
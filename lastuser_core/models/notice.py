@@ -2,17 +2,25 @@
 
 from . import db, BaseMixin
 
-__all__ = ['SMSMessage', 'SMS_STATUS']
+__all__ = ['SMSMessage', 'SMS_STATUS', 'EmailMessage', 'EMAIL_STATUS', 'NoticeFailure']
 
 
 # --- Flags -------------------------------------------------------------------
 
 class SMS_STATUS:
     QUEUED = 0
-    PENDING = 1
+    PENDING = 1  # Accepted by a gateway, waiting for a delivery report
     DELIVERED = 2
     FAILED = 3
     UNKNOWN = 4
+    SENDING = 5  # Claimed by a job that is handing it to a gateway
+
+
+class EMAIL_STATUS:
+    QUEUED = 0
+    SENDING = 1
+    SENT = 2
+    FAILED = 3
 
 
 # --- Channels ----------------------------------------------------------------
@@ -66,3 +74,56 @@ class SMSMessage(BaseMixin, db.Model):
     status = db.Column(db.Integer, default=0, nullable=False)
     status_at = db.Column(db.DateTime, nullable=True)
     fail_reason = db.Column(db.Unicode(25), nullable=True)
+    # Gateway that accepted the message
+    provider = db.Column(db.Unicode(20), nullable=True)
+
+
+class EmailMessage(BaseMixin, db.Model):
+    """
+    An email in the outbound queue, sent by a background job. Sent and failed
+    emails are deleted after a while, since they may contain secrets.
+    """
+    __tablename__ = 'emailmessage'
+    __bind_key__ = 'lastuser'
+    #: Address the email is sent to
+    recipient = db.Column(db.Unicode(254), nullable=False)
+    subject = db.Column(db.Unicode(250), nullable=False)
+    #: Plain text and HTML versions of the message
+    body = db.Column(db.UnicodeText, nullable=False)
+    html = db.Column(db.UnicodeText, nullable=True)
+    #: Delivery state, one of :class:`EMAIL_STATUS`. While SENDING, ``updated_at``
+    #: is the time the email was claimed for sending
+    status = db.Column(db.Integer, default=EMAIL_STATUS.QUEUED, nullable=False, index=True)
+    #: Number of delivery attempts made
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    #: Error from the last attempt
+    error = db.Column(db.UnicodeText, nullable=True)
+    #: Time before which a queued email that failed isn't tried again
+    retry_at = db.Column(db.DateTime, nullable=True)
+    #: Time the mail server accepted the email
+    sent_at = db.Column(db.DateTime, nullable=True)
+
+    # For deleting old emails
+    __table_args__ = (db.Index('ix_emailmessage_created_at', 'created_at'),)
+
+
+class NoticeFailure(BaseMixin, db.Model):
+    """
+    Notices to client apps that could not be delivered even after retrying.
+    """
+    __tablename__ = 'noticefailure'
+    __bind_key__ = 'lastuser'
+    #: Client app the notice was for
+    client_id = db.Column(db.Integer, db.ForeignKey('client.id'), nullable=True)
+    client = db.relationship('Client',
+        backref=db.backref('notice_failures', cascade="all, delete-orphan"))
+    #: URL the notice was sent to
+    url = db.Column(db.Unicode(250), nullable=False)
+    #: HTTP method
+    method = db.Column(db.Unicode(10), nullable=False, default=u'POST')
+    #: Notice contents, as JSON
+    payload = db.Column(db.UnicodeText, nullable=False)
+    #: Number of delivery attempts made
+    attempts = db.Column(db.Integer, nullable=False)
+    #: Error from the last attempt
+    error = db.Column(db.UnicodeText, nullable=False, default=u'')
@@ -1,18 +1,51 @@
 # -*- coding: utf-8 -*-
 
+from collections import namedtuple
 from hashlib import md5
-from werkzeug import check_password_hash, cached_property
-import bcrypt
-from sqlalchemy import or_
-from sqlalchemy.orm import defer
+from werkzeug import cached_property
+from sqlalchemy import or_, event
+from sqlalchemy.orm import defer, Session
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.util import identity_key
 from sqlalchemy.ext.hybrid import hybrid_property
 from coaster import newid, newsecret, newpin, valid_username
 
 from . import db, TimestampMixin, BaseMixin
+from ..cache import TwoTierCache
+from ..passwords import password_hasher
 
 
 __all__ = ['User', 'UserEmail', 'UserEmailClaim', 'PasswordResetRequest', 'UserExternalId',
-           'UserPhone', 'UserPhoneClaim', 'Team', 'Organization', 'UserOldId', 'USER_STATUS']
+           'UserPhone', 'UserPhoneClaim', 'Team', 'Organization', 'UserOldId', 'USER_STATUS',
+           'normalize_email', 'OrgMembership']
+
+
+def normalize_email(email):
+    """
+    Return the key that email addresses are looked up by. Addresses that differ
+    only in case are the same address.
+    """
+    return email.lower()
+
+
+class OrgMembership(namedtuple('OrgMembership', ['org_id', 'userid', 'name', 'title', 'is_owner'])):
+    """
+    An organization that a user is in, and whether the user is in its owners team.
+    """
+    __slots__ = ()
+
+
+#: Cache of each user's memberships, keyed by user id
+membership_cache = TwoTierCache('membership', maxsize=10000)
+
+
+def _lower_prefix_index(name, column):
+    """
+    Return an index on ``lower(column)``, for the ``LIKE 'prefix%'`` matches in
+    :meth:`User.autocomplete`. PostgreSQL only uses an index for prefix matches in
+    non-C locales if it is built with the pattern operator class.
+    """
+    return db.Index(name, db.func.lower(column).label(name), postgresql_ops={name: 'text_pattern_ops'})
 
 
 class USER_STATUS:
@@ -32,6 +65,9 @@ class User(BaseMixin, db.Model):
     description = db.Column(db.UnicodeText, default=u'', nullable=False)
     status = db.Column(db.SmallInteger, nullable=False, default=USER_STATUS.ACTIVE)
 
+    __table_args__ = (_lower_prefix_index('ix_user_fullname_lower', fullname),
+        _lower_prefix_index('ix_user_username_lower', _username))
+
     _defercols = [
         defer('created_at'),
         defer('updated_at'),
@@ -59,9 +95,7 @@ class User(BaseMixin, db.Model):
         if password is None:
             self.pw_hash = None
         else:
-            self.pw_hash = bcrypt.hashpw(
-                password.encode('utf-8') if isinstance(password, unicode) else password,
-                bcrypt.gensalt())
+            self.pw_hash = password_hasher.hash(password)
 
     #: Write-only property (passwords cannot be read back in plain text)
     password = property(fset=_set_password)
@@ -94,12 +128,12 @@ class User(BaseMixin, db.Model):
     def password_is(self, password):
         if self.pw_hash is None:
             return False
-        if self.pw_hash.startswith('sha1$'):
-            return check_password_hash(self.pw_hash, password)
-        else:
-            return bcrypt.hashpw(
-                password.encode('utf-8') if isinstance(password, unicode) else password,
-                self.pw_hash) == self.pw_hash
+        if not password_hasher.verify(password, self.pw_hash):
+            return False
+        if password_hasher.needs_rehash(self.pw_hash):
+            # Upgrade legacy and weaker hashes. Saved when the caller commits
+            self.password = password
+        return True
 
     def __repr__(self):
         return u'<User {username} "{fullname}">'.format(username=self.username or self.userid,
@@ -148,13 +182,15 @@ class User(BaseMixin, db.Model):
         """
         Returns primary email address for user.
         """
+        # Look in the emails collection, which may have been eagerly loaded
+        useremails = self.emails
         # Look for a primary address
-        useremail = UserEmail.query.filter_by(user_id=self.id, primary=True).first()
-        if useremail:
-            return useremail
+        for useremail in useremails:
+            if useremail.primary:
+                return useremail
         # No primary? Maybe there's one that's not set as primary?
-        useremail = UserEmail.query.filter_by(user_id=self.id).first()
-        if useremail:
+        if useremails:
+            useremail = useremails[0]
             # XXX: Mark at primary. This may or may not be saved depending on
             # whether the request ended in a database commit.
             useremail.primary = True
@@ -169,13 +205,15 @@ class User(BaseMixin, db.Model):
         """
         Returns primary phone number for user.
         """
+        # Look in the phones collection, which may have been eagerly loaded
+        userphones = self.phones
         # Look for a primary address
-        userphone = UserPhone.query.filter_by(user=self, primary=True).first()
-        if userphone:
-            return userphone
+        for userphone in userphones:
+            if userphone.primary:
+                return userphone
         # No primary? Maybe there's one that's not set as primary?
-        userphone = UserPhone.query.filter_by(user=self).first()
-        if userphone:
+        if userphones:
+            userphone = userphones[0]
             # XXX: Mark at primary. This may or may not be saved depending on
             # whether the request ended in a database commit.
             userphone.primary = True
@@ -185,25 +223,83 @@ class User(BaseMixin, db.Model):
         # to get the phone number as a string.
         return u''
 
+    #: Memo of :meth:`memberships`
+    _memberships = None
+
+    def memberships(self):
+        """
+        Return an :class:`OrgMembership` for each organization this user is in, sorted
+        by title. This is loaded with one query and cached until the user's teams or
+        their organizations change.
+        """
+        if self._memberships is None:
+            if self.id is None:
+                return ()
+            self.preload_memberships([self])
+        return self._memberships
+
+    @classmethod
+    def preload_memberships(cls, users):
+        """
+        Load :meth:`memberships` for all the given users, with a single query for
+        those not in cache.
+        """
+        missing = {}
+        for user in users:
+            if user._memberships is None and user.id is not None:
+                memberships = membership_cache.get(user.id)
+                if memberships is None:
+                    missing[user.id] = user
+                else:
+                    user._memberships = memberships
+        if missing:
+            owners = {}
+            orgs = {}
+            for user_id, org_id, userid, name, title, is_owner in db.session.query(team_membership.c.user_id,
+                    Organization.id, Organization.userid, Organization._name, Organization.title,
+                    Team.id == Organization.owners_id).select_from(team_membership).join(
+                    Team, Team.id == team_membership.c.team_id).join(
+                    Organization, Organization.id == Team.org_id).filter(
+                    team_membership.c.user_id.in_(list(missing))):
+                orgs[user_id, org_id] = (userid, name, title)
+                owners[user_id, org_id] = owners.get((user_id, org_id), False) or bool(is_owner)
+            found = {}
+            for (user_id, org_id), (userid, name, title) in orgs.items():
+                found.setdefault(user_id, []).append(
+                    OrgMembership(org_id, userid, name, title, owners[user_id, org_id]))
+            # Uncommitted changes must not reach other processes
+            cache = not db.session.info.get('memberships_changed')
+            for user_id, user in missing.items():
+                memberships = tuple(sorted(found.get(user_id, ()), key=lambda m: (m.title, m.org_id)))
+                if cache:
+                    membership_cache.set(user_id, memberships)
+                user._memberships = memberships
+
+    def _organizations(self, memberships):
+        if not memberships:
+            return []
+        orgs = dict((org.id, org) for org in Organization.query.filter(
+            Organization.id.in_([m.org_id for m in memberships])))
+        return [orgs[m.org_id] for m in memberships if m.org_id in orgs]
+
     def organizations(self):
         """
         Return the organizations this user is a member of.
         """
-        return sorted(set([team.org for team in self.teams]), key=lambda o: o.title)
+        return self._organizations(self.memberships())
 
     def organizations_owned(self):
         """
         Return the organizations this user is an owner of.
         """
-        return sorted(set([team.org for team in self.teams if team.org.owners == team]),
-            key=lambda o: o.title)
+        return self._organizations([m for m in self.memberships() if m.is_owner])
 
     def organizations_owned_ids(self):
         """
         Return the database ids of the organizations this user is an owner of. This is used
         for database queries.
         """
-        return list(set([team.org.id for team in self.teams if team.org.owners == team]))
+        return [m.org_id for m in self.memberships() if m.is_owner]
 
     def is_profile_complete(self):
         """
@@ -247,61 +343,124 @@ class User(BaseMixin, db.Model):
             return user
 
     @classmethod
-    def all(cls, userids=None, usernames=None, defercols=False):
+    def all(cls, userids=None, usernames=None, defercols=False, mapping=False):
         """
-        Return all matching users.
+        Return all matching users. Userids of merged accounts are resolved to the account
+        they were merged into. Old userids of the users are loaded with one query.
 
         :param list userids: Userids to look up
         :param list usernames: Usernames to look up
         :param bool defercols: Defer loading non-critical columns
+        :param bool mapping: Return a dictionary of each userid or username found to its user,
+            instead of a list
         """
-        users = set()
+        found = {}
         if userids:
-            query = cls.query.filter(cls.userid.in_(userids))
+            userids = set(userids)
+            query = db.session.query(cls, UserOldId.userid).outerjoin(UserOldId, UserOldId.user_id == cls.id).filter(
+                cls.status == USER_STATUS.ACTIVE, or_(cls.userid.in_(userids), UserOldId.userid.in_(userids)))
+            if defercols:
+                query = query.options(*cls._defercols)
+            for user, olduserid in query.all():
+                if user.userid in userids:
+                    found[user.userid] = user
+                if olduserid in userids:
+                    found[olduserid] = user
+        if usernames:
+            query = cls.query.filter(cls.username.in_(usernames), cls.status == USER_STATUS.ACTIVE)
             if defercols:
                 query = query.options(*cls._defercols)
             for user in query.all():
-                user = user.merged_user()
-                if user.is_active:
-                    users.add(user)
-        return list(users)
+                found[user.username] = user
+        users = list(set(found.values()))
+        cls.preload_oldids(users)
+        if mapping:
+            return found
+        return users
+
+    @classmethod
+    def preload_oldids(cls, users):
+        """
+        Load the ``oldids`` of all the given users with a single query.
+        """
+        users = [user for user in users if 'oldids' in db.inspect(user).unloaded]
+        if users:
+            oldids = {}
+            for oldid in UserOldId.query.filter(UserOldId.user_id.in_([user.id for user in users])).all():
+                oldids.setdefault(oldid.user_id, []).append(oldid)
+            for user in users:
+                set_committed_value(user, 'oldids', oldids.get(user.id, []))
+
+    @classmethod
+    def preload_collections(cls, users, *names):
+        """
+        Load the named collections of all the given users with a single query each.
+        Supports ``emails``, ``phones`` and ``teams``. Teams come with their
+        organizations.
+        """
+        queries = {
+            'emails': lambda ids: db.session.query(UserEmail.user_id, UserEmail).filter(
+                UserEmail.user_id.in_(ids)).order_by(UserEmail.id),
+            'phones': lambda ids: db.session.query(UserPhone.user_id, UserPhone).filter(
+                UserPhone.user_id.in_(ids)).order_by(UserPhone.id),
+            'teams': lambda ids: db.session.query(team_membership.c.user_id, Team).select_from(
+                team_membership).join(Team, Team.id == team_membership.c.team_id).filter(
+                team_membership.c.user_id.in_(ids)).options(db.joinedload(Team.org)).order_by(Team.id),
+            }
+        for name in names:
+            pending = [user for user in users if name in db.inspect(user).unloaded]
+            if pending:
+                items = {}
+                for user_id, item in queries[name]([user.id for user in pending]):
+                    items.setdefault(user_id, []).append(item)
+                for user in pending:
+                    set_committed_value(user, name, items.get(user.id, []))
 
     @classmethod
     def autocomplete(cls, query):
         """
         Return users whose names begin with the query, for autocomplete widgets.
         Looks up users by fullname, username, external ids and email addresses.
+        Exact matches on userid or username are listed first.
 
         :param str query: Letters to start matching with
         """
+        query = query.strip()
+        if not query:
+            return []
         # Escape the '%' and '_' wildcards in SQL LIKE clauses.
         # Some SQL dialects respond to '[' and ']', so remove them.
-        query = query.replace(u'%', ur'\%').replace(u'_', ur'\_').replace(u'[', u'').replace(u']', u'') + u'%'
+        # Patterns are lowercased here rather than in SQL so that PostgreSQL can
+        # match them against the lower() prefix indexes on these columns.
+        like_query = query.replace(u'%', ur'\%').replace(u'_', ur'\_').replace(u'[', u'').replace(u']', u'').lower() + u'%'
         # Use User._username since 'username' is a hybrid property that checks for validity
         # before passing on to _username, the actual column name on the model.
         # We convert to lowercase and use the LIKE operator since ILIKE isn't standard.
-        if not query:
-            return []
         users = cls.query.filter(cls.status == USER_STATUS.ACTIVE,
             or_(  # Match against userid (exact value only), fullname or username, case insensitive
-                cls.userid == query[:-1],
-                db.func.lower(cls.fullname).like(db.func.lower(query)),
-                db.func.lower(cls._username).like(db.func.lower(query))
+                cls.userid == query,
+                db.func.lower(cls.fullname).like(like_query),
+                db.func.lower(cls._username).like(like_query)
                 )
+            ).order_by(  # Exact userid and username matches come first
+                db.case([(or_(cls.userid == query, db.func.lower(cls._username) == query.lower()), 0)], else_=1),
+                cls.fullname
             ).options(*cls._defercols).limit(100).all()  # Limit to 100 results
-        if query.startswith('@'):
+        if like_query.startswith('@'):
             # Add Twitter/GitHub accounts to the head of results
             # TODO: Move this query to a login provider class method
-            users = cls.query.filter(cls.status == USER_STATUS.ACTIVE, cls.id.in_(
+            extusers = cls.query.filter(cls.status == USER_STATUS.ACTIVE, cls.id.in_(
                 db.session.query(UserExternalId.user_id).filter(
                     UserExternalId.service.in_([u'twitter', u'github']),
-                    db.func.lower(UserExternalId.username).like(db.func.lower(query[1:]))
-                ).subquery())).options(*cls._defercols).limit(100).all() + users
-        elif '@' in query:
-            users = cls.query.filter(cls.status == USER_STATUS.ACTIVE, cls.id.in_(
+                    db.func.lower(UserExternalId.username).like(like_query[1:])
+                ).subquery())).order_by(cls.fullname).options(*cls._defercols).limit(100).all()
+            users = extusers + [user for user in users if user not in extusers]
+        elif '@' in like_query:
+            emailusers = cls.query.filter(cls.status == USER_STATUS.ACTIVE, cls.id.in_(
                 db.session.query(UserEmail.user_id).filter(
-                    db.func.lower(UserEmail.email).like(db.func.lower(query))
-                ).subquery())).options(*cls._defercols).limit(100).all() + users
+                    UserEmail.email_normalized.like(like_query)
+                ).subquery())).order_by(cls.fullname).options(*cls._defercols).limit(100).all()
+            users = emailusers + [user for user in users if user not in emailusers]
         return users
 
 
@@ -329,12 +488,18 @@ class UserEmail(BaseMixin, db.Model):
     user = db.relationship(User, primaryjoin=user_id == User.id,
         backref=db.backref('emails', cascade="all, delete-orphan"))
     _email = db.Column('email', db.Unicode(254), unique=True, nullable=False)
+    #: Lookup key for the email address
+    email_normalized = db.Column(db.Unicode(254), nullable=False)
     md5sum = db.Column(db.String(32), unique=True, nullable=False)
     primary = db.Column(db.Boolean, nullable=False, default=False)
 
+    __table_args__ = (db.Index('ix_useremail_user_id_primary', 'user_id', 'primary'),
+        db.Index('ix_useremail_email_normalized', 'email_normalized', unique=True))
+
     def __init__(self, email, **kwargs):
         super(UserEmail, self).__init__(**kwargs)
         self._email = email
+        self.email_normalized = normalize_email(email)
         self.md5sum = md5(self._email).hexdigest()
 
     @hybrid_property
@@ -366,7 +531,7 @@ class UserEmail(BaseMixin, db.Model):
             raise TypeError("Either email or md5sum should be specified")
 
         if email:
-            return cls.query.filter(cls.email.in_([email, email.lower()])).one_or_none()
+            return cls.query.filter_by(email_normalized=normalize_email(email)).one_or_none()
         else:
             return cls.query.filter_by(md5sum=md5sum).one_or_none()
 
@@ -378,8 +543,10 @@ class UserEmailClaim(BaseMixin, db.Model):
     user = db.relationship(User, primaryjoin=user_id == User.id,
         backref=db.backref('emailclaims', cascade="all, delete-orphan"))
     _email = db.Column('email', db.Unicode(254), nullable=True)
+    #: Lookup key for the email address
+    email_normalized = db.Column(db.Unicode(254), nullable=True, index=True)
     verification_code = db.Column(db.String(44), nullable=False, default=newsecret)
-    md5sum = db.Column(db.String(32), nullable=False)
+    md5sum = db.Column(db.String(32), nullable=False, index=True)
 
     __table_args__ = (db.UniqueConstraint('user_id', 'email'),)
 
@@ -387,6 +554,7 @@ class UserEmailClaim(BaseMixin, db.Model):
         super(UserEmailClaim, self).__init__(**kwargs)
         self.verification_code = newsecret()
         self._email = email
+        self.email_normalized = normalize_email(email)
         self.md5sum = md5(self._email).hexdigest()
 
     @hybrid_property
@@ -420,7 +588,7 @@ class UserEmailClaim(BaseMixin, db.Model):
         :param str email: Email address to lookup
         :param User user: User who claimed this email address
         """
-        return cls.query.filter(UserEmailClaim.email.in_([email, email.lower()])).filter_by(user=user).one_or_none()
+        return cls.query.filter_by(email_normalized=normalize_email(email), user=user).first()
 
     @classmethod
     def all(cls, email):
@@ -429,7 +597,7 @@ class UserEmailClaim(BaseMixin, db.Model):
 
         :param str email: Email address to lookup
         """
-        return cls.query.filter(UserEmailClaim.email.in_([email, email.lower()])).order_by(cls.user_id).all()
+        return cls.query.filter_by(email_normalized=normalize_email(email)).order_by(cls.user_id).all()
 
 
 class UserPhone(BaseMixin, db.Model):
@@ -442,6 +610,8 @@ class UserPhone(BaseMixin, db.Model):
     _phone = db.Column('phone', db.Unicode(80), unique=True, nullable=False)
     gets_text = db.Column(db.Boolean, nullable=False, default=True)
 
+    __table_args__ = (db.Index('ix_userphone_user_id_primary', 'user_id', 'primary'),)
+
     def __init__(self, phone, **kwargs):
         super(UserPhone, self).__init__(**kwargs)
         self._phone = phone
@@ -537,6 +707,9 @@ class PasswordResetRequest(BaseMixin, db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     user = db.relationship(User, primaryjoin=user_id == User.id)
     reset_code = db.Column(db.String(44), nullable=False, default=newsecret)
+    # For deleting expired requests, and for finding a request from a reset link
+    __table_args__ = (db.Index('ix_passwordresetrequest_created_at', 'created_at'),
+        db.Index('ix_passwordresetrequest_user_id_reset_code', 'user_id', 'reset_code'))
 
     def __init__(self, **kwargs):
         super(PasswordResetRequest, self).__init__(**kwargs)
@@ -556,7 +729,9 @@ class UserExternalId(BaseMixin, db.Model):
     oauth_token_secret = db.Column(db.String(250), nullable=True)
     oauth_token_type = db.Column(db.String(250), nullable=True)
 
-    __table_args__ = (db.UniqueConstraint("service", "userid"), {})
+    __table_args__ = (db.UniqueConstraint("service", "userid"),
+        db.Index('ix_userexternalid_service_username', 'service', 'username'),
+        _lower_prefix_index('ix_userexternalid_username_lower', username), {})
 
     def __repr__(self):
         return u'<UserExternalId {service}:{username} of {user}'.format(
@@ -591,6 +766,8 @@ team_membership = db.Table(
     'team_membership', db.Model.metadata,
     db.Column('user_id', db.Integer, db.ForeignKey('user.id'), nullable=False),
     db.Column('team_id', db.Integer, db.ForeignKey('team.id'), nullable=False),
+    db.Index('ix_team_membership_user_id', 'user_id'),
+    db.Index('ix_team_membership_team_id', 'team_id'),
     info={'bind_key': 'lastuser'}
     )
 
@@ -659,9 +836,27 @@ class Organization(BaseMixin, db.Model):
         from lastuser_core.models.client import CLIENT_TEAM_ACCESS
         return [cta.client for cta in self.client_team_access if cta.access_level == CLIENT_TEAM_ACCESS.ALL]
 
+    def owner_is(self, user):
+        """
+        Is this user in the owners team? This is an indexed EXISTS query on team
+        membership, so it doesn't load the team's members.
+        """
+        if user is None:
+            return False
+        if self.owners_id is None or user.id is None:
+            # Not saved yet. The team is new and small
+            return self.owners is not None and user in self.owners.users
+        owners = db.session.identity_map.get(identity_key(Team, self.owners_id))
+        if owners is not None and 'users' in owners.__dict__:
+            # Members are loaded already, maybe with changes that aren't flushed yet
+            return user in owners.users
+        return db.session.query(db.exists().where(db.and_(
+            team_membership.c.team_id == self.owners_id,
+            team_membership.c.user_id == user.id))).scalar()
+
     def permissions(self, user, inherited=None):
         perms = super(Organization, self).permissions(user, inherited)
-        if user and user in self.owners.users:
+        if user and self.owner_is(user):
             perms.add('view')
             perms.add('edit')
             perms.add('delete')
@@ -707,7 +902,16 @@ class Organization(BaseMixin, db.Model):
         return query.one_or_none()
 
     @classmethod
-    def all(cls, userids=None, names=None, defercols=False):
+    def all(cls, userids=None, names=None, defercols=False, mapping=False):
+        """
+        Return all matching organizations.
+
+        :param list userids: Userids to look up
+        :param list names: Names to look up
+        :param bool defercols: Defer loading non-critical columns
+        :param bool mapping: Return a dictionary of each userid or name found to its organization,
+            instead of a list
+        """
         orgs = []
         if userids:
             query = cls.query.filter(cls.userid.in_(userids))
@@ -719,6 +923,14 @@ class Organization(BaseMixin, db.Model):
             if defercols:
                 query = query.options(*cls._defercols)
             orgs.extend(query.all())
+        if mapping:
+            found = {}
+            for org in orgs:
+                if userids and org.userid in userids:
+                    found[org.userid] = org
+                if names and org.name in names:
+                    found[org.name] = org
+            return found
         return orgs
 
 
@@ -746,18 +958,11 @@ class Team(BaseMixin, db.Model):
 
     def permissions(self, user, inherited=None):
         perms = super(Team, self).permissions(user, inherited)
-        if user and user in self.org.owners.users:
+        if user and self.org.owner_is(user):
             perms.add('edit')
             perms.add('delete')
         return perms
 
-    @classmethod
-    def migrate_user(cls, olduser, newuser):
-        for team in olduser.teams:
-            if team not in newuser.teams:
-                newuser.teams.append(team)
-        olduser.teams = []
-
     @classmethod
     def get(cls, userid=None):
         """
@@ -766,3 +971,74 @@ class Team(BaseMixin, db.Model):
         :param str userid: Userid of the organization
         """
         return cls.query.filter_by(userid=userid).one_or_none()
+
+
+def memberships_changed(*users):
+    """
+    Drop the membership index of these users from their instances now, and from the
+    cache once the session commits.
+
+    :param users: :class:`User` instances or user ids
+    """
+    session = db.session()
+    changed = session.info.setdefault('memberships_changed', set())
+    for user in users:
+        if isinstance(user, User):
+            user._memberships = None
+            identity = db.inspect(user).identity
+            changed.add(identity[0] if identity else None)  # None: pending user, not cached yet
+        else:
+            changed.add(user)
+            instance = session.identity_map.get(identity_key(User, user))
+            if instance is not None:
+                instance._memberships = None
+
+
+@event.listens_for(Team.users, 'append')
+@event.listens_for(Team.users, 'remove')
+def _team_users_changed(team, user, initiator):
+    memberships_changed(user)
+
+
+@event.listens_for(Session, 'before_flush')
+def _teams_flushing(session, flush_context, instances):
+    # Members of teams that are deleted or moved, and of organizations that change
+    team_ids = set()
+    org_ids = set()
+    for obj in session.deleted:
+        if isinstance(obj, Team):
+            team_ids.add(obj.id)
+    for obj in session.dirty:
+        attrs = db.inspect(obj).attrs
+        if isinstance(obj, Team) and attrs.org_id.history.has_changes():
+            team_ids.add(obj.id)
+        elif isinstance(obj, Organization) and (attrs._name.history.has_changes() or
+                attrs.title.history.has_changes() or attrs.owners_id.history.has_changes()):
+            org_ids.add(obj.id)
+    team_ids.discard(None)
+    org_ids.discard(None)
+    conditions = []
+    if team_ids:
+        conditions.append(Team.id.in_(team_ids))
+    if org_ids:
+        conditions.append(Team.org_id.in_(org_ids))
+    if conditions:
+        with session.no_autoflush:
+            memberships_changed(*[user_id for (user_id,) in session.query(team_membership.c.user_id).join(
+                Team, Team.id == team_membership.c.team_id).filter(db.or_(*conditions)).distinct()])
+
+
+@event.listens_for(Session, 'after_commit')
+def _memberships_committed(session):
+    for user_id in session.info.pop('memberships_changed', ()):
+        if user_id is not None:
+            membership_cache.delete(user_id)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _memberships_discarded(session):
+    # Memos loaded since the change may hold rolled back data
+    for user_id in session.info.pop('memberships_changed', ()):
+        instance = session.identity_map.get(identity_key(User, user_id))
+        if instance is not None:
+            instance._memberships = None
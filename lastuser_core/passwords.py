@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+
+"""
+Password hashing with a cap on the number of concurrent bcrypt operations
+"""
+
+from contextlib import contextmanager
+from threading import Condition
+from time import time
+import bcrypt
+from flask import current_app, has_app_context
+from werkzeug.security import check_password_hash, safe_str_cmp
+from werkzeug.exceptions import ServiceUnavailable
+
+__all__ = ['PasswordHasher', 'PasswordHasherBusy', 'password_hasher', 'init_passwords']
+
+
+class PasswordHasherBusy(ServiceUnavailable):
+    """
+    Raised when no hashing slot frees up in time. Flask responds with a 503.
+    """
+    description = "We're handling too many logins right now. Please try again in a moment."
+
+
+class PasswordHasher(object):
+    """
+    Hashes and verifies passwords with bcrypt, computing at most ``concurrency``
+    hashes at a time. bcrypt releases the GIL while it works, so hashes run in
+    parallel in the calling threads while waiting threads stay idle. A caller
+    that can't get a slot within ``timeout`` seconds gets
+    :class:`PasswordHasherBusy` instead of joining an ever growing queue.
+    :meth:`stats` are written to the app's log every ``log_interval`` seconds
+    while hashes are being requested.
+
+    :param int rounds: bcrypt work factor (log2 of the number of rounds) for new hashes
+    :param int concurrency: Maximum number of hashes computed at once
+    :param float timeout: Seconds to wait for a free slot
+    :param int log_interval: Seconds between log entries, or 0 to not log
+    """
+    def __init__(self, rounds=12, concurrency=4, timeout=1.0, log_interval=300):
+        self.rounds = rounds
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.log_interval = log_interval
+        self._logged_at = time()
+        self._logged_rejected = 0
+        self._cond = Condition()
+        self.waiting = 0
+        self.active = 0
+        self.count = 0
+        self.rejected = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self._dummy = None  # (rounds, hash)
+
+    @contextmanager
+    def _slot(self):
+        self._log_stats()
+        deadline = time() + self.timeout
+        with self._cond:
+            self.waiting += 1
+            try:
+                while self.active >= self.concurrency:
+                    remaining = deadline - time()
+                    if remaining <= 0:
+                        self.rejected += 1
+                        raise PasswordHasherBusy()
+                    self._cond.wait(remaining)
+                self.active += 1
+            finally:
+                self.waiting -= 1
+        started = time()
+        try:
+            yield
+        finally:
+            elapsed = time() - started
+            with self._cond:
+                self.active -= 1
+                self.count += 1
+                self.total_time += elapsed
+                self.max_time = max(self.max_time, elapsed)
+                self._cond.notify()
+
+    def hash(self, password):
+        """
+        Return a bcrypt hash of the password using the configured work factor.
+        """
+        with self._slot():
+            return bcrypt.hashpw(_encode(password), bcrypt.gensalt(self.rounds))
+
+    def verify(self, password, pw_hash):
+        """
+        Check a password against a bcrypt or legacy ``sha1$`` hash.
+        """
+        if pw_hash.startswith('sha1$'):
+            return check_password_hash(pw_hash, password)
+        with self._slot():
+            return safe_str_cmp(bcrypt.hashpw(_encode(password), pw_hash), pw_hash)
+
+    def verify_dummy(self, password):
+        """
+        Spend as long as :meth:`verify` would on a real hash and return ``False``,
+        so that a missing user can't be told apart by response time.
+        """
+        if self._dummy is None or self._dummy[0] != self.rounds:
+            self._dummy = (self.rounds, self.hash(u''))
+        self.verify(password, self._dummy[1])
+        return False
+
+    def needs_rehash(self, pw_hash):
+        """
+        Is this hash weaker than the current policy?
+        """
+        if pw_hash.startswith('sha1$'):
+            return True
+        try:
+            return int(pw_hash.split('$')[2]) < self.rounds
+        except (IndexError, ValueError):
+            return True
+
+    def stats(self):
+        """
+        Return counters for monitoring: threads waiting for a slot, hashes in
+        progress, hashes completed, requests rejected, and mean and max hash time
+        in seconds.
+        """
+        with self._cond:
+            return {
+                'waiting': self.waiting,
+                'active': self.active,
+                'count': self.count,
+                'rejected': self.rejected,
+                'mean_time': self.total_time / self.count if self.count else 0.0,
+                'max_time': self.max_time,
+                }
+
+
+    def _log_stats(self):
+        """
+        Log :meth:`stats` if ``log_interval`` has passed since the last entry. The
+        entry is a warning if requests were rejected in the meantime.
+        """
+        with self._cond:
+            if not self.log_interval or time() < self._logged_at + self.log_interval:
+                return
+            self._logged_at = time()
+            rejected, self._logged_rejected = self.rejected - self._logged_rejected, self.rejected
+        if has_app_context():
+            log = current_app.logger.warning if rejected else current_app.logger.info
+            log(u"Password hashing: %(waiting)d waiting, %(active)d active, %(count)d done, "
+                u"%(rejected)d rejected (%(recent)d recently), mean %(mean_time).3fs, max %(max_time).3fs",
+                dict(self.stats(), recent=rejected))
+
+
+def _encode(password):
+    return password.encode('utf-8') if isinstance(password, unicode) else password
+
+
+#: Password hasher for the app, configured by :func:`init_passwords`
+password_hasher = PasswordHasher()
+
+
+def init_passwords(app):
+    """
+    Configure the password hasher using the app's ``PASSWORD_HASH_ROUNDS``,
+    ``PASSWORD_HASH_CONCURRENCY``, ``PASSWORD_HASH_TIMEOUT`` and
+    ``PASSWORD_HASH_LOG_INTERVAL`` settings.
+    """
+    password_hasher.rounds = app.config.get('PASSWORD_HASH_ROUNDS', 12)
+    password_hasher.concurrency = app.config.get('PASSWORD_HASH_CONCURRENCY', 4)
+    password_hasher.timeout = app.config.get('PASSWORD_HASH_TIMEOUT', 1.0)
+    password_hasher.log_interval = app.config.get('PASSWORD_HASH_LOG_INTERVAL', 300)
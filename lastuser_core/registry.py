@@ -52,12 +52,17 @@ class ResourceRegistry(OrderedDict):
                     if not token:
                         # No token provided in Authorization header or in request parameters
                         return resource_auth_error(u"An access token is required to access this resource.")
-                authtoken = AuthToken.get(token=token)
+                # This is a cached snapshot. The token's user and client are loaded only if used
+                authtoken = AuthToken.get_cached(token=token)
                 if not authtoken:
                     return resource_auth_error(u"Unknown access token.")
+                if not authtoken.is_valid():
+                    return resource_auth_error(u"This access token has expired.")
+                if not authtoken.client_active:
+                    return resource_auth_error(u"This token's client application is not active.")
                 if name not in authtoken.scope:
                     return resource_auth_error(u"Token does not provide access to this resource.")
-                if trusted and not authtoken.client.trusted:
+                if trusted and not authtoken.client_trusted:
                     return resource_auth_error(u"This resource can only be accessed by trusted clients")
                 # All good. Return the result value
                 try:
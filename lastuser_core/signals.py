@@ -1,12 +1,54 @@
 # -*- coding: utf-8 -*-
 
+from contextlib import contextmanager
+from datetime import datetime
+import json
+from flask import current_app
 from flask.signals import Namespace
+from blinker import NamedSignal
 from sqlalchemy import event as sqla_event
-from .models import User, Organization, Team
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.interfaces import MANYTOONE
+from sqlalchemy.orm.attributes import set_committed_value
+from flask.ext.rq import job
+from .jobs import with_app_context, enqueue_in
+from .models import db, User, Organization, Team, Event
 
 
 lastuser_signals = Namespace()
 
+
+class OutboxSignal(NamedSignal):
+    """
+    A signal that is recorded as an :class:`~lastuser_core.models.Event` in the
+    database session when sent, and delivered to receivers by
+    :func:`dispatch_events` after the session is committed. Discarding the session
+    discards the signal. The sender must be a model instance. Keyword arguments
+    may be model instances and JSON-serializable values.
+    """
+    def send(self, sender, **kwargs):
+        db.session.add(Event(name=unicode(self.name), entity_type=unicode(type(sender).__name__),
+            entity_id=sender.id,
+            payload=unicode(json.dumps({'sender': _dump(sender, sender=True), 'kwargs': _dump(kwargs)}))))
+        db.session.info['events_recorded'] = True
+        return []
+
+    def deliver(self, sender, **kwargs):
+        """
+        Call receivers now. Used by :func:`dispatch_events`.
+        """
+        return super(OutboxSignal, self).send(sender, **kwargs)
+
+
+#: Signals whose receivers run after commit, by name
+outbox_signals = {}
+
+
+def outbox_signal(name):
+    signal = outbox_signals[name] = OutboxSignal(name)
+    return signal
+
+
 model_user_new = lastuser_signals.signal('model-user-new')
 model_user_edited = lastuser_signals.signal('model-user-edited')
 model_user_deleted = lastuser_signals.signal('model-user-deleted')
@@ -25,9 +67,9 @@ resource_access_granted = lastuser_signals.signal('resource-access-granted')
 user_login = lastuser_signals.signal('user-login')
 user_logout = lastuser_signals.signal('user-logout')
 user_registered = lastuser_signals.signal('user-registered')
-user_data_changed = lastuser_signals.signal('user-data-changed')
-org_data_changed = lastuser_signals.signal('org-data-changed')
-team_data_changed = lastuser_signals.signal('team-data-changed')
+user_data_changed = outbox_signal('user-data-changed')
+org_data_changed = outbox_signal('org-data-changed')
+team_data_changed = outbox_signal('team-data-changed')
 
 
 @sqla_event.listens_for(User, 'after_insert')
@@ -73,3 +115,189 @@ def _team_edited(mapper, connection, target):
 @sqla_event.listens_for(Team, 'after_delete')
 def _team_deleted(mapper, connection, target):
     model_team_deleted.send(target)
+
+
+# --- Event outbox ------------------------------------------------------------
+
+#: Failed attempts after which an event is set aside as failed and reported.
+#: Later events for the same entity wait until it is resolved
+EVENT_ATTEMPTS = 5
+#: Seconds to wait before dispatching events that failed again
+EVENT_RETRY_DELAY = 60
+
+#: Context managers (called without arguments) that :func:`dispatch_events` runs
+#: receivers within. Receivers can use these to hold their work until the end of
+#: the run, the way work is held until the end of a request
+event_dispatch_contexts = []
+
+
+#: Columns recorded with the sender besides keys, in case the row is gone by the
+#: time the event is dispatched
+EVENT_STATE_COLUMNS = ('userid', 'name', 'title')
+
+
+def _dump(value, sender=False):
+    if isinstance(value, db.Model):
+        ref = {'__model__': type(value).__name__, 'id': value.id}
+        if sender:
+            ref['state'] = dict((prop.key, getattr(value, prop.key))
+                for prop in db.inspect(value).mapper.column_attrs
+                if prop.key in EVENT_STATE_COLUMNS or prop.columns[0].primary_key or prop.columns[0].foreign_keys)
+        return ref
+    elif isinstance(value, (list, tuple)):
+        return [_dump(v) for v in value]
+    elif isinstance(value, dict):
+        return dict((k, _dump(v)) for k, v in value.items())
+    return value
+
+
+def _load(value):
+    if isinstance(value, dict) and '__model__' in value:
+        cls = db.Model._decl_class_registry[value['__model__']]
+        return cls.query.get(value['id']) or _restore(cls, value.get('state', {'id': value['id']}))
+    elif isinstance(value, list):
+        return [_load(v) for v in value]
+    elif isinstance(value, dict):
+        return dict((k, _load(v)) for k, v in value.items())
+    return value
+
+
+def _restore(cls, state):
+    """
+    Rebuild a deleted instance from its recorded column values, as a transient
+    object with its many-to-one relationships loaded.
+    """
+    mapper = db.inspect(cls)
+    obj = mapper.class_manager.new_instance()
+    for key, value in state.items():
+        set_committed_value(obj, key, value)
+    for rel in mapper.relationships:
+        if rel.direction is MANYTOONE and len(rel.local_columns) == 1:
+            fkey = state.get(mapper.get_property_by_column(list(rel.local_columns)[0]).key)
+            if fkey is not None:
+                set_committed_value(obj, rel.key, rel.mapper.class_.query.get(fkey))
+    return obj
+
+
+def deliver_event(event):
+    """
+    Call the receivers of a recorded event.
+    """
+    payload = json.loads(event.payload)
+    return outbox_signals[event.name].deliver(_load(payload['sender']), **_load(payload['kwargs']))
+
+
+@contextmanager
+def _dispatch_context(contexts):
+    if not contexts:
+        yield
+    else:
+        with contexts[0]():
+            with _dispatch_context(contexts[1:]):
+                yield
+
+
+def _claim_event(event_id):
+    """
+    Lock a pending event for delivery. Returns None if it was dispatched already,
+    has failed, or is locked by another dispatcher, which will deliver it.
+    """
+    return Event.query.filter(Event.id == event_id, Event.dispatched_at == None,
+        Event.failed_at == None).with_for_update(skip_locked=True).first()
+
+
+def _dispatch_pending(limit, failed):
+    """
+    Deliver the pending events that aren't claimed by another dispatcher, in
+    order. Returns the number of events delivered.
+    """
+    delivered = 0
+    last_id = 0
+    while True:
+        batch = db.session.query(Event.id, Event.entity_type, Event.entity_id).filter(
+            Event.dispatched_at == None, Event.id > last_id).order_by(Event.id).limit(limit).all()
+        if not batch:
+            break
+        last_id = batch[-1][0]
+        # An entity's events are delivered in order, so only its earliest undispatched
+        # event can go now. Failed events stay the earliest until they are resolved
+        earliest = dict(((entity_type, entity_id), event_id) for entity_type, entity_id, event_id in
+            db.session.query(Event.entity_type, Event.entity_id, db.func.min(Event.id)).filter(
+                Event.dispatched_at == None,
+                Event.entity_type.in_(set(entity_type for event_id, entity_type, entity_id in batch)),
+                Event.entity_id.in_(set(entity_id for event_id, entity_type, entity_id in batch))).group_by(
+                Event.entity_type, Event.entity_id))
+        following = {}
+        previous = {}
+        for event_id, entity_type, entity_id in batch:
+            entity = (entity_type, entity_id)
+            if entity in previous:
+                following[previous[entity]] = event_id
+            previous[entity] = event_id
+
+        for event_id, entity_type, entity_id in batch:
+            entity = (entity_type, entity_id)
+            if entity in failed or earliest.get(entity) != event_id:
+                # An earlier event for this entity failed, or is with another dispatcher
+                continue
+            event = _claim_event(event_id)
+            if event is None:
+                continue
+            try:
+                deliver_event(event)
+            except Exception as e:
+                db.session.rollback()
+                event = _claim_event(event_id)
+                if event is None:
+                    continue
+                event.attempts += 1
+                event.error = repr(e).decode('utf-8', 'replace')
+                if event.attempts < EVENT_ATTEMPTS:
+                    failed.add(entity)
+                else:
+                    event.failed_at = datetime.utcnow()
+                    current_app.logger.error(
+                        u"Event %d (%s for %s %d) failed %d times and was set aside. Later events for the "
+                        u"same %s wait until its failed_at is cleared. Last error: %s",
+                        event.id, event.name, event.entity_type, event.entity_id, event.attempts,
+                        event.entity_type, event.error)
+            else:
+                event.dispatched_at = datetime.utcnow()
+                delivered += 1
+                earliest[entity] = following.get(event_id)
+            db.session.commit()
+    return delivered
+
+
+@job('lastuser')
+@with_app_context
+def dispatch_events(limit=100):
+    """
+    Deliver recorded events in the order they were recorded. Each event is locked
+    while its receivers run, so that concurrent dispatchers don't deliver it twice.
+    An event is marked as dispatched after its receivers return, so receivers may
+    see an event again if a dispatcher dies midway. If a receiver raises, later
+    events for the same entity wait, and another run is scheduled to try again.
+
+    :param int limit: Number of events to load at a time
+    """
+    failed = set()
+    with _dispatch_context(event_dispatch_contexts):
+        # Events skipped because another dispatcher held them, or the events before
+        # them, are picked up by that dispatcher's next pass. Stop after a pass
+        # that delivers nothing
+        while _dispatch_pending(limit, failed):
+            pass
+    if failed:
+        enqueue_in(EVENT_RETRY_DELAY, dispatch_events, limit)
+
+
+@sqla_event.listens_for(Session, 'after_commit')
+def _events_committed(session):
+    if session.info.pop('events_recorded', False) and db.get_app().config.get('DISPATCH_EVENTS', True):
+        dispatch_events.delay()
+
+
+@sqla_event.listens_for(Session, 'after_rollback')
+def _events_discarded(session):
+    session.info.pop('events_recorded', None)
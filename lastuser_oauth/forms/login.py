@@ -7,7 +7,7 @@ import flask.ext.wtf as wtf
 from coaster import valid_username
 from baseframe.forms import Form
 
-from lastuser_core.models import User, UserEmail, getuser
+from lastuser_core.models import User, UserEmail, resolve_user, check_password
 
 
 class LoginForm(Form):
@@ -15,13 +15,13 @@ class LoginForm(Form):
     password = wtforms.PasswordField('Password', validators=[wtforms.validators.Required()])
 
     def validate_username(self, field):
-        existing = getuser(field.data)
+        existing = resolve_user(field.data)
         if existing is None:
             raise wtforms.ValidationError("User does not exist")
 
     def validate_password(self, field):
-        user = getuser(self.username.data)
-        if user is None or not user.password_is(field.data):
+        user = resolve_user(self.username.data)
+        if not check_password(user, field.data):
             raise wtforms.ValidationError("Incorrect password")
         self.user = user
 
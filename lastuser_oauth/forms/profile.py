@@ -6,7 +6,7 @@ import wtforms.fields.html5
 from coaster import valid_username, sorted_timezones
 from baseframe.forms import Form, ValidEmailDomain
 
-from lastuser_core.models import UserEmail, getuser
+from lastuser_core.models import UserEmail, resolve_user
 
 timezones = sorted_timezones()
 
@@ -15,7 +15,7 @@ class PasswordResetRequestForm(Form):
     username = wtforms.TextField('Username or Email', validators=[wtforms.validators.Required()])
 
     def validate_username(self, field):
-        user = getuser(field.data)
+        user = resolve_user(field.data)
         if user is None:
             raise wtforms.ValidationError("Could not find a user with that id")
         self.user = user
@@ -29,7 +29,7 @@ class PasswordResetForm(Form):
                           validators=[wtforms.validators.Required(), wtforms.validators.EqualTo('password')])
 
     def validate_username(self, field):
-        user = getuser(field.data)
+        user = resolve_user(field.data)
         if user is None or user != self.edit_user:
             raise wtforms.ValidationError(
                 "That username or email does not match the user the reset code is for")
@@ -1,26 +1,169 @@
 # -*- coding: utf-8 -*-
 
-from markdown import markdown
-from flask import render_template
+from datetime import datetime, timedelta
+from smtplib import SMTPException, SMTPServerDisconnected, SMTPResponseException, SMTPRecipientsRefused
+from socket import error as socket_error
+from threading import local
+from markdown import Markdown
+from flask import current_app
 from flask.ext.mail import Mail, Message
+from flask.ext.rq import job
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from lastuser_core.models import db, EmailMessage, EMAIL_STATUS
+from lastuser_core.jobs import with_app_context, enqueue_in
 
 mail = Mail()
 
+#: Attempts to send an email before giving up
+EMAIL_ATTEMPTS = 4
+#: Seconds to wait before the first retry, doubling for each retry after
+EMAIL_BACKOFF = 5
+#: Seconds after which an email claimed for sending is queued again, in case the
+#: worker sending it died
+EMAIL_CLAIM_TIMEOUT = 600
+
+#: Compiled email templates, by name
+_templates = {}
+#: Per-thread Markdown converter and SMTP connection
+_local = local()
+
 
 def send_email_verify_link(useremail):
     """
     Mail a verification link to the user.
     """
-    msg = Message(subject="Confirm your email address",
-        recipients=[useremail.email])
-    msg.body = render_template("emailverify.md", useremail=useremail)
-    msg.html = markdown(msg.body)
-    mail.send(msg)
+    return queue_email(useremail.email, "Confirm your email address", "emailverify.md", useremail=useremail)
 
 
 def send_password_reset_link(email, user, secret):
-    msg = Message(subject="Reset your password",
-        recipients=[email])
-    msg.body = render_template("emailreset.md", user=user, secret=secret)
-    msg.html = markdown(msg.body)
-    mail.send(msg)
+    return queue_email(email, "Reset your password", "emailreset.md", user=user, secret=secret)
+
+
+def render_email(template, **context):
+    """
+    Render a Markdown email template, returning plain text and HTML.
+    """
+    compiled = _templates.get(template)
+    if compiled is None or current_app.debug:
+        compiled = _templates[template] = current_app.jinja_env.get_template(template)
+    body = compiled.render(**context)
+    converter = getattr(_local, 'markdown', None)
+    if converter is None:
+        converter = _local.markdown = Markdown()
+    return body, converter.reset().convert(body)
+
+
+def queue_email(recipient, subject, template, **context):
+    """
+    Render an email and add it to the outbound queue. It is sent by a background
+    job once the database session is committed.
+
+    :param str recipient: Email address
+    :param str subject: Subject line
+    :param str template: Name of a Markdown template
+    """
+    body, html = render_email(template, **context)
+    message = EmailMessage(recipient=recipient, subject=unicode(subject), body=body, html=html)
+    db.session.add(message)
+    db.session.info['emails_queued'] = True
+    return message
+
+
+@event.listens_for(Session, 'after_commit')
+def _emails_committed(session):
+    if session.info.pop('emails_queued', False) and db.get_app().config.get('QUEUE_EMAILS', True):
+        send_queued_emails.delay()
+
+
+@event.listens_for(Session, 'after_rollback')
+def _emails_discarded(session):
+    session.info.pop('emails_queued', None)
+
+
+@job("lastuser")
+@with_app_context
+def send_queued_emails():
+    """
+    Send all queued emails over one SMTP connection. Each email is claimed before
+    sending, so concurrent jobs don't send it twice. Emails whose claim is older
+    than :data:`EMAIL_CLAIM_TIMEOUT` are queued again.
+    """
+    now = datetime.utcnow()
+    EmailMessage.query.filter(EmailMessage.status == EMAIL_STATUS.SENDING,
+        EmailMessage.updated_at < now - timedelta(seconds=EMAIL_CLAIM_TIMEOUT)).update(
+        {'status': EMAIL_STATUS.QUEUED}, synchronize_session=False)
+    db.session.commit()
+    due = db.or_(EmailMessage.retry_at == None, EmailMessage.retry_at <= now)
+    pending = [message_id for (message_id,) in db.session.query(EmailMessage.id).filter(
+        EmailMessage.status == EMAIL_STATUS.QUEUED, due).order_by(EmailMessage.id)]
+    for message_id in pending:
+        # Claiming updates updated_at, which times the claim out
+        claimed = EmailMessage.query.filter(EmailMessage.id == message_id,
+            EmailMessage.status == EMAIL_STATUS.QUEUED, due).update(
+            {'status': EMAIL_STATUS.SENDING}, synchronize_session=False)
+        db.session.commit()
+        if claimed:
+            deliver_email(EmailMessage.query.get(message_id))
+
+
+def deliver_email(message):
+    """
+    Make an attempt to send a claimed email, and record the outcome. If the mail
+    server can't take it now, the email is queued again and another job is
+    scheduled after a delay that doubles with each attempt. Returns True if the
+    mail server accepted the email, False if it was given up on, and None if it
+    will be retried.
+
+    :param message: :class:`EmailMessage` to send
+    """
+    msg = Message(subject=message.subject, recipients=[message.recipient], body=message.body, html=message.html)
+    message.attempts += 1
+    try:
+        _send(msg)
+    except (SMTPException, socket_error) as e:
+        close_smtp_connection()
+        message.error = repr(e).decode('utf-8', 'replace')
+        if message.attempts < EMAIL_ATTEMPTS and not (isinstance(e, SMTPRecipientsRefused) or (
+                isinstance(e, SMTPResponseException) and e.smtp_code >= 500)):  # Else a permanent failure
+            delay = EMAIL_BACKOFF * 2 ** (message.attempts - 1)
+            message.status = EMAIL_STATUS.QUEUED
+            message.retry_at = datetime.utcnow() + timedelta(seconds=delay)
+            db.session.commit()
+            enqueue_in(delay, send_queued_emails)
+            return None
+        message.status = EMAIL_STATUS.FAILED
+        db.session.commit()
+        return False
+    message.status = EMAIL_STATUS.SENT
+    message.sent_at = datetime.utcnow()
+    db.session.commit()
+    return True
+
+
+def _send(msg):
+    connection = getattr(_local, 'smtp', None)
+    if connection is not None:
+        try:
+            connection.send(msg)
+            return
+        except SMTPServerDisconnected:
+            # The server dropped the idle connection. Open a new one
+            _local.smtp = None
+    connection = mail.connect()
+    connection.__enter__()  # Opens the connection, which is kept open across emails
+    _local.smtp = connection
+    connection.send(msg)
+
+
+def close_smtp_connection():
+    """
+    Close this thread's SMTP connection, if open.
+    """
+    connection = getattr(_local, 'smtp', None)
+    _local.smtp = None
+    if connection is not None and connection.host is not None:
+        try:
+            connection.host.quit()
+        except (SMTPException, socket_error):
+            connection.host.close()
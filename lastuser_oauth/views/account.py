@@ -171,6 +171,7 @@ def profile_merge():
             new_user = merge_users(g.user, other_user)
             login_internal(new_user)
             user_data_changed.send(new_user, changes=['merge'])
+            db.session.commit()
             flash("Your accounts have been merged.", 'success')
             session.pop('merge_userid', None)
             return redirect(get_next_url(), code=303)
@@ -1,28 +1,107 @@
 # -*- coding: utf-8 -*-
 
 import os
+from collections import namedtuple
 from datetime import datetime, timedelta
 from functools import wraps
 from urllib import unquote
 from pytz import common_timezones
 from flask import g, current_app, request, session, flash, redirect, url_for, Response
+from flask.ctx import _AppCtxGlobals
 from coaster.views import get_current_url
+from lastuser_core.cache import TwoTierCache, delete_on_commit
 from lastuser_core.models import db, User, Client
-from lastuser_core.signals import user_login, user_logout, user_registered
+from lastuser_core.signals import (user_login, user_logout, user_registered,
+    model_user_edited, model_user_deleted)
 from .. import lastuser_oauth
 
 valid_timezones = set(common_timezones)
 
 
+#: Compact identity of the user in a session. ``userid`` is the session's userid,
+#: which may belong to an account that has since been merged into user ``id``
+SessionUser = namedtuple('SessionUser', ['id', 'userid'])
+
+#: Cache of :class:`SessionUser` instances, keyed by the userid in the session
+session_user_cache = TwoTierCache('sessionuser', maxsize=10000, ttl=10, shared_ttl=60)
+
+
+class LastuserGlobals(_AppCtxGlobals):
+    """
+    Request globals where ``g.user`` and ``g.client`` are loaded from the database
+    only when a view or template first uses them, using the :class:`SessionUser`
+    in ``g.session_user`` and the :class:`ClientSnapshot` in ``g.client_snapshot``.
+    """
+    @property
+    def user(self):
+        if '_user' not in self.__dict__:
+            session_user = self.__dict__.get('session_user')
+            user = User.query.get(session_user.id) if session_user is not None else None
+            self._user = user if user is not None and user.is_active else None
+        return self._user
+
+    @user.setter
+    def user(self, value):
+        self._user = value
+
+    @user.deleter
+    def user(self):
+        self.__dict__.pop('_user', None)
+
+    @property
+    def client(self):
+        if '_client' not in self.__dict__:
+            if 'client_snapshot' not in self.__dict__:
+                raise AttributeError('client')
+            self._client = self.client_snapshot.client
+        return self._client
+
+    @client.setter
+    def client(self, value):
+        self._client = value
+
+    @client.deleter
+    def client(self):
+        self.__dict__.pop('_client', None)
+
+
+@lastuser_oauth.record_once
+def _set_globals_class(state):
+    state.app.app_ctx_globals_class = LastuserGlobals
+
+
+def get_session_user(userid):
+    """
+    Return a :class:`SessionUser` for the userid in a session, or None if there is
+    no such active user.
+    """
+    session_user = session_user_cache.get(userid)
+    if session_user is None:
+        user = User.get(userid=userid)
+        if user is not None:
+            session_user = SessionUser(user.id, userid)
+            session_user_cache.set(userid, session_user)
+    return session_user
+
+
+@model_user_edited.connect
+@model_user_deleted.connect
+def _uncache_session_user(user):
+    # Merging and suspending accounts are edits too. These signals are sent during
+    # the flush, so wait for the commit before dropping the cached identity
+    delete_on_commit(db.object_session(user), session_user_cache, user.userid)
+
+
 @lastuser_oauth.before_app_request
 def lookup_current_user():
     """
-    If there's a userid in the session, retrieve the user object and add
-    to the request namespace object g.
+    If there's a userid in the session, look up the user and add to the request
+    namespace object g. The user object itself is loaded when g.user is first used.
     """
-    g.user = None
+    g.session_user = None
     if 'userid' in session:
-        g.user = User.get(userid=session['userid'])
+        g.session_user = get_session_user(session['userid'])
+    del g.user  # Reload on next use
 
 
 @lastuser_oauth.after_app_request
@@ -100,11 +179,12 @@ def _client_login_inner():
     if request.authorization is None:
         return Response(u"Client credentials required.", 401,
             {'WWW-Authenticate': 'Basic realm="Client credentials"'})
-    client = Client.get(key=request.authorization.username)
-    if client is None or not client.secret_is(request.authorization.password):
+    client = Client.get_cached(key=request.authorization.username)
+    if client is None or not client.active or not client.secret_is(request.authorization.password):
         return Response(u"Invalid client credentials.", 401,
             {'WWW-Authenticate': 'Basic realm="Client credentials"'})
-    g.client = client
+    g.client_snapshot = client
+    del g.client  # Load from the snapshot on next use
 
 
 def requires_client_login(f):
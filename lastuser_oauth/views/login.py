@@ -1,6 +1,5 @@
 # -*- coding: utf-8 -*-
 
-from datetime import datetime, timedelta
 import urlparse
 from openid import oidutil
 from flask import g, current_app, redirect, request, flash, render_template, url_for, Markup, escape, abort
@@ -9,6 +8,7 @@ from coaster.views import get_next_url, load_model
 from baseframe.forms import render_form, render_message, render_redirect
 
 from lastuser_core import login_registry
+from lastuser_core.expiry import expiry_cutoff
 from .. import lastuser_oauth
 from ..mailclient import send_email_verify_link, send_password_reset_link
 from lastuser_core.models import db, User, UserEmailClaim, PasswordResetRequest, Client
@@ -207,8 +207,8 @@ def reset_email(user, kwargs):
     if not resetreq:
         return render_message(title="Invalid reset link",
             message=u"The reset link you clicked on is invalid.")
-    if resetreq.created_at < datetime.utcnow() - timedelta(days=1):
-        # Reset code has expired (> 24 hours). Delete it
+    if resetreq.created_at < expiry_cutoff('PASSWORD_RESET_EXPIRY'):
+        # Reset code has expired. Delete it
         db.session.delete(resetreq)
         db.session.commit()
         return render_message(title="Expired reset link",
@@ -1,9 +1,16 @@
 # -*- coding: utf-8 -*-
 
+from collections import OrderedDict
+from contextlib import contextmanager
+import json
 import requests
+from requests.adapters import HTTPAdapter
+from flask import g, has_app_context, has_request_context
 from flask.ext.rq import job
-from lastuser_core.models import AuthToken
-from lastuser_core.signals import user_data_changed, org_data_changed, team_data_changed
+from lastuser_core.models import db, NoticeFailure, notice_recipients
+from lastuser_core.jobs import enqueue_in
+from lastuser_core.signals import user_data_changed, org_data_changed, team_data_changed, event_dispatch_contexts
+from .. import lastuser_oauth
 
 
 user_changes_to_notify = set(['merge', 'profile', 'email', 'email-claim', 'email-delete',
@@ -19,23 +26,22 @@ def notify_user_data_changed(user, changes):
     """
     if user_changes_to_notify & set(changes):
         # We have changes that apps need to hear about
-        for token in AuthToken.query.filter_by(user=user).all():
-            if token.client.notification_uri:
-                notify_changes = []
-                for change in changes:
-                    if change in ['merge', 'profile']:
+        for recipient in notice_recipients(user=user):
+            notify_changes = []
+            for change in changes:
+                if change in ['merge', 'profile']:
+                    notify_changes.append(change)
+                elif change in ['email', 'email-claim', 'email-delete']:
+                    if 'email' in recipient.scope:
                         notify_changes.append(change)
-                    elif change in ['email', 'email-claim', 'email-delete']:
-                        if 'email' in token.scope:
-                            notify_changes.append(change)
-                    elif change in ['phone', 'phone-claim', 'phone-delete']:
-                        if 'phone' in token.scope:
-                            notify_changes.append(change)
-                if notify_changes:
-                    send_notice.delay(token.client.notification_uri, data=
-                        {'userid': user.userid,
-                        'type': 'user',
-                        'changes': notify_changes})
+                elif change in ['phone', 'phone-claim', 'phone-delete']:
+                    if 'phone' in recipient.scope:
+                        notify_changes.append(change)
+            if notify_changes:
+                queue_notice(recipient,
+                    {'userid': user.userid,
+                    'type': 'user',
+                    'changes': notify_changes})
 
 
 @org_data_changed.connect
@@ -44,25 +50,23 @@ def notify_org_data_changed(org, user, changes, team=None):
     Like :func:`notify_user_data_changed`, except we'll also look at
     all other owners of this org to find apps that need to be notified.
     """
-    client_users = {}
-    if team is not None:
-        team_access = set(org.clients_with_team_access())
+    if db.inspect(org).transient:
+        # The org was deleted along with its owners team. Notify apps via the owner who deleted it
+        recipients = [r for r in notice_recipients(user=user) if 'organizations' in r.scope]
     else:
-        team_access = []
-    for token in AuthToken.query.filter(AuthToken.user_id.in_([u.id for u in org.owners.users])).all():
-        if 'organizations' in token.scope and token.client.notification_uri:
-            if team is not None:
-                if token.client not in team_access:
-                    continue
-            client_users.setdefault(token.client, []).append(token.user)
+        recipients = notice_recipients(org=org, team_access=team is not None)
+    client_users = OrderedDict()
+    for recipient in recipients:
+        client_users.setdefault(recipient.client_id, []).append(recipient)
     # Now we have a list of clients to notify and a list of users to notify them with
-    for client, users in client_users.items():
-        if user in users:
-            notify_user = user
+    for recipients in client_users.values():
+        userids = [r.userid for r in recipients]
+        if user.userid in userids:
+            notify_userid = user.userid
         else:
-            notify_user = users[0]  # First user available
-        send_notice.delay(client.notification_uri, data=
-            {'userid': notify_user.userid,
+            notify_userid = userids[0]  # First user available
+        queue_notice(recipients[0],
+            {'userid': notify_userid,
             'type': 'org' if team is None else 'team',
             'orgid': org.userid,
             'teamid': team.userid if team is not None else None,
@@ -78,6 +82,144 @@ def notify_team_data_changed(team, user, changes):
     notify_org_data_changed(team.org, user=user, changes=['team-' + c for c in changes], team=team)
 
 
+def queue_notice(recipient, data):
+    """
+    Queue a notice to a client app. Notices queued during a request are sent when
+    the request is done, and those queued within :func:`collect_notices` when the
+    block ends. Notices to the same app about the same user, org or team are
+    merged, and apps that accept batches receive all their notices in one request.
+
+    :param recipient: :class:`NoticeRecipient` for the client app
+    :param dict data: Notice
+    """
+    notice = (recipient.client_id, recipient.notification_uri, recipient.notification_batch,
+        dict(data, changes=list(data['changes'])))
+    if has_request_context() and getattr(g, 'pending_notices', None) is None:
+        g.pending_notices = OrderedDict()
+    pending = getattr(g, 'pending_notices', None) if has_app_context() else None
+    if pending is None:
+        dispatch_notices([notice])
+        return
+    key = (recipient.client_id, data['type'], data.get('orgid'), data.get('teamid'),
+        data['userid'] if data['type'] == 'user' else None)
+    if key in pending:
+        changes = pending[key][3]['changes']
+        changes.extend(c for c in data['changes'] if c not in changes)
+    else:
+        pending[key] = notice
+
+
+@lastuser_oauth.after_app_request
+def send_pending_notices(response):
+    pending = getattr(g, 'pending_notices', None)
+    if pending:
+        g.pending_notices = None
+        dispatch_notices(pending.values())
+    return response
+
+
+@contextmanager
+def collect_notices():
+    """
+    Hold notices queued within this block, merging and batching them as in a
+    request, and send them when the block ends. Needs an app context.
+    """
+    if getattr(g, 'pending_notices', None) is not None:
+        # Already collecting, for a request or an outer block
+        yield
+        return
+    g.pending_notices = OrderedDict()
+    try:
+        yield
+    finally:
+        pending, g.pending_notices = g.pending_notices, None
+        if pending:
+            dispatch_notices(pending.values())
+
+
+# Receivers run by dispatch_events send their notices once the run is done
+event_dispatch_contexts.append(collect_notices)
+
+
+def dispatch_notices(notices):
+    """
+    Enqueue delivery jobs for (client_id, notification_uri, batch, data) tuples.
+    """
+    batches = {}
+    for client_id, url, batch, data in notices:
+        if batch:
+            batches.setdefault((client_id, url), []).append(data)
+        else:
+            send_notice.delay(url, data=data, client_id=client_id)
+    for (client_id, url), batch in batches.items():
+        send_notices.delay(url, batch, client_id=client_id)
+
+
 @job("lastuser")
-def send_notice(url, params=None, data=None, method='POST'):
-    requests.request(method, url, params=params, data=data)
+def send_notice(url, params=None, data=None, method='POST', client_id=None, attempt=1):
+    deliver_notice(url, method=method, params=params, data=data, client_id=client_id, attempt=attempt)
+
+
+@job("lastuser")
+def send_notices(url, notices, client_id=None, attempt=1):
+    deliver_notice(url, notices=notices, client_id=client_id, attempt=attempt)
+
+
+#: Seconds to wait for a client app to accept a connection and to respond
+NOTICE_TIMEOUT = (5, 15)
+#: Attempts to deliver a notice before giving up
+NOTICE_ATTEMPTS = 4
+#: Seconds to wait before the first retry, doubling for each retry after
+NOTICE_BACKOFF = 2
+
+#: HTTP session that keeps connections to client apps alive, pooled per host
+notice_session = requests.Session()
+notice_session.mount('http://', HTTPAdapter(pool_connections=50, pool_maxsize=4))
+notice_session.mount('https://', HTTPAdapter(pool_connections=50, pool_maxsize=4))
+
+
+def deliver_notice(url, method='POST', params=None, data=None, notices=None, client_id=None, attempt=1):
+    """
+    Send a notice to a client app. Server and network errors are retried with
+    exponential backoff by queueing the job again, so that the worker is free for
+    other jobs in the meantime. Notices that could not be delivered are recorded as
+    :class:`NoticeFailure`. Returns True if the notice was delivered, False if it
+    was given up on, and None if it will be retried.
+
+    :param str url: Notification URL
+    :param str method: HTTP method
+    :param dict params: Query parameters
+    :param dict data: Form data, for a single notice
+    :param list notices: Notices to send as a JSON batch, instead of ``data``
+    :param int client_id: Client app the notice is for, for the failure record
+    :param int attempt: Number of this attempt, counting from 1
+    """
+    if notices is not None:
+        body = json.dumps({'notices': notices})
+        headers = {'Content-Type': 'application/json'}
+    else:
+        body = data
+        headers = None
+    retry = True
+    try:
+        response = notice_session.request(method, url, params=params, data=body, headers=headers,
+            timeout=NOTICE_TIMEOUT)
+    except requests.RequestException as e:
+        error = repr(e).decode('utf-8', 'replace')
+    else:
+        if response.status_code < 400:
+            return True
+        error = u"HTTP {code}".format(code=response.status_code)
+        retry = response.status_code >= 500  # Else the app rejected the notice. Trying again won't help
+    if retry and attempt < NOTICE_ATTEMPTS:
+        delay = NOTICE_BACKOFF * 2 ** (attempt - 1)
+        if notices is not None:
+            enqueue_in(delay, send_notices, url, notices, client_id=client_id, attempt=attempt + 1)
+        else:
+            enqueue_in(delay, send_notice, url, params=params, data=data, method=method, client_id=client_id,
+                attempt=attempt + 1)
+        return None
+    db.session.add(NoticeFailure(client_id=client_id, url=url, method=unicode(method), attempts=attempt, error=error,
+        payload=unicode(json.dumps({'params': params, 'data': data, 'notices': notices}))))
+    db.session.commit()
+    return False
@@ -1,14 +1,15 @@
 # -*- coding: utf-8 -*-
 
-from datetime import datetime, timedelta
 import urlparse
+from datetime import datetime
 from flask import g, render_template, redirect, request, jsonify, get_flashed_messages
-from coaster import newsecret
 
 from lastuser_core.utils import make_redirect_url
 from lastuser_core import resource_registry
-from lastuser_core.models import (db, Client, AuthCode, AuthToken, UserFlashMessage,
-    UserClientPermissions, TeamClientPermissions, getuser, Resource, ResourceAction)
+from lastuser_core.expiry import expiry_seconds, expiry_cutoff
+from lastuser_core.authcode import AuthCodeGrant, auth_code_store
+from lastuser_core.models import (db, Client, AuthToken, UserFlashMessage,
+    UserClientPermissions, TeamClientPermissions, resolve_user, check_password, scope_catalog)
 from .. import lastuser_oauth
 from ..forms import AuthorizeForm
 from .helpers import requires_login_no_message, requires_client_login
@@ -23,7 +24,7 @@ def verifyscope(scope, client):
     """
     Verify if requested scope is valid for this client. Scope must be a list.
     """
-    resources = {}  # resource_object: [action_object, ...]
+    resources = {}  # resource_snapshot: [action_snapshot, ...]
 
     for item in scope:
         if item not in resource_registry:  # Validation is only required for non-internal resources
@@ -36,7 +37,7 @@ def verifyscope(scope, client):
             else:
                 resource_name = item
                 action_name = None
-            resource = Resource.query.filter_by(name=resource_name).first()
+            resource = scope_catalog.get(resource_name)
             # Validation 2: Resource exists
             if not resource:
                 raise ScopeException(u"Unknown resource ‘{resource}’ in scope".format(resource=resource_name))
@@ -46,7 +47,7 @@ def verifyscope(scope, client):
                     u"This application does not have access to resource ‘{resource}’ in scope".format(resource=resource_name))
             # Validation 4: Action is valid
             if action_name:
-                action = ResourceAction.query.filter_by(name=action_name, resource=resource).first()
+                action = resource.actions.get(action_name)
                 if not action:
                     raise ScopeException(u"Unknown action ‘{action}’ on resource ‘{resource}’".format(
                         action=action_name, resource=resource_name))
@@ -68,10 +69,9 @@ def oauth_make_auth_code(client, scope, redirect_uri):
     Make an auth code for a given client. Caller must commit
     the database session for this to work.
     """
-    authcode = AuthCode(user=g.user, client=client, scope=scope, redirect_uri=redirect_uri)
-    authcode.code = newsecret()
-    db.session.add(authcode)
-    return authcode.code
+    grant = AuthCodeGrant.make(user=g.user, client=client, scope=scope, redirect_uri=redirect_uri)
+    auth_code_store().save(grant)
+    return grant.code
 
 
 def clear_flashed_messages():
@@ -198,7 +198,7 @@ def oauth_authorize():
 
     # If there is an existing auth token with the same or greater scope, don't ask user again; authorise silently
     existing_token = AuthToken.query.filter_by(user=g.user, client=client).first()
-    if existing_token and set(scope).issubset(set(existing_token.scope)):
+    if existing_token and existing_token.scope.issuperset(scope):
         return oauth_auth_success(client, redirect_uri, state, oauth_make_auth_code(client, scope, redirect_uri))
 
     # First request. Ask user.
@@ -236,11 +236,14 @@ def oauth_token_error(error, error_description=None, error_uri=None):
 
 
 def oauth_make_token(user, client, scope):
+    validity = expiry_seconds('ACCESS_TOKEN_EXPIRY')
     token = AuthToken.query.filter_by(user=user, client=client).first()
     if token:
         token.add_scope(scope)
+        if not token.is_valid() or token.validity != validity:
+            token.refresh(validity=validity)
     else:
-        token = AuthToken(user=user, client=client, scope=scope, token_type='bearer')
+        token = AuthToken(user=user, client=client, scope=scope, token_type='bearer', validity=validity)
         db.session.add(token)
     # TODO: Look up Resources for items in scope; look up their providing clients apps,
     # and notify each client app of this token
@@ -250,7 +253,7 @@ def oauth_make_token(user, client, scope):
 def oauth_token_success(token, **params):
     params['access_token'] = token.token
     params['token_type'] = token.token_type
-    params['scope'] = u' '.join(token.scope)
+    params['scope'] = unicode(token.scope)
     if token.client.trusted:
         # Trusted client. Send back waiting user messages.
         for ufm in list(UserFlashMessage.query.filter_by(user=token.user).all()):
@@ -259,11 +262,10 @@ def oauth_token_success(token, **params):
                 'message': ufm.message
                 })
             db.session.delete(ufm)
-    # TODO: Understand how refresh_token works.
-    if token.validity:
-        params['expires_in'] = token.validity
+    if token.expires_at is not None:
+        params['expires_in'] = max(int((token.expires_at - datetime.utcnow()).total_seconds()), 0)
         # No refresh tokens for client_credentials tokens
-        if token.user is not None:
+        if token.refresh_token is not None:
             params['refresh_token'] = token.refresh_token
     response = jsonify(**params)
     response.headers['Cache-Control'] = 'no-cache, no-store, max-age=0, must-revalidate'
@@ -288,12 +290,13 @@ def oauth_token():
     # if grant_type == 'password' (GET)
     username = request.form.get('username')
     password = request.form.get('password')
+    # if grant_type == 'refresh_token'
+    refresh_token = request.form.get('refresh_token')
 
     # Validations 1: Required parameters
     if not grant_type:
         return oauth_token_error('invalid_request', "Missing grant_type")
-    # grant_type == 'refresh_token' is not supported. All tokens are permanent unless revoked
-    if grant_type not in ['authorization_code', 'client_credentials', 'password']:
+    if grant_type not in ['authorization_code', 'client_credentials', 'password', 'refresh_token']:
         return oauth_token_error('unsupported_grant_type')
 
     # Validations 2: client scope
@@ -309,17 +312,18 @@ def oauth_token():
 
     # Validations 3: auth code
     elif grant_type == 'authorization_code':
-        authcode = AuthCode.query.filter_by(code=code, client=client).first()
+        # Codes are single use. Commit right away so that the code stays used up
+        # even if a check below fails
+        authcode = auth_code_store().redeem(code, client.id)
+        db.session.commit()
         if not authcode:
             return oauth_token_error('invalid_grant', "Unknown auth code")
-        if authcode.created_at < (datetime.utcnow() - timedelta(minutes=1)):  # XXX: Time limit: 1 minute
-            db.session.delete(authcode)
-            db.session.commit()
+        if authcode.created_at < expiry_cutoff('AUTH_CODE_EXPIRY'):
             return oauth_token_error('invalid_grant', "Expired auth code")
         # Validations 3.1: scope in authcode
         if not scope or scope[0] == '':
             return oauth_token_error('invalid_scope', "Scope is blank")
-        if not set(scope).issubset(set(authcode.scope)):
+        if not authcode.scope.issuperset(scope):
             return oauth_token_error('invalid_scope', "Scope expanded")
         else:
             # Scope not provided. Use whatever the authcode allows
@@ -327,9 +331,9 @@ def oauth_token():
         if redirect_uri != authcode.redirect_uri:
             return oauth_token_error('invalid_client', "redirect_uri does not match")
 
-        token = oauth_make_token(user=authcode.user, client=client, scope=scope)
-        db.session.delete(authcode)
-        return oauth_token_success(token, userinfo=get_userinfo(user=authcode.user, client=client, scope=scope))
+        user = authcode.user
+        token = oauth_make_token(user=user, client=client, scope=scope)
+        return oauth_token_success(token, userinfo=get_userinfo(user=user, client=client, scope=scope))
 
     elif grant_type == 'password':
         # Validations 4.1: password grant_type is only for trusted clients
@@ -339,10 +343,10 @@ def oauth_token():
         # Validations 4.2: Are username and password provided and correct?
         if not username or not password:
             return oauth_token_error('invalid_request', "Username or password not provided")
-        user = getuser(username)
-        if not user:
-            return oauth_token_error('invalid_client', "No such user")  # XXX: invalid_client doesn't seem right
-        if not user.password_is(password):
+        user = resolve_user(username)
+        if not check_password(user, password):  # Takes as long whether the user exists or not
+            if not user:
+                return oauth_token_error('invalid_client', "No such user")  # XXX: invalid_client doesn't seem right
             return oauth_token_error('invalid_client', "Password mismatch")
         # Validations 4.3: verify scope
         try:
@@ -352,3 +356,22 @@ def oauth_token():
         # All good. Grant access
         token = oauth_make_token(user=user, client=client, scope=scope)
         return oauth_token_success(token, userinfo=get_userinfo(user=user, client=client, scope=scope))
+
+    elif grant_type == 'refresh_token':
+        # Validations 5.1: refresh token
+        if not refresh_token:
+            return oauth_token_error('invalid_request', "Missing refresh_token")
+        # Lock the token so that only one of several requests with the same refresh token
+        # gets a new token. The others find the refresh token has changed
+        token = AuthToken.query.filter_by(refresh_token=refresh_token, client=client).with_for_update().first()
+        if not token:
+            return oauth_token_error('invalid_grant', "Unknown refresh token")
+        if token.expires_at is not None and token.expires_at < expiry_cutoff('REFRESH_TOKEN_EXPIRY'):
+            return oauth_token_error('invalid_grant', "Expired refresh token")
+        if token.user is not None and not token.user.is_active:
+            return oauth_token_error('invalid_grant', "User account is not active")
+        # Validations 5.2: scope can't be expanded. The token keeps its scope
+        if scope != [u''] and not token.scope.issuperset(scope):
+            return oauth_token_error('invalid_scope', "Scope expanded")
+        token.refresh(validity=expiry_seconds('ACCESS_TOKEN_EXPIRY'))
+        return oauth_token_success(token)
@@ -43,12 +43,12 @@ def profile_edit(newprofile=False):
                 useremail = UserEmailClaim(user=g.user, email=form.email.data)
                 db.session.add(useremail)
             send_email_verify_link(useremail)
-            db.session.commit()
             user_data_changed.send(g.user, changes=['profile', 'email-claim'])
+            db.session.commit()
             flash("Your profile has been updated. We sent you an email to confirm your address", category='success')
         else:
-            db.session.commit()
             user_data_changed.send(g.user, changes=['profile'])
+            db.session.commit()
             flash("Your profile has been updated.", category='success')
 
         if newprofile:
@@ -71,7 +71,7 @@ def confirm_email(md5sum, secret):
     emailclaim = UserEmailClaim.query.filter_by(md5sum=md5sum, verification_code=secret).first()
     if emailclaim is not None:
         if 'verify' in emailclaim.permissions(g.user):
-            existing = UserEmail.query.filter(UserEmail.email.in_([emailclaim.email, emailclaim.email.lower()])).first()
+            existing = UserEmail.get(email=emailclaim.email)
             if existing is not None:
                 claimed_email = emailclaim.email
                 claimed_user = emailclaim.user
@@ -90,10 +90,10 @@ def confirm_email(md5sum, secret):
 
             useremail = emailclaim.user.add_email(emailclaim.email.lower(), primary=emailclaim.user.email is None)
             db.session.delete(emailclaim)
-            for claim in UserEmailClaim.query.filter(UserEmailClaim.email.in_([useremail.email, useremail.email.lower()])).all():
+            for claim in UserEmailClaim.query.filter_by(email_normalized=useremail.email_normalized).all():
                 db.session.delete(claim)
-            db.session.commit()
             user_data_changed.send(g.user, changes=['email'])
+            db.session.commit()
             return render_message(title="Email address verified",
                 message=Markup(u"Hello <strong>{fullname}</strong>! "
                     u"Your email address <code>{email}</code> has now been verified.".format(
@@ -1,17 +1,74 @@
 # -*- coding: utf-8 -*-
 
-from flask import request, g
+from flask import current_app, request, g
 from coaster import getbool
 from coaster.views import jsonp, requestargs
 
-from lastuser_core.models import (getuser, User, Organization, AuthToken, Resource,
-    ResourceAction, UserClientPermissions, TeamClientPermissions)
+from lastuser_core.models import (getuser, getusers, User, Organization, Client, AuthToken, scope_catalog,
+    UserClientPermissions, TeamClientPermissions)
 from lastuser_core import resource_registry
 from .. import lastuser_oauth
 from .helpers import requires_client_login, requires_user_or_client_login
 
 
-def get_userinfo(user, client, scope=[], get_permissions=True):
+#: Token and resource pairs accepted by one verify_bulk request, unless set in
+#: the app's config as ``VERIFY_BULK_MAX``
+VERIFY_BULK_MAX = 100
+
+
+def preload_userinfo(users, client, scope, get_permissions=True):
+    """
+    Load what :func:`get_userinfo` needs for all the given users, with one query per
+    kind of item instead of one per user. Items are attached to the users, so they
+    stay loaded as long as the caller holds on to the users. Returns a dictionary
+    of user id: permissions to pass to :func:`get_userinfo`.
+
+    :param scope: Scope, or the union of the scopes the users' data is wanted for
+    """
+    if 'id' in scope:
+        User.preload_oldids(users)
+    collections = []
+    if 'email' in scope:
+        collections.append('emails')
+    if 'phone' in scope:
+        collections.append('phones')
+    if 'organizations' in scope or (get_permissions and not client.user):
+        collections.append('teams')
+    User.preload_collections(users, *collections)
+    if 'organizations' in scope:
+        User.preload_memberships(users)
+
+    permissions = {}
+    if get_permissions and users:
+        if client.user:
+            for perms in UserClientPermissions.query.filter(UserClientPermissions.client_id == client.id,
+                    UserClientPermissions.user_id.in_([user.id for user in users])):
+                permissions[perms.user_id] = perms.access_permissions.split(u' ')
+        else:
+            team_ids = set(team.id for user in users for team in user.teams)
+            team_permissions = {}
+            if team_ids:
+                for perms in TeamClientPermissions.query.filter(TeamClientPermissions.client_id == client.id,
+                        TeamClientPermissions.team_id.in_(team_ids)):
+                    team_permissions.setdefault(perms.team_id, set()).update(perms.access_permissions.split(u' '))
+            for user in users:
+                permsset = set()
+                for team in user.teams:
+                    permsset.update(team_permissions.get(team.id, ()))
+                permissions[user.id] = sorted(permsset)
+    return permissions
+
+
+def get_userinfo(user, client, scope=[], get_permissions=True, permissions=None):
+    """
+    Return the information about a user that the scope allows a client to see.
+
+    :param dict permissions: Permissions returned by :func:`preload_userinfo`, if the
+        caller preloaded the user's data. Otherwise it is loaded here
+    """
+    if permissions is None:
+        permissions = preload_userinfo([user], client, scope, get_permissions)
+
     if 'id' in scope:
         userinfo = {'userid': user.userid,
                     'username': user.username,
@@ -26,25 +83,16 @@ def get_userinfo(user, client, scope=[], get_permissions=True):
         userinfo['phone'] = unicode(user.phone)
     if 'organizations' in scope:
         userinfo['organizations'] = {
-            'owner': [{'userid': org.userid, 'name': org.name, 'title': org.title} for org in user.organizations_owned()],
-            'member': [{'userid': org.userid, 'name': org.name, 'title': org.title} for org in user.organizations()],
+            'owner': [{'userid': org.userid, 'name': org.name, 'title': org.title}
+                for org in user.memberships() if org.is_owner],
+            'member': [{'userid': org.userid, 'name': org.name, 'title': org.title} for org in user.memberships()],
             }
         userinfo['teams'] = [{'userid': team.userid,
                               'title': team.title,
                               'org': team.org.userid,
-                              'owners': team == team.org.owners} for team in user.teams]
-    if get_permissions:
-        if client.user:
-            perms = UserClientPermissions.query.filter_by(user=user, client=client).first()
-            if perms:
-                userinfo['permissions'] = perms.access_permissions.split(u' ')
-        else:
-            perms = TeamClientPermissions.query.filter_by(client=client).filter(
-                TeamClientPermissions.team_id.in_([team.id for team in user.teams])).all()
-            permsset = set()
-            for permob in perms:
-                permsset.update(permob.access_permissions.split(u' '))
-            userinfo['permissions'] = sorted(permsset)
+                              'owners': team.id == team.org.owners_id} for team in user.teams]
+    if get_permissions and user.id in permissions:
+        userinfo['permissions'] = permissions[user.id]
     return userinfo
 
 
@@ -77,57 +125,136 @@ def api_result(status, **params):
 
 # --- Client access endpoints -------------------------------------------------
 
-@lastuser_oauth.route('/api/1/token/verify', methods=['POST'])
-@requires_client_login
-def token_verify():
-    token = request.form.get('access_token')
-    client_resource = request.form.get('resource')  # Can only be a single resource
-    if not client_resource:
-        # No resource specified by caller
-        return resource_error('no_resource')
-    if not token:
-        # No token specified by caller
-        return resource_error('no_token')
+def verify_token_resource(authtoken, client_resource, userinfo=None):
+    """
+    Verify that the given token grants access to a resource provided by the current
+    client. Returns a dictionary of parameters for :func:`api_result`.
 
-    authtoken = AuthToken.query.filter_by(token=token).first()
+    :param authtoken: :class:`AuthTokenSnapshot`, or None if the token is unknown
+    :param str client_resource: Resource name, optionally with an action name
+    :param userinfo: Function taking a user and scope and returning the user's
+        information, if not :func:`get_userinfo` for the current client
+    """
     if not authtoken:
         # No such auth token
-        return api_result('error', error='no_token')
+        return {'status': 'error', 'error': 'no_token'}
+    if not authtoken.is_valid():
+        return {'status': 'error', 'error': 'token_expired'}
     if client_resource not in authtoken.scope:
         # Token does not grant access to this resource
-        return api_result('error', error='access_denied')
+        return {'status': 'error', 'error': 'access_denied'}
     if '/' in client_resource:
         parts = client_resource.split('/')
         if len(parts) != 2:
-            return api_result('error', error='invalid_scope')
+            return {'status': 'error', 'error': 'invalid_scope'}
         resource_name, action_name = parts
     else:
         resource_name = client_resource
         action_name = None
-    resource = Resource.query.filter_by(name=resource_name).first()
-    if not resource or resource.client != g.client:
+    resource = scope_catalog.get(resource_name)
+    if not resource or resource.client_id != g.client_snapshot.id:
         # Resource does not exist or does not belong to this client
-        return api_result('error', error='access_denied')
-    if action_name:
-        action = ResourceAction.query.filter_by(name=action_name, resource=resource).first()
-        if not action:
-            return api_result('error', error='access_denied')
+        return {'status': 'error', 'error': 'access_denied'}
+    if action_name and action_name not in resource.actions:
+        return {'status': 'error', 'error': 'access_denied'}
 
     # All validations passed. Token is valid for this client and scope. Return with information on the token
     # TODO: Don't return validity. Set the HTTP cache headers instead.
-    params = {'validity': 120}  # Period (in seconds) for which this assertion may be cached.
-    if authtoken.user:
-        params['userinfo'] = get_userinfo(authtoken.user, g.client, scope=authtoken.scope)
+    # Period (in seconds) for which this assertion may be cached. Tokens that expire
+    # may be cached until they expire
+    expires_in = authtoken.expires_in()
+    params = {'status': 'ok', 'validity': 120 if expires_in is None else expires_in}
+    user = authtoken.user
+    if user:
+        if userinfo is None:
+            params['userinfo'] = get_userinfo(user, g.client, scope=authtoken.scope)
+        else:
+            params['userinfo'] = userinfo(user, authtoken.scope)
+    client = authtoken.client  # Loaded from the snapshot on each access
     params['clientinfo'] = {
-        'title': authtoken.client.title,
-        'userid': authtoken.client.user.userid,
-        'buid': authtoken.client.user.userid,
-        'owner_title': authtoken.client.owner_title,
-        'website': authtoken.client.website,
-        'key': authtoken.client.key,
-        'trusted': authtoken.client.trusted,
+        'title': client.title,
+        'userid': client.user.userid,
+        'buid': client.user.userid,
+        'owner_title': client.owner_title,
+        'website': client.website,
+        'key': client.key,
+        'trusted': client.trusted,
         }
-    return api_result('ok', **params)
+    return params
+
+
+@lastuser_oauth.route('/api/1/token/verify', methods=['POST'])
+@requires_client_login
+def token_verify():
+    token = request.form.get('access_token')
+    client_resource = request.form.get('resource')  # Can only be a single resource
+    if not client_resource:
+        # No resource specified by caller
+        return resource_error('no_resource')
+    if not token:
+        # No token specified by caller
+        return resource_error('no_token')
+
+    authtoken = AuthToken.get_cached(token=token)
+    result = verify_token_resource(authtoken, client_resource)
+    return api_result(result.pop('status'), **result)
+
+
+@lastuser_oauth.route('/api/1/token/verify_bulk', methods=['POST'])
+@requires_client_login
+def token_verify_bulk():
+    """
+    Verify multiple tokens at once. Accepts matching lists of ``access_token[]`` and
+    ``resource[]`` and returns a list of results, one per pair, in the same format
+    as :func:`token_verify`.
+    """
+    tokens = request.form.getlist('access_token[]')
+    client_resources = request.form.getlist('resource[]')
+    if not client_resources:
+        return resource_error('no_resource')
+    if not tokens:
+        return resource_error('no_token')
+    if len(tokens) != len(client_resources):
+        return resource_error('invalid_request', "Tokens and resources must be provided in pairs")
+    limit = current_app.config.get('VERIFY_BULK_MAX', VERIFY_BULK_MAX)
+    if len(tokens) > limit:
+        return resource_error('invalid_request', "At most {limit} tokens may be verified at once".format(
+            limit=limit))
+
+    authtokens = AuthToken.all_cached(tokens)
+    # Load users and clients into the session in one query each, so that
+    # snapshot.user and snapshot.client don't query once per token, and then
+    # the users' information in one query per kind of item.
+    # The session only holds weak references, so keep them in this list until we're done
+    preloaded = []
+    permissions = {}
+    if authtokens:
+        user_ids = set(t.user_id for t in authtokens.values() if t.user_id is not None)
+        if user_ids:
+            users = User.query.filter(User.id.in_(user_ids)).all()
+            preloaded.extend(users)
+            scope = set()
+            for t in authtokens.values():
+                scope.update(t.scope)
+            permissions = preload_userinfo(users, g.client, scope)
+        preloaded.extend(Client.query.filter(Client.id.in_(set(t.client_id for t in authtokens.values()))).all())
+
+    # A user may appear in several pairs. Build their information once per scope
+    userinfos = {}
+
+    def userinfo(user, scope):
+        if (user.id, scope) not in userinfos:
+            userinfos[user.id, scope] = get_userinfo(user, g.client, scope=scope, permissions=permissions)
+        return userinfos[user.id, scope]
+
+    results = []
+    for token, client_resource in zip(tokens, client_resources):
+        result = verify_token_resource(authtokens.get(token), client_resource, userinfo)
+        result['access_token'] = token
+        result['resource'] = client_resource
+        results.append(result)
+    del preloaded
+    return api_result('ok', results=results)
 
 
 @lastuser_oauth.route('/api/1/user/get_by_userid', methods=['GET', 'POST'])
@@ -190,7 +317,7 @@ def user_get_by_userids(userid):
              'buid': o.userid,
              'userid': o.userid,
              'name': o.name,
-             'title': o.fullname,
+             'title': o.title,
              'label': o.pickername} for o in orgs]
         )
 
@@ -227,24 +354,18 @@ def user_getall(name):
     Returns users with the given username, email address or Twitter id
     """
     names = name
-    userids = set()  # Dupe checker
     if not names:
         return api_result('error', error='no_name_provided')
-    results = []
-    for name in names:
-        user = getuser(name)
-        if user and user.userid not in userids:
-            results.append({
-                'type': 'user',
-                'userid': user.userid,
-                'buid': user.userid,
-                'name': user.username,
-                'title': user.fullname,
-                'label': user.pickername,
-                'timezone': user.timezone,
-                'oldids': [o.userid for o in user.oldids],
-                })
-            userids.add(user.userid)
+    results = [{
+        'type': 'user',
+        'userid': user.userid,
+        'buid': user.userid,
+        'name': user.username,
+        'title': user.fullname,
+        'label': user.pickername,
+        'timezone': user.timezone,
+        'oldids': [o.userid for o in user.oldids],
+        } for user in getusers(names)]
     if not results:
         return api_result('error', error='not_found')
     else:
@@ -277,7 +398,7 @@ def org_team_get():
     """
     Returns a list of teams in the given organization.
     """
-    if not g.client.team_access:
+    if not g.client_snapshot.team_access:
         return api_result('error', error='no_team_access')
     org_userids = request.values.getlist('org')
     if not org_userids:
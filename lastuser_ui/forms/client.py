@@ -37,6 +37,9 @@ class RegisterClientForm(Form):
     notification_uri = wtforms.fields.html5.URLField('Notification URL', validators=[wtforms.validators.Optional(), wtforms.validators.URL()],
         description="When the user's data changes, Lastuser will POST a notice to this URL. "
             "Other notices may be posted too")
+    notification_batch = wtforms.BooleanField('Batch notifications', default=False,
+        description="Send multiple notices in a single JSON request to the notification URL, "
+            "as {\"notices\": [...]}, instead of one form-encoded request per notice")
     iframe_uri = wtforms.fields.html5.URLField('IFrame URL', validators=[wtforms.validators.Optional(), wtforms.validators.URL()],
         description="Front-end notifications URL. This is loaded in a hidden iframe to notify the app that the "
             "user updated their profile in some way (not yet implemented)")
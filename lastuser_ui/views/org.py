@@ -31,8 +31,9 @@ def org_new():
         form.populate_obj(org)
         org.owners.users.append(g.user)
         db.session.add(org)
-        db.session.commit()
+        db.session.flush()  # Get an id for the event
         org_data_changed.send(org, changes=['new'], user=g.user)
+        db.session.commit()
         return render_redirect(url_for('.org_info', name=org.name), code=303)
     return render_form(form=form, title="New Organization", formid="org_new", submit="Create", ajax=False)
 
@@ -54,8 +55,8 @@ def org_edit(org):
     form.description.description = current_app.config.get('ORG_DESCRIPTION_REASON')
     if form.validate_on_submit():
         form.populate_obj(org)
-        db.session.commit()
         org_data_changed.send(org, changes=['edit'], user=g.user)
+        db.session.commit()
         return render_redirect(url_for('.org_info', name=org.name), code=303)
     return render_form(form=form, title="New Organization", formid="org_edit", submit="Save", ajax=False)
 
@@ -65,7 +66,7 @@ def org_edit(org):
 @load_model(Organization, {'name': 'name'}, 'org', permission='delete')
 def org_delete(org):
     if request.method == 'POST':
-        # FIXME: Find a better way to do this
+        # Recorded in the session, so it's dropped if the delete isn't confirmed
         org_data_changed.send(org, changes=['delete'], user=g.user)
     return render_delete_sqla(org, db, title=u"Confirm delete", message=u"Delete organization ‘{title}’? ".format(
             title=org.title),
@@ -92,8 +93,9 @@ def team_new(org):
         if form.users.data:
             team.users = User.query.filter(User.userid.in_(form.users.data)).all()
         db.session.add(team)
-        db.session.commit()
+        db.session.flush()  # Get an id for the event
         team_data_changed.send(team, changes=['new'], user=g.user)
+        db.session.commit()
         return render_redirect(url_for('.org_info', name=org.name), code=303)
     return make_response(render_template('edit_team.html', form=form, title=u"Create new team",
         formid='team_new', submit="Create"))
@@ -114,8 +116,8 @@ def team_edit(org, team):
         team.title = form.title.data
         if form.users.data:
             team.users = User.query.filter(User.userid.in_(form.users.data)).all()
-        db.session.commit()
         team_data_changed.send(team, changes=['edit'], user=g.user)
+        db.session.commit()
         return render_redirect(url_for('.org_info', name=org.name), code=303)
     return make_response(render_template(u'edit_team.html', form=form,
         title=u"Edit team: {title}".format(title=team.title),
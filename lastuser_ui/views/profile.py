@@ -47,10 +47,10 @@ def add_email():
         if useremail is None:
             useremail = UserEmailClaim(user=g.user, email=form.email.data)
             db.session.add(useremail)
-            db.session.commit()
         send_email_verify_link(useremail)
-        flash("We sent you an email to confirm your address.", 'success')
         user_data_changed.send(g.user, changes=['email-claim'])
+        db.session.commit()
+        flash("We sent you an email to confirm your address.", 'success')
         return render_redirect(url_for('.profile'), code=303)
     return render_form(form=form, title="Add an email address", formid="email_add", submit="Add email", ajax=True)
 
@@ -82,9 +82,9 @@ def add_phone():
             userphone = UserPhoneClaim(user=g.user, phone=form.phone.data)
             db.session.add(userphone)
         send_phone_verify_code(userphone)
-        db.session.commit()  # Commit after sending because send_phone_verify_code saves the message sent
-        flash("We sent a verification code to your phone number.", 'success')
         user_data_changed.send(g.user, changes=['phone-claim'])
+        db.session.commit()  # Commit after queueing, so that the message is sent
+        flash("We sent a verification code to your phone number.", 'success')
         return render_redirect(url_for('.verify_phone', number=userphone.phone), code=303)
     return render_form(form=form, title="Add a phone number", formid="phone_add", submit="Add phone", ajax=True)
 
@@ -118,9 +118,9 @@ def verify_phone(phoneclaim):
             userphone = UserPhone(user=g.user, phone=phoneclaim.phone, gets_text=True, primary=primary)
             db.session.add(userphone)
             db.session.delete(phoneclaim)
+            user_data_changed.send(g.user, changes=['phone'])
             db.session.commit()
             flash("Your phone number has been verified.", 'success')
-            user_data_changed.send(g.user, changes=['phone'])
             return render_redirect(url_for('.profile'), code=303)
         else:
             db.session.delete(phoneclaim)
@@ -4,77 +4,277 @@
 Adds support for texting Indian mobile numbers
 """
 
-from datetime import datetime
+from datetime import datetime, timedelta
 from pytz import timezone
 import requests
-# from urllib2 import urlopen, URLError
-# from urllib import urlencode
+from requests.adapters import HTTPAdapter
+from sqlalchemy import event
+from sqlalchemy.orm import Session
 
-from flask import current_app, flash, request
+from flask import current_app, request
+from flask.ext.rq import job
 from lastuser_core.models import db, SMSMessage, SMS_STATUS
+from lastuser_core.jobs import with_app_context, enqueue_in
 from .. import lastuser_ui
 
 # SMS GupShup sends delivery reports with this timezone
 SMSGUPSHUP_TIMEZONE = timezone('Asia/Kolkata')
 
+#: Seconds to wait for a gateway to accept a connection and to respond
+SMS_TIMEOUT = (5, 15)
+#: Attempts to send through each gateway before failing over to the next
+SMS_ATTEMPTS = 3
+#: Seconds to wait before the first retry, doubling for each retry after
+SMS_BACKOFF = 2
+#: Seconds after which a message claimed for sending is queued again, in case the
+#: worker sending it died
+SMS_CLAIM_TIMEOUT = 600
 
-def send_message(msg):
-    if msg.phone_number.startswith('+91'):  # Indian number. Use Exotel
-        if len(msg.phone_number) != 13:
-            raise ValueError("Invalid Indian mobile number")
-        # All okay. Send!
-        if not (current_app.config.get('SMS_EXOTEL_SID') and current_app.config.get('SMS_EXOTEL_TOKEN')):
-            raise ValueError("Lastuser is not configured for SMS")
-        else:
-            sid = current_app.config['SMS_EXOTEL_SID']
-            token = current_app.config['SMS_EXOTEL_TOKEN']
-            r = requests.post('https://twilix.exotel.in/v1/Accounts/{sid}/Sms/send.json'.format(sid=sid),
-                auth=(sid, token),
-                data={
-                    'From': current_app.config.get('SMS_FROM'),
-                    'To': msg.phone_number,
-                    'Body': msg.message
-                })
-            if r.status_code in (200, 201):
-                # All good
-                msg.transaction_id = r.json().get('SMSMessage', {}).get('Sid')
-            else:
-                # FIXME: This function should not be sending messages to the UI
-                flash("Message could not be sent.", 'danger')
-
-        # # TODO: Also check if we have SMS GupShup credentials in settings.py
-        # params = urlencode(dict(
-        #     method='SendMessage',
-        #     send_to=msg.phone_number[1:],  # Number with leading +
-        #     msg=msg.message,
-        #     msg_type='TEXT',
-        #     format='text',
-        #     v='1.1',
-        #     auth_scheme='plain',
-        #     userid=current_app.config['SMS_SMSGUPSHUP_USER'],
-        #     password=current_app.config['SMS_SMSGUPSHUP_PASS'],
-        #     mask=current_app.config['SMS_SMSGUPSHUP_MASK']
-        #     ))
-        # try:
-        #     response = urlopen('https://enterprise.smsgupshup.com/GatewayAPI/rest?%s' % params).read()
-        #     r_status, r_phone, r_id = [item.strip() for item in response.split('|')]
-        #     if r_status == 'success':
-        #         msg.status = SMS_STATUS.PENDING
-        #         msg.transaction_id = r_id
-        # except URLError, e:
-        #     # FIXME: This function should not be sending messages to the UI
-        #     flash("Message could not be sent. Error: %s" % e)
-    else:
-        # Unsupported at this time
-        raise ValueError("Unsupported phone number")
+#: HTTP session that keeps connections to gateways alive
+sms_session = requests.Session()
+sms_session.mount('https://', HTTPAdapter(pool_maxsize=4))
+sms_session.mount('http://', HTTPAdapter(pool_maxsize=4))
+
+
+class SMSError(Exception):
+    """
+    The gateway could not take the message right now. Worth trying again.
+    """
+    pass
+
+
+class SMSRejected(SMSError):
+    """
+    The gateway refused the message. Try another gateway instead.
+    """
+    pass
+
+
+class SMSProvider(object):
+    """
+    Base class for SMS gateways. Subclasses implement :meth:`send`, and are
+    registered in :data:`sms_providers` and enabled with the ``SMS_PROVIDERS``
+    setting.
+
+    :param config: App config
+    """
+    #: Name recorded against messages sent through this gateway
+    name = None
+
+    def __init__(self, config):
+        self.config = config
+
+    def configured(self):
+        """
+        Are the credentials for this gateway available?
+        """
+        return True
+
+    def supports(self, phone_number):
+        """
+        Can this gateway text this number?
+        """
+        return phone_number.startswith('+91') and len(phone_number) == 13
+
+    def send(self, msg):
+        """
+        Hand a message to the gateway and return the gateway's id for it. Raise
+        :class:`SMSError` or :class:`SMSRejected` if it wasn't accepted.
+        """
+        raise NotImplementedError
+
+    def request(self, method, url, **kwargs):
+        try:
+            r = sms_session.request(method, url, timeout=SMS_TIMEOUT, **kwargs)
+        except requests.RequestException as e:
+            raise SMSError(repr(e))
+        if r.status_code >= 500:
+            raise SMSError("HTTP {code}".format(code=r.status_code))
+        elif r.status_code >= 400:
+            raise SMSRejected("HTTP {code}".format(code=r.status_code))
+        return r
+
+
+class ExotelProvider(SMSProvider):
+    name = 'exotel'
+
+    def configured(self):
+        return bool(self.config.get('SMS_EXOTEL_SID') and self.config.get('SMS_EXOTEL_TOKEN'))
+
+    def send(self, msg):
+        sid = self.config['SMS_EXOTEL_SID']
+        data = {
+            'From': self.config.get('SMS_FROM'),
+            'To': msg.phone_number,
+            'Body': msg.message,
+            }
+        if self.config.get('SMS_EXOTEL_CALLBACK'):
+            data['StatusCallback'] = self.config['SMS_EXOTEL_CALLBACK']
+        r = self.request('POST', self.config.get('SMS_EXOTEL_URL',
+                'https://twilix.exotel.in/v1/Accounts/{sid}/Sms/send.json').format(sid=sid),
+            auth=(sid, self.config['SMS_EXOTEL_TOKEN']), data=data)
+        return r.json().get('SMSMessage', {}).get('Sid')
+
+
+class SMSGupShupProvider(SMSProvider):
+    name = 'smsgupshup'
+
+    def configured(self):
+        return bool(self.config.get('SMS_SMSGUPSHUP_USER') and self.config.get('SMS_SMSGUPSHUP_PASS'))
+
+    def send(self, msg):
+        r = self.request('GET', self.config.get('SMS_SMSGUPSHUP_URL',
+                'https://enterprise.smsgupshup.com/GatewayAPI/rest'),
+            params=dict(
+                method='SendMessage',
+                send_to=msg.phone_number[1:],  # Number without leading +
+                msg=msg.message,
+                msg_type='TEXT',
+                format='text',
+                v='1.1',
+                auth_scheme='plain',
+                userid=self.config['SMS_SMSGUPSHUP_USER'],
+                password=self.config['SMS_SMSGUPSHUP_PASS'],
+                mask=self.config.get('SMS_SMSGUPSHUP_MASK')))
+        r_status, r_phone, r_id = ([item.strip() for item in r.text.split('|')] + [None, None])[:3]
+        if r_status != 'success':
+            raise SMSRejected(r.text)
+        return r_id
+
+
+#: SMS gateways by name. Add to this to support another gateway
+sms_providers = {
+    'exotel': ExotelProvider,
+    'smsgupshup': SMSGupShupProvider,
+    }
+
+
+def get_sms_providers(phone_number):
+    """
+    Return configured gateways that can text this number, in the order of
+    preference given in the ``SMS_PROVIDERS`` setting.
+    """
+    config = current_app.config
+    providers = [sms_providers[name](config) for name in config.get('SMS_PROVIDERS', ['exotel'])]
+    return [p for p in providers if p.configured() and p.supports(phone_number)]
 
 
 def send_phone_verify_code(phoneclaim):
     msg = SMSMessage(phone_number=phoneclaim.phone,
         message=current_app.config['SMS_VERIFICATION_TEMPLATE'].format(code=phoneclaim.verification_code))
-    # Now send this
-    send_message(msg)
+    queue_sms(msg)
+    return msg
+
+
+def queue_sms(msg):
+    """
+    Add a message to the outbound queue. It is sent by a background job once the
+    database session is committed.
+    """
+    if not get_sms_providers(msg.phone_number):
+        raise ValueError("Lastuser is not configured for SMS to this number")
+    msg.status = SMS_STATUS.QUEUED
     db.session.add(msg)
+    db.session.info['sms_queued'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def _sms_committed(session):
+    if session.info.pop('sms_queued', False) and db.get_app().config.get('QUEUE_SMS', True):
+        send_queued_sms.delay()
+
+
+@event.listens_for(Session, 'after_rollback')
+def _sms_discarded(session):
+    session.info.pop('sms_queued', None)
+
+
+@job("lastuser")
+@with_app_context
+def send_queued_sms():
+    """
+    Send all queued messages. Each message is claimed before sending, so concurrent
+    jobs don't send it twice. Messages whose claim is older than
+    :data:`SMS_CLAIM_TIMEOUT` are queued again.
+    """
+    SMSMessage.query.filter(SMSMessage.status == SMS_STATUS.SENDING,
+        SMSMessage.updated_at < datetime.utcnow() - timedelta(seconds=SMS_CLAIM_TIMEOUT)).update(
+        {'status': SMS_STATUS.QUEUED}, synchronize_session=False)
+    db.session.commit()
+    pending = [msg_id for (msg_id,) in db.session.query(SMSMessage.id).filter_by(
+        status=SMS_STATUS.QUEUED).order_by(SMSMessage.id)]
+    for msg_id in pending:
+        # Messages are SENDING until a gateway takes them. Claiming updates
+        # updated_at, which times the claim out
+        claimed = SMSMessage.query.filter_by(id=msg_id, status=SMS_STATUS.QUEUED).update(
+            {'status': SMS_STATUS.SENDING}, synchronize_session=False)
+        db.session.commit()
+        if claimed:
+            deliver_sms(SMSMessage.query.get(msg_id))
+
+
+@job("lastuser")
+@with_app_context
+def send_claimed_sms(msg_id, provider, attempt):
+    """
+    Try sending a claimed message again, from the given gateway and attempt.
+    """
+    msg = SMSMessage.query.get(msg_id)
+    if msg is not None and msg.status == SMS_STATUS.SENDING:
+        deliver_sms(msg, provider, attempt)
+
+
+def deliver_sms(msg, provider=None, attempt=1):
+    """
+    Send a message through the first gateway that takes it. A gateway that can't
+    take the message right now is tried again by a job scheduled after a delay
+    that doubles with each attempt, and after :data:`SMS_ATTEMPTS` the next gateway
+    is tried. The message is PENDING once a gateway takes it, until the gateway
+    reports delivery, or is marked FAILED if no gateway took it. Returns True if a
+    gateway took the message, False if it failed, and None if it will be retried.
+
+    :param msg: :class:`SMSMessage` to send
+    :param str provider: Name of the gateway to continue from, if not the first
+    :param int attempt: Number of this attempt with that gateway, counting from 1
+    """
+    providers = get_sms_providers(msg.phone_number)
+    names = [p.name for p in providers]
+    if provider in names:
+        providers = providers[names.index(provider):]
+    else:
+        attempt = 1
+    error = u"No gateway"
+    for gateway in providers:
+        try:
+            transaction_id = gateway.send(msg)
+        except SMSError as e:
+            error = u"{name}: {error}".format(name=gateway.name, error=unicode(e))
+            if not isinstance(e, SMSRejected) and attempt < SMS_ATTEMPTS:
+                enqueue_in(SMS_BACKOFF * 2 ** (attempt - 1), send_claimed_sms, msg.id, gateway.name, attempt + 1)
+                return None
+            attempt = 1  # Fail over to the next gateway
+        else:
+            msg.transaction_id = transaction_id
+            msg.provider = unicode(gateway.name)
+            update_sms_status(msg, SMS_STATUS.PENDING)
+            db.session.commit()
+            return True
+    update_sms_status(msg, SMS_STATUS.FAILED, error)
+    db.session.commit()
+    return False
+
+
+def update_sms_status(msg, status, reason=None, status_at=None):
+    """
+    Move a message to a new state. Messages that were DELIVERED or FAILED stay
+    that way. Returns True if the state changed.
+    """
+    if msg.status in (SMS_STATUS.DELIVERED, SMS_STATUS.FAILED):
+        return False
+    msg.status = status
+    msg.fail_reason = reason[:25] if reason else None
+    msg.status_at = status_at or datetime.utcnow()
+    return True
 
 
 @lastuser_ui.route('/report/smsgupshup')
@@ -92,18 +292,33 @@ def report_smsgupshup():
     elif msg.phone_number != '+' + phoneNo:
         return "Incorrect phone number", 404
     else:
+        status_at = None
+        if deliveredTS:
+            # This delivery time is in IST, GMT+0530
+            # Convert this into a naive UTC timestamp before saving
+            local_status_at = datetime.fromtimestamp(float(deliveredTS) / 1000.0)
+            status_at = local_status_at - SMSGUPSHUP_TIMEZONE.utcoffset(local_status_at)
         if status == 'SUCCESS':
-            msg.status = SMS_STATUS.DELIVERED
+            update_sms_status(msg, SMS_STATUS.DELIVERED, cause, status_at)
         elif status == 'FAIL':
-            msg.status = SMS_STATUS.FAILED
+            update_sms_status(msg, SMS_STATUS.FAILED, cause, status_at)
         else:
-            msg.status == SMS_STATUS.UNKNOWN
-        msg.fail_reason = cause
-        if deliveredTS:
-            deliveredTS = float(deliveredTS) / 1000.0
-        # This delivery time is in IST, GMT+0530
-        # Convert this into a naive UTC timestamp before saving
-        local_status_at = datetime.fromtimestamp(deliveredTS)
-        msg.status_at = local_status_at - SMSGUPSHUP_TIMEZONE.utcoffset(local_status_at)
+            update_sms_status(msg, SMS_STATUS.UNKNOWN, cause, status_at)
+    db.session.commit()
+    return "Status updated"
+
+
+@lastuser_ui.route('/report/exotel', methods=['POST'])
+def report_exotel():
+    msg = SMSMessage.query.filter_by(transaction_id=request.form.get('SmsSid')).first()
+    if not msg:
+        return "No such message", 404
+    status = request.form.get('Status')
+    if status == 'sent':
+        update_sms_status(msg, SMS_STATUS.DELIVERED)
+    elif status in ('failed', 'failed-dnd'):
+        update_sms_status(msg, SMS_STATUS.FAILED, status)
+    elif status not in ('queued', 'sending', 'submitted'):  # Still in progress
+        update_sms_status(msg, SMS_STATUS.UNKNOWN, status)
     db.session.commit()
     return "Status updated"
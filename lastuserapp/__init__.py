@@ -7,6 +7,8 @@ from baseframe import baseframe, assets, Version
 
 import lastuser_core, lastuser_oauth, lastuser_ui
 from lastuser_core import login_registry
+from lastuser_core.cache import init_cache
+from lastuser_core.passwords import init_passwords
 from lastuser_core.models import db
 from lastuser_oauth import providers
 from ._version import __version__
@@ -29,6 +31,8 @@ def init_for(env):
     coaster.app.init_app(app, env)
     db.init_app(app)
     db.app = app  # To make it work without an app context
+    init_cache(app)
+    init_passwords(app)
     RQ(app)  # Pick up RQ configuration from the app
     baseframe.init_app(app, requires=['baseframe-bs3', 'jquery.cookie', 'timezone', 'lastuser-oauth'])
 
@@ -25,7 +25,7 @@ def organization_links(self):
     """
     return [{
         'link': url_for('lastuser_ui.org_info', name=org.name),
-        'title': org.title} for org in self.organizations_owned()]
+        'title': org.title} for org in self.memberships() if org.is_owner]
 
 User.profile_url = property(profile_url)
 User.organization_links = organization_links
@@ -1,11 +1,73 @@
 #!/usr/bin/env python
 
-from coaster.manage import init_manager
+import sys
+
+from coaster.manage import init_manager, manager
 
 from lastuser_core.models import db
 from lastuserapp import app, init_for
 
 
+@manager.option('-e', '--env', default='dev', help="runtime environment [default 'dev']")
+@manager.option('-b', '--batch', default=1000, type=int, help="rows to delete per transaction [default 1000]")
+@manager.option('-q', '--queue', action='store_true', help="run on the 'lastuser' RQ queue instead of here")
+def sweep(env, batch, queue):
+    """Delete expired auth codes, tokens, password reset requests, flash messages and emails"""
+    from lastuser_core.expiry import sweep_expired
+    manager.init_for(env)
+    if queue:
+        with manager.app.app_context():
+            sweep_expired.delay(batch)
+        print "Sweep queued"
+    else:
+        for table, count, seconds in sweep_expired(batch):
+            print "%s: deleted %d in %.2fs" % (table, count, seconds)
+
+
+@manager.option('-e', '--env', default='dev', help="runtime environment [default 'dev']")
+@manager.option('-v', '--verbose', action='store_true', help="print the statement and plan for every query")
+def explain(env, verbose):
+    """Check that queries on the login and token paths use indexes"""
+    from lastuser_core.explain import explain_queries
+    manager.init_for(env)
+    unexpected = 0
+    with manager.app.app_context():
+        for label, statement, lines, scans, scan_expected in explain_queries():
+            flagged = scans and not scan_expected
+            unexpected += flagged
+            print "%s %s" % ('SCAN' if flagged else 'ok  ', label)
+            if verbose or flagged:
+                print "    " + " ".join(statement.split())
+                for line in lines:
+                    print "      " + line
+    if unexpected:
+        print "%d queries scan a table" % unexpected
+        sys.exit(1)
+
+
+@manager.option('-e', '--env', default='dev', help="runtime environment [default 'dev']")
+@manager.option('-n', '--dry-run', action='store_true', help="count the rows that would move, without merging")
+@manager.option('name2', help="username or email address of the other account")
+@manager.option('name1', help="username or email address of an account")
+def merge(env, name1, name2, dry_run):
+    """Merge two user accounts into the older one"""
+    from lastuser_core.models import getuser, merge_users, merge_report
+    from lastuser_core.signals import user_data_changed
+    manager.init_for(env)
+    with manager.app.app_context():
+        user1, user2 = getuser(name1), getuser(name2)
+        if user1 is None or user2 is None or user1 == user2:
+            print "Need two different active accounts"
+            sys.exit(1)
+        for table, rows, duplicates in merge_report(user1, user2):
+            print "%s: %d rows, %d merged into existing rows" % (table, rows, duplicates)
+        if not dry_run:
+            user = merge_users(user1, user2)
+            user_data_changed.send(user, changes=['merge'])
+            db.session.commit()
+            print "Merged into %s" % user.pickername
+
+
 if __name__ == "__main__":
     db.init_app(app)
     manager = init_manager(app, db, init_for)
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+
+from lastuserapp import app, db
+import lastuser_core.models as models
+from lastuser_core.authcode import AuthCodeGrant, auth_code_stores
+from .test_db import TestDatabaseFixture
+
+
+class TestAuthCodeStore(TestDatabaseFixture):
+    def save_grant(self, store):
+        self.user = models.User.query.filter_by(username=u"user1").first()
+        self.client = models.Client.query.first()
+        grant = AuthCodeGrant.make(user=self.user, client=self.client, scope=models.Scope([u'id']),
+            redirect_uri=u'http://example.com/')
+        store.save(grant)
+        db.session.commit()
+        return grant
+
+    def test_sql(self):
+        store = auth_code_stores['sql']
+        with app.app_context():
+            grant = self.save_grant(store)
+            self.assertIsNone(store.redeem(grant.code, self.client.id + 1))
+            redeemed = store.redeem(grant.code, self.client.id)
+            db.session.commit()
+            self.assertEqual((redeemed.user, redeemed.scope), (self.user, grant.scope))
+            self.assertIsNone(store.redeem(grant.code, self.client.id))
+        self.assertEqual(models.AuthCode.query.count(), 0)
+
+    def test_cache(self):
+        store = auth_code_stores['cache']
+        with app.app_context():
+            grant = self.save_grant(store)
+            self.assertEqual(store.redeem(grant.code, self.client.id), grant)
+            self.assertIsNone(store.redeem(grant.code, self.client.id))
+            # A code presented by the wrong client is used up
+            grant = self.save_grant(store)
+            self.assertIsNone(store.redeem(grant.code, self.client.id + 1))
+            self.assertIsNone(store.redeem(grant.code, self.client.id))
@@ -1,7 +1,11 @@
 # -*- coding: utf-8 -*-
 
 import unittest
+from base64 import b64encode
+from contextlib import contextmanager
+from sqlalchemy import event
 from lastuserapp import app, db, init_for
+import lastuser_core.models as models
 from .fixtures import make_fixtures
 
 
@@ -18,3 +22,56 @@ class TestDatabaseFixture(unittest.TestCase):
         db.session.rollback()
         db.drop_all()
         db.session.remove()
+
+
+class TestClientAPIFixture(TestDatabaseFixture):
+    """
+    Fixture for API requests made by user1's client app with a token for user1.
+    Requests end by removing the session, so only plain values are kept: the
+    user's ``userid``, the ``token`` and ``refresh_token``, and ``headers`` with
+    the client's credentials.
+    """
+    #: Scope of the token
+    token_scope = [u"id"]
+    #: Validity of the token in seconds, or 0 if it doesn't expire
+    token_validity = 0
+
+    def setUp(self):
+        super(TestClientAPIFixture, self).setUp()
+        user = models.User.query.filter_by(username=u"user1").first()
+        client = models.Client.query.filter_by(user=user).first()
+        authtoken = models.AuthToken(user=user, client=client, scope=self.token_scope,
+            validity=self.token_validity)
+        db.session.add(authtoken)
+        db.session.commit()
+        self.userid, self.token, self.refresh_token = user.userid, authtoken.token, authtoken.refresh_token
+        self.headers = {'Authorization': 'Basic ' + b64encode('%s:%s' % (client.key, client.secret))}
+
+
+@contextmanager
+def count_queries():
+    """
+    Collect the statements sent to the database in the block into a list.
+    """
+    queries = []
+
+    def count(conn, cursor, statement, *args):
+        queries.append(statement)
+    engine = db.get_engine(app, bind='lastuser')
+    event.listen(engine, 'before_cursor_execute', count)
+    try:
+        yield queries
+    finally:
+        event.remove(engine, 'before_cursor_execute', count)
+
+
+def record_retries(test, module):
+    """
+    Make ``enqueue_in`` in the module record the jobs it is asked to schedule,
+    instead of queueing them, until the test ends. Returns the list it records
+    (seconds, job, args, kwargs) to.
+    """
+    retries = []
+    test.addCleanup(setattr, module, 'enqueue_in', module.enqueue_in)
+    module.enqueue_in = lambda seconds, func, *args, **kwargs: retries.append((seconds, func, args, kwargs))
+    return retries
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+
+from datetime import datetime, timedelta
+from lastuserapp import app, db
+import lastuser_core.models as models
+from lastuser_core.expiry import sweep_expired
+from .test_db import TestDatabaseFixture
+
+
+class TestSweepExpired(TestDatabaseFixture):
+    def test_sweep(self):
+        user = models.User.query.filter_by(username=u"user1").first()
+        client = models.Client.query.first()
+        old = datetime.utcnow() - timedelta(days=30)
+        for created_at in [old, old, datetime.utcnow()]:
+            db.session.add(models.AuthCode(user=user, client=client, redirect_uri=u'http://example.com/',
+                scope=[u'id'], created_at=created_at))
+            db.session.add(models.PasswordResetRequest(user=user, created_at=created_at))
+        db.session.add(models.UserFlashMessage(user=user, category=u'info', message=u"Hi", created_at=old))
+        token = models.AuthToken(user=user, client=client, scope=[u'id'])
+        token.expires_at = old - timedelta(days=30)  # Past the refresh window too
+        db.session.add(token)
+        for status in [models.EMAIL_STATUS.SENT, models.EMAIL_STATUS.FAILED, models.EMAIL_STATUS.QUEUED]:
+            db.session.add(models.EmailMessage(recipient=u"user1@example.com", subject=u"Hi", body=u"Hi",
+                status=status, created_at=old))
+        db.session.commit()
+
+        with app.app_context():
+            report = sweep_expired(batch_size=1)
+        self.assertEqual([(table, count) for table, count, seconds in report],
+            [('authcode', 2), ('authtoken', 1), ('passwordresetrequest', 2), ('userflashmessage', 1),
+            ('emailmessage', 2)])
+        self.assertEqual(models.AuthCode.query.count(), 1)
+        self.assertEqual(models.PasswordResetRequest.query.count(), 1)
+        # Emails still waiting to be sent are kept
+        self.assertEqual([m.status for m in models.EmailMessage.query.all()], [models.EMAIL_STATUS.QUEUED])
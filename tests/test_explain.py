@@ -0,0 +1,14 @@
+# -*- coding: utf-8 -*-
+
+from lastuserapp import app
+from lastuser_core.explain import explain_queries
+from .test_db import TestDatabaseFixture
+
+
+class TestExplain(TestDatabaseFixture):
+    def test_no_table_scans(self):
+        with app.app_context():
+            report = explain_queries()
+        self.assertTrue(report)
+        self.assertEqual([(label, lines) for label, statement, lines, scans, scan_expected in report
+            if scans and not scan_expected], [])
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+from flask import g, session
+from lastuserapp import app, db
+import lastuser_core.models as models
+from lastuser_oauth.views.helpers import (SessionUser, session_user_cache, get_session_user,
+    lookup_current_user)
+from .test_db import TestDatabaseFixture
+
+
+class TestSessionUser(TestDatabaseFixture):
+    def setUp(self):
+        super(TestSessionUser, self).setUp()
+        self.user = models.User.query.filter_by(username=u"user1").first()
+        self.userid = self.user.userid
+
+    def test_lazy_user(self):
+        with app.test_request_context('/'):
+            session['userid'] = self.userid
+            lookup_current_user()
+            self.assertEqual(g.session_user, SessionUser(self.user.id, self.userid))
+            self.assertNotIn('_user', g.__dict__)  # Not loaded until used
+            self.assertEqual(g.user, self.user)
+            self.assertIn('_user', g.__dict__)
+        with app.test_request_context('/'):
+            lookup_current_user()
+            self.assertIsNone(g.session_user)
+            self.assertIsNone(g.user)
+
+    def test_cache(self):
+        self.assertIsNone(session_user_cache.get(self.userid))
+        session_user = get_session_user(self.userid)
+        self.assertEqual(session_user, SessionUser(self.user.id, self.userid))
+        self.assertIs(session_user_cache.get(self.userid), session_user)
+        self.assertIs(get_session_user(self.userid), session_user)
+        # Unknown userids aren't cached
+        self.assertIsNone(get_session_user(u"unknown"))
+        self.assertIsNone(session_user_cache.get(u"unknown"))
+
+    def test_invalidation(self):
+        session_user = get_session_user(self.userid)
+        self.user.status = models.USER_STATUS.SUSPENDED
+        db.session.flush()
+        # Until the commit, other transactions still see the active user
+        self.assertIs(session_user_cache.get(self.userid), session_user)
+        db.session.commit()
+        self.assertIsNone(session_user_cache.get(self.userid))
+        with app.test_request_context('/'):
+            session['userid'] = self.userid
+            lookup_current_user()
+            self.assertIsNone(g.user)  # Suspended users aren't logged in
+
+    def test_invalidation_on_delete(self):
+        user2 = models.User.query.filter_by(username=u"user2").first()
+        userid = user2.userid
+        get_session_user(userid)
+        db.session.delete(user2)
+        db.session.flush()
+        self.assertIsNotNone(session_user_cache.get(userid))
+        db.session.commit()
+        self.assertIsNone(session_user_cache.get(userid))
+        self.assertIsNone(get_session_user(userid))
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+import asyncore
+import smtpd
+from datetime import datetime, timedelta
+from threading import Thread
+from lastuserapp import app, db
+import lastuser_core.models as models
+from lastuser_oauth import mailclient
+from .test_db import TestDatabaseFixture, record_retries
+
+
+class SinkServer(smtpd.SMTPServer):
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+        self.received = []
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.received.append((rcpttos, data))
+
+
+class TestMailClient(TestDatabaseFixture):
+    def setUp(self):
+        super(TestMailClient, self).setUp()
+        self.sink = SinkServer()
+        self.thread = Thread(target=asyncore.loop, kwargs={'timeout': 0.1})
+        self.thread.daemon = True
+        self.thread.start()
+        self.mail = app.extensions['mail']
+        self.mail_config = (self.mail.server, self.mail.port, self.mail.suppress)
+        self.mail.server, self.mail.port = '127.0.0.1', self.sink.socket.getsockname()[1]
+        self.mail.suppress = False
+        self.backoff, mailclient.EMAIL_BACKOFF = mailclient.EMAIL_BACKOFF, 0
+        self.retries = record_retries(self, mailclient)
+        self.user = models.User.query.filter_by(username=u"user1").first()
+
+    def tearDown(self):
+        mailclient.close_smtp_connection()
+        mailclient.EMAIL_BACKOFF = self.backoff
+        self.mail.server, self.mail.port, self.mail.suppress = self.mail_config
+        self.sink.close()
+        self.thread.join()
+        super(TestMailClient, self).tearDown()
+
+    def test_send(self):
+        with app.test_request_context('/reset'):
+            mailclient.send_password_reset_link(u"user1@example.com", self.user, u"secret")
+            mailclient.send_password_reset_link(u"user2@example.com", self.user, u"secret")
+            db.session.commit()
+        self.assertEqual(models.EmailMessage.query.filter_by(status=models.EMAIL_STATUS.QUEUED).count(), 2)
+        mailclient.send_queued_emails()
+        self.assertEqual([rcpttos for rcpttos, data in self.sink.received],
+            [['user1@example.com'], ['user2@example.com']])
+        self.assertIn('/reset/', self.sink.received[0][1])
+        messages = models.EmailMessage.query.order_by(models.EmailMessage.id).all()
+        self.assertEqual([(m.status, m.attempts) for m in messages], [(models.EMAIL_STATUS.SENT, 1)] * 2)
+        self.assertIn(u'<a href=', messages[0].html)
+
+    def test_failure(self):
+        self.sink.close()  # Nothing is listening now
+        with app.test_request_context('/reset'):
+            message = mailclient.send_password_reset_link(u"user1@example.com", self.user, u"secret")
+            db.session.commit()
+            # Each attempt queues the email again and schedules another job, until it's given up on
+            for attempt in range(1, mailclient.EMAIL_ATTEMPTS):
+                self.assertIsNone(mailclient.deliver_email(message))
+                self.assertEqual((message.status, message.attempts), (models.EMAIL_STATUS.QUEUED, attempt))
+            self.assertEqual(self.retries,
+                [(0, mailclient.send_queued_emails, (), {})] * (mailclient.EMAIL_ATTEMPTS - 1))
+            self.assertFalse(mailclient.deliver_email(message))
+            self.assertEqual(message.status, models.EMAIL_STATUS.FAILED)
+            self.assertEqual(message.attempts, mailclient.EMAIL_ATTEMPTS)
+            self.assertTrue(message.error)
+
+    def test_retry_later(self):
+        with app.test_request_context('/reset'):
+            message = mailclient.send_password_reset_link(u"user1@example.com", self.user, u"secret")
+            message.retry_at = datetime.utcnow() + timedelta(minutes=1)
+            db.session.commit()
+            message_id = message.id
+        mailclient.send_queued_emails()
+        self.assertEqual(self.sink.received, [])  # Not due yet
+        message = models.EmailMessage.query.get(message_id)
+        message.retry_at = datetime.utcnow()
+        db.session.commit()
+        mailclient.send_queued_emails()
+        self.assertEqual(len(self.sink.received), 1)
+
+    def test_reclaim(self):
+        with app.test_request_context('/reset'):
+            stuck = mailclient.send_password_reset_link(u"user1@example.com", self.user, u"secret")
+            sending = mailclient.send_password_reset_link(u"user2@example.com", self.user, u"secret")
+            db.session.commit()
+            # One email was claimed by a worker that died, the other is being sent right now
+            stuck.status = sending.status = models.EMAIL_STATUS.SENDING
+            stuck.updated_at = datetime.utcnow() - timedelta(seconds=mailclient.EMAIL_CLAIM_TIMEOUT + 1)
+            db.session.commit()
+            stuck_id, sending_id = stuck.id, sending.id
+        mailclient.send_queued_emails()
+        self.assertEqual([rcpttos for rcpttos, data in self.sink.received], [['user1@example.com']])
+        self.assertEqual(models.EmailMessage.query.get(stuck_id).status, models.EMAIL_STATUS.SENT)
+        self.assertEqual(models.EmailMessage.query.get(sending_id).status, models.EMAIL_STATUS.SENDING)
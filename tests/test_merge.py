@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+
+from datetime import timedelta
+from lastuserapp import db
+import lastuser_core.models as models
+from .test_db import TestDatabaseFixture
+
+
+class TestMergeUsers(TestDatabaseFixture):
+    def test_merge(self):
+        user1 = models.User.query.filter_by(username=u"user1").first()
+        user2 = models.User.query.filter_by(username=u"user2").first()
+        user2.created_at = user1.created_at + timedelta(days=1)
+        client = models.Client.query.first()
+        owners = models.Organization.get(name=u"org").owners
+        owners.users.append(user2)
+        for user, scope, permissions in [(user1, u'id', u'read'), (user2, u'email', u'write')]:
+            db.session.add(models.AuthToken(user=user, client=client, scope=[scope]))
+            db.session.add(models.UserClientPermissions(user=user, client=client, access_permissions=permissions))
+            db.session.add(models.UserEmailClaim(user=user, email=u"claimed@example.com"))
+        db.session.commit()
+        token = models.AuthToken.query.filter_by(user=user2).one().token
+        self.assertEqual(models.AuthToken.get_cached(token).user_id, user2.id)
+
+        report = dict((table, (rows, duplicates)) for table, rows, duplicates in models.merge_report(user2, user1))
+        self.assertEqual(report['authtoken'], (1, 1))
+        self.assertEqual(report['team_membership'], (1, 1))
+        self.assertEqual(report['useremail'], (1, 0))
+        self.assertEqual(models.AuthToken.query.count(), 2)  # Nothing changed yet
+
+        self.assertEqual(models.merge_users(user2, user1), user1)
+        db.session.commit()
+        self.assertEqual(user2.status, models.USER_STATUS.MERGED)
+        self.assertEqual(sorted(e.email for e in user1.emails), [u"user1@example.com", u"user2@example.com"])
+        self.assertEqual(models.AuthToken.query.one().scope, (u'email', u'id'))
+        self.assertEqual(models.AuthToken.get_cached(token), None)
+        self.assertEqual(models.UserClientPermissions.query.one().access_permissions, u'read write')
+        self.assertEqual(models.UserEmailClaim.query.one().user, user1)
+        self.assertEqual(owners.users, [user1])
+        self.assertEqual(models.getuser(u"user2@example.com"), user1)
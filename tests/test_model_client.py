@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
 
-from lastuserapp import db
+import pickle
+from datetime import datetime, timedelta
+from lastuserapp import app, db
+from lastuser_core.cache import shared_cache
 import lastuser_core.models as models
 from .test_db import TestDatabaseFixture
 
@@ -10,6 +13,25 @@ class TestClient(TestDatabaseFixture):
         super(TestClient, self).setUp()
         self.user = models.User.query.filter_by(username=u"user1").first()
 
+    def test_get_cached(self):
+        client = models.Client.query.filter_by(user=self.user).first()
+        snapshot = models.Client.get_cached(client.key)
+        self.assertEqual(snapshot.id, client.id)
+        self.assertTrue(snapshot.secret_is(client.secret))
+        self.assertFalse(snapshot.secret_is(client.secret + u"x"))
+        self.assertIs(models.Client.get_cached(client.key), snapshot)
+        client.active = False
+        db.session.commit()
+        self.assertFalse(models.Client.get_cached(client.key).active)
+        self.assertIsNone(models.Client.get_cached(u"unknown"))
+        # A new secret takes effect once committed
+        snapshot = models.Client.get_cached(client.key)
+        client.secret = u"new secret"
+        db.session.flush()
+        self.assertIs(models.Client.get_cached(client.key), snapshot)
+        db.session.commit()
+        self.assertTrue(models.Client.get_cached(client.key).secret_is(u"new secret"))
+
 
 class TestUserClientPermissions(TestDatabaseFixture):
     def setUp(self):
@@ -61,6 +83,29 @@ class TestResource(TestDatabaseFixture):
         self.assertIs(len(resources), 2)
         self.assertEquals(resources[1].name, u"resource")
 
+    def test_scope_catalog(self):
+        resource = models.scope_catalog.get(u"test_resource")
+        self.assertEqual(resource.client_id, self.client.id)
+        self.assertEqual(resource.actions[u"read"].title, u"Read")
+        self.assertIs(models.scope_catalog.get(u"resource"), models.scope_catalog.resources()[u"resource"])
+        action = models.ResourceAction(name=u"write", title=u"Write", resource=self.client.resources[1])
+        db.session.add(action)
+        db.session.commit()
+        self.assertEqual(sorted(models.scope_catalog.get(u"resource").actions), [u"write"])
+        db.session.delete(self.client.resources[1])
+        db.session.commit()
+        self.assertIsNone(models.scope_catalog.get(u"resource"))
+
+    def test_scope_catalog_version_per_request(self):
+        resources = models.scope_catalog.resources()
+        with app.test_request_context():
+            self.assertIs(models.scope_catalog.resources(), resources)
+            # Another process changes a resource. This request keeps the version it saw first
+            shared_cache.inc(models.scope_catalog.version_key)
+            self.assertIs(models.scope_catalog.resources(), resources)
+        with app.test_request_context():
+            self.assertIsNot(models.scope_catalog.resources(), resources)
+
 
 class TestClientTeamAccess(TestDatabaseFixture):
     def setUp(self):
@@ -100,3 +145,99 @@ class TestPermission(TestDatabaseFixture):
         self.permission = models.Permission(user=self.user, org=self.org, name=u"admin", title=u"admin", allusers=True)
         db.session.add(self.permission)
         db.session.commit()
+
+
+class TestAuthToken(TestDatabaseFixture):
+    def setUp(self):
+        super(TestAuthToken, self).setUp()
+        self.user = models.User.query.filter_by(username=u"user1").first()
+        self.client = models.Client.query.filter_by(user=self.user).first()
+        self.create_fixtures()
+
+    def create_fixtures(self):
+        self.authtoken = models.AuthToken(user=self.user, client=self.client, scope=[u"id"])
+        db.session.add(self.authtoken)
+        db.session.commit()
+
+    def test_get_cached(self):
+        snapshot = models.AuthToken.get_cached(self.authtoken.token)
+        self.assertEqual(snapshot.scope, (u"id",))
+        self.assertEqual(snapshot.user, self.user)
+        self.assertEqual(snapshot.client, self.client)
+        self.assertIs(models.AuthToken.get_cached(self.authtoken.token), snapshot)
+
+    def test_scope(self):
+        scope = models.Scope(u"id  email\r\norganizations")
+        self.assertEqual(scope, (u"email", u"id", u"organizations"))
+        self.assertTrue(u"email" in scope and scope.issuperset([u"id", u"email"]))
+        self.assertFalse(scope.issubset([u"id"]))
+        self.assertEqual(unicode(scope | [u"phone"]), u"email id organizations phone")
+        self.assertEqual(pickle.loads(pickle.dumps(scope, 2)), scope)
+        # Parsed once, and again when the column changes
+        self.assertIs(self.authtoken.scope, self.authtoken.scope)
+        self.authtoken._scope = u"email id"
+        self.assertEqual(self.authtoken.scope, (u"email", u"id"))
+
+    def test_cache_invalidation(self):
+        oldtoken = self.authtoken.token
+        models.AuthToken.get_cached(oldtoken)
+        self.authtoken.add_scope(u"email")
+        db.session.commit()
+        self.assertEqual(models.AuthToken.get_cached(oldtoken).scope, (u"email", u"id"))
+        self.authtoken.refresh()
+        db.session.commit()
+        self.assertIsNone(models.AuthToken.get_cached(oldtoken))
+        self.client.active = False
+        db.session.commit()
+        self.assertFalse(models.AuthToken.get_cached(self.authtoken.token).client_active)
+
+    def test_cache_invalidation_after_commit(self):
+        # Until the commit, other transactions still see the old token and may cache it again
+        token = self.authtoken.token
+        snapshot = models.AuthToken.get_cached(token)
+        self.authtoken.refresh()
+        db.session.flush()
+        self.assertIs(models.AuthToken.get_cached(token), snapshot)
+        db.session.commit()
+        self.assertIsNone(models.AuthToken.get_cached(token))
+        # Changes that are rolled back leave the cache alone
+        snapshot = models.AuthToken.get_cached(self.authtoken.token)
+        self.authtoken.add_scope(u"email")
+        db.session.flush()
+        db.session.rollback()
+        self.assertIs(models.AuthToken.get_cached(self.authtoken.token), snapshot)
+
+    def test_expiry(self):
+        self.assertIsNone(self.authtoken.expires_at)
+        self.assertIsNone(models.AuthToken.get_cached(self.authtoken.token).expires_in())
+        token, refresh_token = self.authtoken.token, self.authtoken.refresh_token
+        self.authtoken.refresh(validity=60)
+        db.session.commit()
+        self.assertNotIn(self.authtoken.token, (token, None))
+        self.assertNotIn(self.authtoken.refresh_token, (refresh_token, None))
+        snapshot = models.AuthToken.get_cached(self.authtoken.token)
+        self.assertTrue(snapshot.is_valid() and 0 < snapshot.expires_in() <= 60)
+        self.authtoken.expires_at = datetime.utcnow() - timedelta(seconds=1)
+        db.session.commit()
+        self.assertFalse(self.authtoken.is_valid())
+        self.assertFalse(models.AuthToken.get_cached(self.authtoken.token).is_valid())
+
+    def test_notice_recipients(self):
+        self.assertEqual(models.notice_recipients(user=self.user), [])
+        self.client.notification_uri = u"http://example.com/notify"
+        org = models.Organization.get(name=u"org")
+        orgclient = models.Client(title=u"Org app", user=self.user, website=u"http://example.org",
+            notification_uri=u"http://example.org/notify")
+        orgtoken = models.AuthToken(user=self.user, client=orgclient, scope=[u"organizations"])
+        db.session.add_all([orgclient, orgtoken])
+        db.session.commit()
+        self.assertEqual(models.notice_recipients(user=self.user), [
+            (self.client.id, u"http://example.com/notify", False, (u"id",), self.user.userid),
+            (orgtoken.client.id, u"http://example.org/notify", False, (u"organizations",), self.user.userid)])
+        self.assertEqual([r.client_id for r in models.notice_recipients(org=org)], [orgtoken.client.id])
+        self.assertEqual(models.notice_recipients(org=org, team_access=True), [])
+
+    def test_all_cached(self):
+        snapshots = models.AuthToken.all_cached([self.authtoken.token, u"unknown"])
+        self.assertEqual(snapshots.keys(), [self.authtoken.token])
+        self.assertEqual(snapshots[self.authtoken.token].user_id, self.user.id)
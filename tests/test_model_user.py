@@ -1,6 +1,11 @@
 # -*- coding: utf-8 -*-
 
-from lastuserapp import db
+import logging
+from time import time
+from sqlalchemy.exc import IntegrityError
+from werkzeug.security import generate_password_hash
+from lastuserapp import app, db
+from lastuser_core.passwords import PasswordHasherBusy
 import lastuser_core.models as models
 from .test_db import TestDatabaseFixture
 
@@ -19,6 +24,19 @@ class TestTeam(TestDatabaseFixture):
         db.session.add(self.team)
         db.session.commit()
 
+    def test_permissions(self):
+        user2 = models.User.query.filter_by(username=u"user2").first()
+        self.assertTrue(set(['edit', 'delete']) <= self.team.permissions(self.user))
+        self.assertFalse('edit' in self.team.permissions(user2))
+        self.assertFalse('edit' in self.org.permissions(user2))
+        self.org.owners.users.append(user2)
+        self.assertTrue('edit' in self.org.permissions(user2))
+        # Not saved yet
+        org = models.Organization(title=u"New", name=u"new")
+        org.owners.users.append(user2)
+        self.assertTrue(org.owner_is(user2))
+        self.assertFalse(org.owner_is(self.user))
+
 
 class TestOrganization(TestDatabaseFixture):
     def setUp(self):
@@ -36,3 +54,162 @@ class TestOrganization(TestDatabaseFixture):
         self.client_team_access1 = models.ClientTeamAccess(org=self.org1, client=self.client, access_level=models.CLIENT_TEAM_ACCESS.ALL)
         db.session.add_all([self.org, self.org1, self.client_team_access, self.client_team_access1])
         db.session.commit()
+
+
+class TestUser(TestDatabaseFixture):
+    def setUp(self):
+        super(TestUser, self).setUp()
+        self.user = models.User.query.filter_by(username=u"user1").first()
+
+    def test_primary_email(self):
+        # The fixture email isn't marked primary, so the first address is promoted
+        self.assertEqual(unicode(self.user.email), u"user1@example.com")
+        self.assertTrue(self.user.email.primary)
+        self.assertEqual(unicode(self.user.phone), u"1234567890")
+
+    def test_organizations_owned(self):
+        org = models.Organization.get(name=u"org")
+        self.assertEqual(self.user.organizations_owned(), [org])
+        self.assertEqual(self.user.organizations_owned_ids(), [org.id])
+
+    def test_memberships(self):
+        org = models.Organization.get(name=u"org")
+        self.assertEqual(self.user.memberships(), (models.OrgMembership(org.id, org.userid, u"org", u"Organization", True),))
+        self.assertEqual(models.user.membership_cache.get(self.user.id), self.user.memberships())
+        user2 = models.User.query.filter_by(username=u"user2").first()
+        org2 = models.Organization(name=u"org2", title=u"Another")
+        org2.owners.users.append(user2)
+        team = models.Team(title=u"Members", org=org2)
+        team.users.append(self.user)
+        db.session.add_all([org2, team])
+        db.session.commit()
+        self.assertEqual(models.user.membership_cache.get(self.user.id), None)
+        self.assertEqual([(m.name, m.is_owner) for m in self.user.memberships()], [(u"org2", False), (u"org", True)])
+        self.assertEqual(self.user.organizations(), [org2, org])
+        org2.title = u"Renamed"
+        db.session.commit()
+        self.assertEqual([m.title for m in self.user.memberships()], [u"Organization", u"Renamed"])
+        db.session.delete(team)
+        db.session.commit()
+        self.assertEqual(self.user.organizations(), [org])
+
+    def test_getusers(self):
+        user2 = models.User.query.filter_by(username=u"user2").first()
+        claimant = models.User(username=u"user3", fullname=u"User 3")
+        db.session.add(claimant)
+        db.session.add(models.UserEmailClaim(user=claimant, email=u"unverified@example.com"))
+        db.session.add(models.UserExternalId(user=user2, service=u"twitter", userid=u"2", username=u"user2"))
+        db.session.add(models.UserOldId(user=self.user, userid=u"oldid"))
+        db.session.commit()
+        names = [u"user2", u"USER1@example.com", u"@user2", u"unverified@example.com", u"user1", u"missing"]
+        users = models.getusers(names)
+        self.assertEqual(users, [user2, self.user, claimant])
+        expected = []
+        for name in names:
+            user = models.getuser(name)
+            if user is not None and user not in expected:
+                expected.append(user)
+        self.assertEqual(users, expected)
+        self.assertEqual([o.userid for o in self.user.oldids], [u"oldid"])
+
+    def test_email_case(self):
+        useremail = models.UserEmail.get(email=u"User1@Example.COM")
+        self.assertEqual(useremail.user, self.user)
+        self.assertEqual(models.getuser(u"USER1@example.com"), self.user)
+        db.session.add(models.UserEmailClaim(user=self.user, email=u"New@Example.com"))
+        db.session.commit()
+        self.assertEqual(models.UserEmailClaim.get(email=u"new@example.com", user=self.user).email, u"New@Example.com")
+        # Addresses that differ only in case can't be added twice
+        db.session.add(models.UserEmail(email=u"USER1@example.com", user=self.user))
+        self.assertRaises(IntegrityError, db.session.commit)
+        db.session.rollback()
+
+    def test_all(self):
+        user2 = models.User.query.filter_by(username=u"user2").first()
+        merged = models.User(username=u"merged", fullname=u"Merged", status=models.USER_STATUS.MERGED)
+        db.session.add(merged)
+        db.session.add(models.UserOldId(user=self.user, userid=merged.userid))
+        db.session.commit()
+        found = models.User.all(userids=[merged.userid, user2.userid, u"missing"], usernames=[u"user1"], mapping=True)
+        self.assertEqual(found, {merged.userid: self.user, user2.userid: user2, u"user1": self.user})
+        self.assertEqual(set(models.User.all(userids=[merged.userid, self.user.userid])), set([self.user]))
+        self.assertEqual([o.userid for o in self.user.oldids], [merged.userid])
+
+    def test_autocomplete(self):
+        user2 = models.User.query.filter_by(username=u"user2").first()
+        user22 = models.User(username=u"user22", fullname=u"Aaron")
+        db.session.add(user22)
+        db.session.commit()
+        # Exact username matches are ranked ahead of the rest, which are ordered by name
+        self.assertEqual(models.User.autocomplete(u"User2"), [user2, user22])
+        self.assertEqual(models.User.autocomplete(u"user"), [user22, self.user, user2])
+        self.assertEqual(models.User.autocomplete(u"aa"), [user22])
+        self.assertEqual(models.User.autocomplete(u"user1@"), [self.user])
+        self.assertEqual(models.User.autocomplete(u"%"), [])
+        self.assertEqual(models.User.autocomplete(u"  "), [])
+
+    def test_autocomplete_indexes(self):
+        # Declared on the models, so that schemas made with create_all have them too
+        self.assertTrue(set(['ix_user_fullname_lower', 'ix_user_username_lower']).issubset(
+            index.name for index in models.User.__table__.indexes))
+        self.assertIn('ix_userexternalid_username_lower',
+            [index.name for index in models.UserExternalId.__table__.indexes])
+
+    def test_password(self):
+        hasher = models.user.password_hasher
+        self.user.password = u"secret"
+        self.assertTrue(self.user.pw_hash.startswith('$2a$%02d$' % hasher.rounds))
+        self.assertTrue(self.user.password_is(u"secret"))
+        self.assertFalse(self.user.password_is(u"wrong"))
+        # Legacy and weaker hashes are upgraded on a successful check
+        self.user.pw_hash = generate_password_hash(u"secret", method='sha1')
+        self.assertTrue(self.user.password_is(u"secret"))
+        self.assertFalse(hasher.needs_rehash(self.user.pw_hash))
+        # No free slot: fail fast with a 503
+        concurrency, timeout = hasher.concurrency, hasher.timeout
+        hasher.concurrency, hasher.timeout = 0, 0
+        try:
+            self.assertRaises(PasswordHasherBusy, self.user.password_is, u"secret")
+        finally:
+            hasher.concurrency, hasher.timeout = concurrency, timeout
+        self.assertEqual(hasher.stats()['active'], 0)
+
+    def test_password_stats_logged(self):
+        hasher = models.user.password_hasher
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        app.logger.addHandler(handler)
+        concurrency, timeout = hasher.concurrency, hasher.timeout
+        try:
+            with app.test_request_context():
+                hasher.log_interval = 60
+                hasher._logged_at, hasher._logged_rejected = time(), hasher.rejected
+                hasher.concurrency, hasher.timeout = 0, 0
+                self.assertRaises(PasswordHasherBusy, hasher.hash, u"secret")
+                hasher.concurrency, hasher.timeout = concurrency, timeout
+                hasher.hash(u"secret")
+                self.assertEqual(records, [])  # Not due yet
+                hasher._logged_at -= 60
+                hasher.hash(u"secret")
+        finally:
+            app.logger.removeHandler(handler)
+            hasher.concurrency, hasher.timeout = concurrency, timeout
+            hasher.log_interval = 0
+        [record] = records
+        self.assertEqual(record.levelno, logging.WARNING)
+        self.assertIn(u"(1 recently)", record.getMessage())
+
+    def test_resolve_user(self):
+        with app.test_request_context():
+            self.assertEqual(models.resolve_user(u"user1"), self.user)
+            self.user.username = u"renamed"
+            db.session.commit()
+            # Memoized for the rest of the request
+            self.assertEqual(models.resolve_user(u"user1"), self.user)
+            self.assertEqual(models.resolve_user(u"missing"), None)
+        with app.test_request_context():
+            self.assertEqual(models.resolve_user(u"user1"), None)
+        self.user.password = u"secret"
+        self.assertTrue(models.check_password(self.user, u"secret"))
+        self.assertFalse(models.check_password(None, u"secret"))
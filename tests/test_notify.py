@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+
+import json
+from threading import Thread
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+import lastuser_core.models as models
+from lastuser_oauth.views import notify
+from .test_db import TestDatabaseFixture, record_retries
+
+
+class NoticeHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.received.append((self.path, self.headers.get('Content-Type'), body))
+        self.send_response(self.server.responses.pop(0) if self.server.responses else 200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class TestDeliverNotice(TestDatabaseFixture):
+    def setUp(self):
+        super(TestDeliverNotice, self).setUp()
+        self.server = HTTPServer(('127.0.0.1', 0), NoticeHandler)
+        self.server.received = []
+        self.server.responses = []
+        self.thread = Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = u'http://127.0.0.1:%d/notify' % self.server.server_port
+        self.retries = record_retries(self, notify)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        super(TestDeliverNotice, self).tearDown()
+
+    def test_deliver(self):
+        self.assertTrue(notify.deliver_notice(self.url, data={'userid': 'abc', 'type': 'user'}))
+        self.assertTrue(notify.deliver_notice(self.url, notices=[{'userid': 'abc'}, {'userid': 'def'}]))
+        (path, ctype, body), (bpath, bctype, bbody) = self.server.received
+        self.assertEqual(ctype, 'application/x-www-form-urlencoded')
+        self.assertEqual(bctype, 'application/json')
+        self.assertEqual(json.loads(bbody), {'notices': [{'userid': 'abc'}, {'userid': 'def'}]})
+
+    def test_retry_and_failure(self):
+        self.server.responses = [503, 200]
+        self.assertIsNone(notify.deliver_notice(self.url, data={'userid': 'abc'}))
+        # The retry is queued for later instead of holding up the worker
+        [(seconds, func, args, kwargs)] = self.retries
+        self.assertEqual((seconds, func, kwargs['attempt']), (notify.NOTICE_BACKOFF, notify.send_notice, 2))
+        func(*args, **kwargs)
+        self.assertEqual(len(self.server.received), 2)
+        self.assertEqual(len(self.retries), 1)
+        # Client errors aren't retried, and the notice is recorded as failed
+        self.server.responses = [404]
+        self.assertFalse(notify.deliver_notice(self.url, data={'userid': 'abc'}))
+        failure = models.NoticeFailure.query.one()
+        self.assertEqual((failure.attempts, failure.error), (1, u"HTTP 404"))
+        # So are notices that failed on every attempt
+        self.server.responses = [503]
+        self.assertFalse(notify.deliver_notice(self.url, notices=[{'userid': 'abc'}],
+            attempt=notify.NOTICE_ATTEMPTS))
+        self.assertEqual(len(self.retries), 1)
+        self.assertEqual(models.NoticeFailure.query.count(), 2)
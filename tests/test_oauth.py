@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+from datetime import datetime, timedelta
+import json
+from lastuserapp import app, db
+import lastuser_core.models as models
+from .test_db import TestClientAPIFixture
+
+
+class TestRefreshToken(TestClientAPIFixture):
+    token_scope = [u"id", u"email"]
+    token_validity = 60
+
+    def setUp(self):
+        super(TestRefreshToken, self).setUp()
+        app.config['ACCESS_TOKEN_EXPIRY'] = 3600
+
+    def tearDown(self):
+        app.config.pop('ACCESS_TOKEN_EXPIRY', None)
+        super(TestRefreshToken, self).tearDown()
+
+    def refresh(self, refresh_token, **data):
+        data.update(grant_type='refresh_token', refresh_token=refresh_token)
+        rv = app.test_client().post('/token', headers=self.headers, data=data)
+        return rv.status_code, json.loads(rv.data)
+
+    def test_refresh(self):
+        code, result = self.refresh(self.refresh_token, scope=u"id")
+        self.assertEqual(code, 200)
+        self.assertNotIn(result['access_token'], (self.token, None))
+        self.assertNotIn(result['refresh_token'], (self.refresh_token, None))
+        self.assertEqual(result['scope'], u"email id")  # The token keeps its scope
+        self.assertTrue(3590 < result['expires_in'] <= 3600)
+        authtoken = models.AuthToken.query.filter_by(token=result['access_token']).one()
+        self.assertEqual(authtoken.refresh_token, result['refresh_token'])
+        self.assertIsNone(models.AuthToken.get_cached(self.token))
+        # The new refresh token works in turn
+        code, again = self.refresh(result['refresh_token'])
+        self.assertEqual(code, 200)
+        self.assertNotEqual(again['access_token'], result['access_token'])
+
+    def test_reused(self):
+        code, result = self.refresh(self.refresh_token)
+        self.assertEqual(code, 200)
+        code, result = self.refresh(self.refresh_token)
+        self.assertEqual((code, result['error'], result['error_description']),
+            (400, 'invalid_grant', "Unknown refresh token"))
+
+    def test_expired(self):
+        authtoken = models.AuthToken.query.filter_by(token=self.token).one()
+        authtoken.expires_at = datetime.utcnow() - timedelta(days=31)  # Past the refresh window
+        db.session.commit()
+        code, result = self.refresh(self.refresh_token)
+        self.assertEqual((code, result['error'], result['error_description']),
+            (400, 'invalid_grant', "Expired refresh token"))
+        self.assertEqual(models.AuthToken.query.filter_by(refresh_token=self.refresh_token).one().token, self.token)
+
+    def test_scope_expanded(self):
+        code, result = self.refresh(self.refresh_token, scope=u"id email phone")
+        self.assertEqual((code, result['error']), (400, 'invalid_scope'))
+        self.assertEqual(models.AuthToken.query.filter_by(refresh_token=self.refresh_token).one().token, self.token)
+
+    def test_inactive_user(self):
+        user = models.User.query.filter_by(username=u"user1").one()
+        user.status = models.USER_STATUS.SUSPENDED
+        db.session.commit()
+        code, result = self.refresh(self.refresh_token)
+        self.assertEqual((code, result['error']), (400, 'invalid_grant'))
+        self.assertEqual(models.AuthToken.query.filter_by(refresh_token=self.refresh_token).one().token, self.token)
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+import json
+from lastuserapp import app, db
+from lastuser_core.cache import init_cache
+import lastuser_core.models as models
+from lastuser_core.models.user import membership_cache
+from lastuser_oauth.views.resource import get_userinfo
+from .test_db import TestDatabaseFixture, TestClientAPIFixture, count_queries
+
+
+class TestGetUserinfo(TestDatabaseFixture):
+    def setUp(self):
+        super(TestGetUserinfo, self).setUp()
+        user = models.User.query.filter_by(username=u"user1").first()
+        db.session.add(models.UserClientPermissions(user=user, client=models.Client.query.filter_by(user=user).first(),
+            access_permissions=u"admin"))
+        db.session.commit()
+
+    def add_org(self, name):
+        org = models.Organization(name=name, title=name.title())
+        org.owners.users.append(models.User.query.filter_by(username=u"user2").first())
+        team = models.Team(title=u"Members", org=org)
+        team.users.append(models.User.query.filter_by(username=u"user1").first())
+        db.session.add_all([org, team])
+        db.session.commit()
+
+    def userinfo(self):
+        """
+        Return get_userinfo for user1 loaded afresh, and the number of queries it made.
+        """
+        db.session.remove()
+        user = models.User.query.filter_by(username=u"user1").one()
+        client = models.Client.query.filter_by(user=user).one()
+        membership_cache.delete(user.id)
+        with count_queries() as queries:
+            userinfo = get_userinfo(user, client, scope=models.Scope(u"id email phone organizations"))
+        return userinfo, len(queries)
+
+    def test_userinfo(self):
+        userinfo, queries = self.userinfo()
+        org = models.Organization.get(name=u"org")
+        orginfo = {'userid': org.userid, 'name': u"org", 'title': u"Organization"}
+        self.assertEqual(userinfo, {
+            'userid': models.User.get(username=u"user1").userid,
+            'username': u"user1",
+            'fullname': u"User 1",
+            'timezone': None,
+            'oldids': [],
+            'email': u"user1@example.com",
+            'phone': u"1234567890",
+            'organizations': {'owner': [orginfo], 'member': [orginfo]},
+            'teams': [{'userid': org.owners.userid, 'title': org.owners.title, 'org': org.userid,
+                'owners': True}],
+            'permissions': [u"admin"],
+            })
+        # More organizations and teams don't take more queries
+        self.add_org(u"alpha")
+        self.add_org(u"beta")
+        userinfo, more_queries = self.userinfo()
+        self.assertEqual(len(userinfo['teams']), 3)
+        self.assertEqual([o['name'] for o in userinfo['organizations']['member']], [u"alpha", u"beta", u"org"])
+        self.assertEqual(userinfo['organizations']['owner'], [orginfo])
+        self.assertEqual(more_queries, queries)
+
+
+class TestTokenVerifyBulk(TestClientAPIFixture):
+    token_scope = [u"id", u"test_resource"]
+
+    def tearDown(self):
+        app.config.pop('VERIFY_BULK_MAX', None)
+        super(TestTokenVerifyBulk, self).tearDown()
+
+    def verify(self, tokens, resources):
+        rv = app.test_client().post('/api/1/token/verify_bulk', headers=self.headers,
+            data={'access_token[]': tokens, 'resource[]': resources})
+        return rv.status_code, json.loads(rv.data)
+
+    def test_verify_bulk(self):
+        code, result = self.verify([self.token, u"unknown"], [u"test_resource", u"test_resource"])
+        self.assertEqual(code, 200)
+        self.assertEqual([(r['status'], r['access_token']) for r in result['results']],
+            [('ok', self.token), ('error', u"unknown")])
+        self.assertEqual(result['results'][0]['userinfo']['userid'], self.userid)
+
+    def test_query_count(self):
+        authtoken = models.AuthToken.get(self.token)
+        authtoken.add_scope([u"email", u"phone", u"organizations"])
+        other = models.AuthToken(user=models.User.query.filter_by(username=u"user2").first(),
+            client=authtoken.client, scope=authtoken.scope)
+        db.session.add(other)
+        db.session.commit()
+        other_token = other.token
+
+        def count(tokens):
+            init_cache(app)  # Start each request with empty caches
+            with count_queries() as queries:
+                code, result = self.verify(tokens, [u"test_resource"] * len(tokens))
+            self.assertEqual([r['status'] for r in result['results']], ['ok'] * len(tokens))
+            return len(queries)
+        # More users and pairs don't take more queries
+        self.assertEqual(count([self.token, other_token] * 3), count([self.token]))
+
+    def test_limit(self):
+        app.config['VERIFY_BULK_MAX'] = 2
+        code, result = self.verify([self.token] * 3, [u"test_resource"] * 3)
+        self.assertEqual((code, result['error']), (400, 'invalid_request'))
+        code, result = self.verify([self.token] * 2, [u"test_resource"] * 2)
+        self.assertEqual((code, len(result['results'])), (200, 2))
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+from lastuserapp import db
+import lastuser_core.models as models
+from lastuser_core import signals
+from lastuser_core.signals import org_data_changed, user_data_changed, dispatch_events
+from lastuser_oauth.views import notify
+from .test_db import TestDatabaseFixture, record_retries
+
+
+class TestOutbox(TestDatabaseFixture):
+    def setUp(self):
+        super(TestOutbox, self).setUp()
+        self.user = models.User.query.filter_by(username=u"user1").first()
+        self.received = []
+        org_data_changed.connect(self.receiver)
+
+    def tearDown(self):
+        org_data_changed.disconnect(self.receiver)
+        super(TestOutbox, self).tearDown()
+
+    def receiver(self, org, user, changes):
+        self.received.append((org.userid, db.inspect(org).transient, user.username, changes))
+
+    def test_dispatch(self):
+        org = models.Organization(name=u"events", title=u"Events")
+        org.owners.users.append(self.user)
+        db.session.add(org)
+        db.session.flush()
+        org_data_changed.send(org, changes=['new'], user=self.user)
+        self.assertEqual(self.received, [])
+        db.session.commit()
+        orgid = org.userid
+        dispatch_events()
+        self.assertEqual(self.received, [(orgid, False, u"user1", ['new'])])
+        self.assertEqual(models.Event.pending(), [])
+
+        # Events that aren't committed are dropped
+        org = models.Organization.get(userid=orgid)
+        self.user = models.User.get(username=u"user1")
+        org_data_changed.send(org, changes=['edit'], user=self.user)
+        db.session.rollback()
+        self.assertEqual(models.Event.pending(), [])
+
+        # Receivers get the deleted org rebuilt from the event
+        org_data_changed.send(org, changes=['delete'], user=self.user)
+        db.session.delete(org)
+        db.session.commit()
+        dispatch_events()
+        self.assertEqual(self.received[1], (orgid, True, u"user1", ['delete']))
+        self.assertEqual(models.Event.pending(), [])
+
+    def test_retry(self):
+        retries = record_retries(self, signals)
+        org = models.Organization.get(name=u"org")
+        orgid = org.userid
+        org_data_changed.send(org, changes=['edit'], user=self.user)
+        org_data_changed.send(org, changes=['delete'], user=self.user)
+        db.session.commit()
+        org_data_changed.connect(self.failing_receiver)
+        try:
+            dispatch_events()
+        finally:
+            org_data_changed.disconnect(self.failing_receiver)
+        # The event is tried again later. The next event for the org waits for it
+        self.assertEqual(retries, [(signals.EVENT_RETRY_DELAY, dispatch_events, (100,), {})])
+        pending = models.Event.pending()
+        self.assertEqual([e.attempts for e in pending], [1, 0])
+        self.assertIn(u"ValueError", pending[0].error)
+        dispatch_events()
+        self.assertEqual([changes for o, transient, username, changes in self.received[-2:]], [['edit'], ['delete']])
+        self.assertEqual(models.Event.pending(), [])
+
+    def test_failed(self):
+        retries = record_retries(self, signals)
+        attempts, signals.EVENT_ATTEMPTS = signals.EVENT_ATTEMPTS, 1
+        org = models.Organization.get(name=u"org")
+        org_data_changed.send(org, changes=['edit'], user=self.user)
+        org_data_changed.send(org, changes=['delete'], user=self.user)
+        db.session.commit()
+        org_data_changed.connect(self.failing_receiver)
+        try:
+            dispatch_events()
+        finally:
+            org_data_changed.disconnect(self.failing_receiver)
+            signals.EVENT_ATTEMPTS = attempts
+        # The event is set aside, not marked as dispatched, and not tried again
+        self.assertEqual(retries, [])
+        [event] = models.Event.failed()
+        self.assertIsNone(event.dispatched_at)
+        [pending] = models.Event.pending()
+        self.assertGreater(pending.id, event.id)
+        # The next event for the org waits until the failed event is resolved
+        received = len(self.received)
+        dispatch_events()
+        self.assertEqual(len(self.received), received)
+        event = models.Event.failed()[0]
+        event.failed_at = None
+        db.session.commit()
+        dispatch_events()
+        self.assertEqual([changes for o, transient, username, changes in self.received[received:]],
+            [['edit'], ['delete']])
+        self.assertEqual(models.Event.pending() + models.Event.failed(), [])
+
+    def failing_receiver(self, org, user, changes):
+        raise ValueError("Receiver failed")
+
+
+class TestOutboxNotices(TestDatabaseFixture):
+    def test_merged_notices(self):
+        user = models.User.query.filter_by(username=u"user1").first()
+        client = models.Client.query.filter_by(user=user).first()
+        client.notification_uri = u"http://example.com/notify"
+        db.session.add(models.AuthToken(user=user, client=client, scope=[u"id", u"email"]))
+        db.session.commit()
+        user_data_changed.send(user, changes=['profile'])
+        user_data_changed.send(user, changes=['email', 'profile'])
+        db.session.commit()
+        dispatched = []
+        dispatch_notices, notify.dispatch_notices = notify.dispatch_notices, dispatched.append
+        try:
+            dispatch_events()
+        finally:
+            notify.dispatch_notices = dispatch_notices
+        # Both events reach the app as one notice
+        self.assertEqual(len(dispatched), 1)
+        [(client_id, url, batch, data)] = dispatched[0]
+        self.assertEqual((url, data['type'], data['changes']), (u"http://example.com/notify", 'user',
+            ['profile', 'email']))
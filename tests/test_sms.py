@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+from datetime import datetime, timedelta
+from lastuserapp import app, db
+import lastuser_core.models as models
+from lastuser_ui.views import sms
+from .test_db import TestDatabaseFixture, record_retries
+
+
+class FakeGateway(sms.SMSProvider):
+    name = 'fake'
+    #: Errors to raise, in order, before accepting messages. Set by each test
+    errors = None
+    #: Messages accepted. Set by each test
+    sent = None
+
+    def send(self, msg):
+        if self.errors:
+            raise self.errors.pop(0)
+        self.sent.append((msg.phone_number, msg.message))
+        return u'fake%d' % len(self.sent)
+
+
+class DownGateway(FakeGateway):
+    name = 'down'
+
+    def send(self, msg):
+        raise sms.SMSRejected("Account suspended")
+
+
+class TestSMSDelivery(TestDatabaseFixture):
+    def setUp(self):
+        super(TestSMSDelivery, self).setUp()
+        sms.sms_providers.update({'fake': FakeGateway, 'down': DownGateway})
+        self.providers = app.config.get('SMS_PROVIDERS')
+        app.config['SMS_PROVIDERS'] = ['down', 'fake']
+        FakeGateway.errors = []
+        FakeGateway.sent = []
+        self.retries = record_retries(self, sms)
+        self.client = app.test_client()
+
+    def tearDown(self):
+        FakeGateway.errors = FakeGateway.sent = None
+        app.config['SMS_PROVIDERS'] = self.providers
+        del sms.sms_providers['fake'], sms.sms_providers['down']
+        super(TestSMSDelivery, self).tearDown()
+
+    def test_failover_and_report(self):
+        FakeGateway.errors = [sms.SMSError("Timeout")]
+        with app.app_context():
+            sms.queue_sms(models.SMSMessage(phone_number=u'+919999999999', message=u"Hello"))
+            db.session.commit()
+            sms.send_queued_sms()
+            msg = models.SMSMessage.query.filter_by(phone_number=u'+919999999999').one()
+            self.assertEqual(msg.status, models.SMS_STATUS.SENDING)
+            # The gateway that timed out is tried again later
+            [(seconds, func, args, kwargs)] = self.retries
+            self.assertEqual((seconds, func, args, kwargs),
+                (sms.SMS_BACKOFF, sms.send_claimed_sms, (msg.id, 'fake', 2), {}))
+            func(*args)
+            msg = models.SMSMessage.query.filter_by(phone_number=u'+919999999999').one()
+            self.assertEqual((msg.status, msg.provider, msg.transaction_id),
+                (models.SMS_STATUS.PENDING, u'fake', u'fake1'))
+            self.assertEqual(FakeGateway.sent, [(u'+919999999999', u"Hello")])
+
+        rv = self.client.get('/report/smsgupshup?externalId=fake1&status=SUCCESS&phoneNo=919999999999'
+            '&deliveredTS=1395900000000')
+        self.assertEqual(rv.status_code, 200)
+        rv = self.client.post('/report/exotel', data={'SmsSid': 'fake1', 'Status': 'failed'})
+        self.assertEqual(rv.status_code, 200)
+        msg = models.SMSMessage.query.filter_by(transaction_id=u'fake1').one()
+        self.assertEqual(msg.status, models.SMS_STATUS.DELIVERED)  # Delivered messages stay delivered
+
+    def test_failure(self):
+        FakeGateway.errors = [sms.SMSError("Timeout")] * sms.SMS_ATTEMPTS
+        with app.app_context():
+            msg = models.SMSMessage(phone_number=u'+919999999999', message=u"Hello")
+            sms.queue_sms(msg)
+            db.session.commit()
+            self.assertIsNone(sms.deliver_sms(msg))
+            for attempt in range(2, sms.SMS_ATTEMPTS):
+                self.assertIsNone(sms.deliver_sms(msg, *self.retries[-1][2][1:]))
+            self.assertEqual([args[1:] for seconds, func, args, kwargs in self.retries],
+                [('fake', attempt) for attempt in range(2, sms.SMS_ATTEMPTS + 1)])
+            self.assertFalse(sms.deliver_sms(msg, *self.retries[-1][2][1:]))
+            self.assertEqual(msg.status, models.SMS_STATUS.FAILED)
+            self.assertEqual(msg.fail_reason, u"fake: Timeout")
+
+    def test_reclaim(self):
+        with app.app_context():
+            stuck = models.SMSMessage(phone_number=u'+919999999999', message=u"Stuck")
+            sending = models.SMSMessage(phone_number=u'+919999999999', message=u"Sending")
+            sms.queue_sms(stuck)
+            sms.queue_sms(sending)
+            db.session.commit()
+            # One message was claimed by a worker that died, the other is being sent right now
+            stuck.status = sending.status = models.SMS_STATUS.SENDING
+            stuck.updated_at = datetime.utcnow() - timedelta(seconds=sms.SMS_CLAIM_TIMEOUT + 1)
+            db.session.commit()
+            sms.send_queued_sms()
+            self.assertEqual(FakeGateway.sent, [(u'+919999999999', u"Stuck")])
+            self.assertEqual(models.SMSMessage.query.filter_by(message=u"Sending").one().status,
+                models.SMS_STATUS.SENDING)